@@ -2,11 +2,36 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import copy
+import multiprocessing
 import os
+import re
 import yaml
 import sys
-import subprocess
 import shutil
+import socket
+import tempfile
+import traceback
+
+from androidbuildsystem import apk
+from androidbuildsystem import cache
+from androidbuildsystem import devices
+from androidbuildsystem import dex
+from androidbuildsystem import drawables
+from androidbuildsystem import files
+from androidbuildsystem import hooks
+from androidbuildsystem import incremental
+from androidbuildsystem import jvm
+from androidbuildsystem import libraries
+from androidbuildsystem import process
+from androidbuildsystem import remote
+from androidbuildsystem import resources
+from androidbuildsystem import sdk
+from androidbuildsystem import signing
+from androidbuildsystem import tasks
+from androidbuildsystem import tracing
+from androidbuildsystem import watch
+from androidbuildsystem import workspace
 
 
 android_manifest_contents = """<?xml version="1.0" encoding="utf-8"?>
@@ -39,6 +64,7 @@ android_strings_xml = """<?xml version="1.0" encoding="utf-8"?>
     <string name="helloText">Hello, world!</string>
 </resources>"""
 android_manifest_file = 'AndroidManifest.xml'
+javac_error_pattern = re.compile(r'^(.+\.java):\d+: error:')
 
 
 def _printAndExit(print_string):
@@ -52,6 +78,23 @@ def _printAndExit(print_string):
     sys.exit(1)
 
 
+def _runHooks(options, when):
+    """
+    Runs the before or after hooks of a step, exiting if a hook that fails
+    the build failed.
+
+    Args:
+    options: The build configuration options of the step.
+    when: Either before or after.
+    """
+    try:
+        failures = hooks.run(options.get(when))
+    except ValueError as e:
+        _printAndExit('Invalid ' + when + ' hooks: ' + str(e))
+    if len(failures) > 0:
+        _printAndExit('Failed ' + when + ' hooks: ' + ', '.join(failures))
+
+
 def _parseTargets(targets):
     """
     Parses the targets output by the android SDK into a dictionary.
@@ -139,168 +182,643 @@ def _parseVirtualDevices(virtual_devices):
     return parsed_virtual_devices
 
 
-def _compile(args, compile_options):
+def _writeArgumentFile(arguments):
+    """
+    Writes arguments to a temporary file that java tools can read with @file.
+
+    Args:
+    arguments: A list of the arguments to write.
+    Returns:
+    A string with the absolute path to the argument file.
+    """
+    argument_fd, argument_file = tempfile.mkstemp(suffix='.txt')
+    with os.fdopen(argument_fd, 'w') as argument_f:
+        for argument in arguments:
+            argument = argument.replace('\\', '\\\\').replace('"', '\\"')
+            argument_f.write('"' + argument + '"\n')
+    return argument_file
+
+
+def _javac(javac_program, obj_directory, classpaths, sourcepath,
+           java_source_paths):
+    """
+    Compiles a batch of java sources with a single javac invocation.
+
+    Args:
+    javac_program: The path to the javac program.
+    obj_directory: The directory to write the class files to.
+    classpaths: A list of the classpath entries.
+    sourcepath: The source path to find other java sources on.
+    java_source_paths: A list of the java sources to compile.
+    """
+    sources_file = _writeArgumentFile(java_source_paths)
+    try:
+        result, output = remote.run([javac_program,
+                                     '-d', obj_directory,
+                                     '-classpath', ':'.join(classpaths),
+                                     '-sourcepath', sourcepath,
+                                     '@' + sources_file],
+                                    sourcepath.split(':') + classpaths +
+                                    java_source_paths,
+                                    [obj_directory])
+    finally:
+        os.remove(sources_file)
+    sys.stdout.write(output)
+    if result != 0:
+        failed_source_paths = []
+        for line in output.split('\n'):
+            match = javac_error_pattern.match(line)
+            if match and match.group(1) not in failed_source_paths:
+                failed_source_paths.append(match.group(1))
+        for failed_source_path in failed_source_paths:
+            print 'Failed to compile ' + failed_source_path
+        _printAndExit('Failed to compile')
+
+
+def _compileConfiguration(javac_program, classpaths):
     """
-    Performs the compile steps to create java bytecode.
+    Describes the compiler and classpath so that incremental compiles can
+    tell when everything needs to be recompiled.
+
+    Args:
+    javac_program: The path to the javac program.
+    classpaths: A list of the classpath entries.
+    Returns:
+    A string identifying the compiler configuration.
+    """
+    configuration = [javac_program]
+    for classpath in classpaths:
+        if os.path.isfile(classpath):
+            classpath_stat = os.stat(classpath)
+            classpath += '@' + str(classpath_stat.st_size) + \
+                ',' + str(int(classpath_stat.st_mtime))
+        configuration.append(classpath)
+    return ':'.join(configuration)
+
+
+def _configurationFile(output_file):
+    """
+    Works out where the configuration a file was generated with is kept.
+
+    Args:
+    output_file: The path to the generated file.
+    Returns:
+    The path to the JSON file next to it.
+    """
+    return output_file + '.json'
+
+
+def _isUpToDate(output_file, input_directories, configuration=None):
+    """
+    Checks whether a file is newer than everything in its input directories.
+
+    The directories themselves are included so that deleted inputs are noticed.
+
+    Args:
+    output_file: The path to the generated file.
+    input_directories: A list of the directories and files the file is
+    generated from.
+    configuration: A string identifying the tools and options the file is
+    generated with, which has to match the one saved when it was written,
+    or None to only compare modification times.
+    Returns:
+    True if the file exists and no input has changed since it was written.
+    """
+    if not os.path.exists(output_file):
+        return False
+    if configuration is not None and \
+            files.loadJson(_configurationFile(output_file), {}).get(
+                'configuration') != configuration:
+        return False
+    output_mtime = os.path.getmtime(output_file)
+    for input_directory in input_directories:
+        if os.path.isfile(input_directory):
+            if os.path.getmtime(input_directory) > output_mtime:
+                return False
+            continue
+        for root, dirnames, filenames in os.walk(input_directory):
+            if os.path.getmtime(root) > output_mtime:
+                return False
+            for filename in filenames:
+                if os.path.getmtime(os.path.join(root, filename)) > \
+                        output_mtime:
+                    return False
+    return True
+
+
+def _syncDirectory(source_directory, destination_directory):
+    """
+    Copies the files of a directory tree that have different contents, so
+    that unchanged files keep their modification times.
+
+    Args:
+    source_directory: The directory to copy from.
+    destination_directory: The directory to copy to.
+    Returns:
+    True if any file was copied.
+    """
+    copied = False
+    for root, dirnames, filenames in os.walk(source_directory):
+        for filename in filenames:
+            source_file = os.path.join(root, filename)
+            destination_file = os.path.join(
+                destination_directory,
+                os.path.relpath(source_file, source_directory))
+            if os.path.isfile(destination_file):
+                with open(source_file, 'rb') as source_f:
+                    with open(destination_file, 'rb') as destination_f:
+                        if source_f.read() == destination_f.read():
+                            continue
+            destination_file_directory = os.path.dirname(destination_file)
+            if not os.path.exists(destination_file_directory):
+                os.makedirs(destination_file_directory)
+            shutil.copyfile(source_file, destination_file)
+            copied = True
+    return copied
+
+
+def _isAffected(changed, paths):
+    """
+    Checks whether any changed path is one of or inside a set of paths.
+
+    Args:
+    changed: The set of changed paths relative to the build directory.
+    paths: A list of files and directories relative to the build directory.
+    Returns:
+    True if a changed path is affected.
+    """
+    for changed_path in changed:
+        for path in paths:
+            if changed_path == path or \
+                    changed_path.startswith(path + os.sep):
+                return True
+    return False
+
+
+def _resourcesFile(args, package_options):
+    """
+    Works out the path of the resources archive written by aapt.
 
     Args:
     args: The arguments given to the main function.
-    compile_options: The build configuration options for compiling
+    package_options: The build configuration options for packaging, or None
+    if the package step is not configured.
     Returns:
-    A string with the absolute path to the build tools folder
+    A string with the path to the resources archive.
     """
-    # Execute the before scripts
-    for before_script in compile_options['before']:
-        subprocess.call(before_script, shell=True)
-    # Find a list of targets
+    name = 'resources'
+    if package_options is not None:
+        name = package_options['name']
+    return os.path.join(args.output, 'bin', name + '.ap_')
+
+
+def _findTarget(args, compile_options):
+    """
+    Checks that the target to compile against exists and finds the build
+    tools for it.
+
+    Args:
+    args: The arguments given to the main function.
+    compile_options: The build configuration options for compiling.
+    Returns:
+    A string with the absolute path to the build tools folder.
+    """
+    # Find the target in the SDK index
     print 'Checking target validity...'
     check_target = compile_options['target']
-    tools_directory = os.path.join(args.android, 'tools')
-    targets = subprocess.check_output(['android',
-                                       'list',
-                                       'target'],
-                                      cwd=tools_directory)
-    parsed_targets = _parseTargets(targets)
-    parsed_target = None
-    for target in parsed_targets:
-        if check_target in target['identifiers']:
-            parsed_target = target
-            break
+    sdk_index = sdk.loadIndex(args.android)
+    parsed_target = sdk.findPlatform(sdk_index, check_target)
     if parsed_target is None:
-        _printAndExit('Could not find target: ' +
-                      check_target +
-                      '\n' +
-                      targets)
-    # Remove the classes directory
-    obj_directory = os.path.join(args.directory, 'obj')
-    shutil.rmtree(obj_directory)
-    os.makedirs(obj_directory)
-    # Create R.java
-    print 'Creating R.java...'
-    build_tools_folder = os.path.join(args.android, 'build-tools')
-    build_tools_target_folder = ''
-    for directory in os.listdir(build_tools_folder):
-        if directory.split('.')[0] == parsed_target['api_level']:
-            build_tools_target_folder = os.path.join(build_tools_folder,
-                                                     directory)
-            break
+        # Add-ons are not in the index so ask the android tool
+        tools_directory = os.path.join(args.android, 'tools')
+        result, targets = process.run(['android', 'list', 'target'],
+                                      cwd=tools_directory)
+        if result != 0:
+            _printAndExit('Failed to list the targets\n' + targets)
+        parsed_targets = _parseTargets(targets)
+        for target in parsed_targets:
+            if check_target in target['identifiers']:
+                parsed_target = target
+                break
+        if parsed_target is None:
+            _printAndExit('Could not find target: ' +
+                          check_target +
+                          '\n' +
+                          targets)
+    build_tools_target_folder = sdk.findBuildTools(sdk_index,
+                                                   parsed_target['api_level'])
+    if build_tools_target_folder is None:
+        _printAndExit('Could not find build tools for API level ' +
+                      parsed_target['api_level'])
+    return build_tools_target_folder
+
+
+def _genDirectory(args):
+    """
+    Works out where R.java is written.
+
+    Args:
+    args: The arguments given to the main function.
+    Returns:
+    A string with the path to the directory of the generated sources.
+    """
+    if args.output != args.directory:
+        return os.path.join(args.output, 'gen')
+    return os.path.join(args.directory, 'src')
+
+
+def _createRJava(args, compile_options, build_tools_target_folder,
+                 changed=None, package_options=None):
+    """
+    Creates R.java from the resources, and the resources archive when the
+    resources are linked.
+
+    Args:
+    args: The arguments given to the main function.
+    compile_options: The build configuration options for compiling.
+    build_tools_target_folder: The build tools target folder.
+    changed: The set of paths changed since the last build in watch mode, or
+    None if anything may have changed.
+    package_options: The build configuration options for packaging, or None
+    if the package step is not configured.
+    Returns:
+    A tuple of the path to the resources archive when the resources are
+    linked, otherwise None, and whether R.java changed.
+    """
     android_aapt_program = os.path.join(build_tools_target_folder, 'aapt')
     res_directory = os.path.join(args.directory, 'res')
-    src_directory = os.path.join(args.directory, 'src')
+    gen_directory = _genDirectory(args)
+    if not os.path.exists(gen_directory):
+        os.makedirs(gen_directory)
     manifest_file = os.path.join(args.directory, android_manifest_file)
     platforms_directory = os.path.join(args.android, 'platforms')
-    target_directory = os.path.join(platforms_directory, check_target)
+    target_directory = os.path.join(platforms_directory,
+                                    compile_options['target'])
     android_jar_file = os.path.join(target_directory, 'android.jar')
-    result = subprocess.check_call([android_aapt_program,
-                                    'package',
-                                    '-f',
-                                    '-m',
-                                    '-S', res_directory,
-                                    '-J', src_directory,
-                                    '-M', manifest_file,
-                                    '-I', android_jar_file])
-    if result != 0:
-        _printAndExit('Failed to create R.java')
-    # Compile
-    print 'Compiling...'
+    link_resources = compile_options.get('link_resources', False)
+    resources_file = _resourcesFile(args, package_options)
+    r_java_changed = False
+    if changed is not None and \
+            not _isAffected(changed, ['res', android_manifest_file,
+                                      args.build]) and \
+            (not link_resources or os.path.isfile(resources_file)):
+        print 'R.java is up to date'
+    elif link_resources:
+        print 'Creating R.java and the resources archive...'
+        rename = None
+        if package_options is not None:
+            rename = package_options.get('rename')
+        r_directory = tempfile.mkdtemp(dir=args.output)
+        try:
+            result = resources.link(build_tools_target_folder,
+                                    manifest_file,
+                                    res_directory,
+                                    android_jar_file,
+                                    os.path.join(args.output, 'compiled'),
+                                    resources_file,
+                                    r_directory,
+                                    rename)
+            if result != 0:
+                _printAndExit('Failed to compile resources')
+            r_java_changed = _syncDirectory(r_directory, gen_directory)
+        finally:
+            shutil.rmtree(r_directory)
+    else:
+        print 'Creating R.java...'
+        r_directory = tempfile.mkdtemp(dir=args.output)
+        try:
+            result = cache.call([android_aapt_program,
+                                 'package',
+                                 '-f',
+                                 '-m',
+                                 '-S', res_directory,
+                                 '-J', r_directory,
+                                 '-M', manifest_file,
+                                 '-I', android_jar_file],
+                                [res_directory,
+                                 manifest_file,
+                                 android_jar_file],
+                                [r_directory])
+            if result != 0:
+                _printAndExit('Failed to create R.java')
+            r_java_changed = _syncDirectory(r_directory, gen_directory)
+        finally:
+            shutil.rmtree(r_directory)
+    if link_resources:
+        return resources_file, r_java_changed
+    return None, r_java_changed
+
+
+def _compileJava(args, compile_options, library_jars, changed=None,
+                 r_java_changed=True):
+    """
+    Compiles the java sources and R.java into class files.
+
+    Args:
+    args: The arguments given to the main function.
+    compile_options: The build configuration options for compiling.
+    library_jars: The list of library jars returned by libraries.index.
+    changed: The set of paths changed since the last build in watch mode, or
+    None if anything may have changed.
+    r_java_changed: Whether R.java was changed by this build.
+    """
+    obj_directory = os.path.join(args.output, 'obj')
+    if changed is not None and not r_java_changed and \
+            not _isAffected(changed, ['src', 'lib']):
+        print 'Java classes are up to date'
+        return
+    # Remove the classes directory
+    if not compile_options.get('incremental', False):
+        shutil.rmtree(obj_directory)
+        os.makedirs(obj_directory)
+    platforms_directory = os.path.join(args.android, 'platforms')
+    target_directory = os.path.join(platforms_directory,
+                                    compile_options['target'])
+    android_jar_file = os.path.join(target_directory, 'android.jar')
+    src_directory = os.path.join(args.directory, 'src')
+    gen_directory = _genDirectory(args)
     javac_program = os.path.join(args.java, 'bin/javac')
-    obj_directory = os.path.join(args.directory, 'obj')
     classpaths = [android_jar_file, obj_directory]
+    classpaths.extend(jar['path'] for jar in library_jars)
+    classpaths.extend(args.classpath)
+    source_directories = [src_directory]
+    if gen_directory != src_directory:
+        source_directories.append(gen_directory)
+    java_sources = {}
+    for source_directory in source_directories:
+        for root, dirnames, filenames in os.walk(source_directory):
+            for filename in filenames:
+                if os.path.splitext(filename)[1] == '.java':
+                    java_source_path = os.path.join(root, filename)
+                    relative_path = os.path.relpath(java_source_path,
+                                                    source_directory)
+                    java_sources[relative_path] = java_source_path
+    java_source_paths = sorted(java_sources.values())
+    incremental_compile = compile_options.get('incremental', False)
+    if incremental_compile:
+        configuration = _compileConfiguration(javac_program, classpaths)
+        sources, previous = incremental.loadManifest(obj_directory,
+                                                     configuration)
+        if len(sources) == 0 and len(previous) == 0:
+            shutil.rmtree(obj_directory)
+            os.makedirs(obj_directory)
+        java_source_paths, hashes = incremental.plan(sources,
+                                                     previous,
+                                                     obj_directory,
+                                                     java_sources)
+        if len(previous) > 0:
+            incremental.saveManifest(obj_directory, configuration, sources,
+                                     previous)
+    if len(java_source_paths) == 0:
+        print 'Java classes are up to date'
+    else:
+        print 'Compiling ' + str(len(java_source_paths)) + ' java sources...'
+    while True:
+        batch_size = compile_options.get('batch_size', 0)
+        if batch_size <= 0:
+            batch_size = max(len(java_source_paths), 1)
+        for index in range(0, len(java_source_paths), batch_size):
+            _javac(javac_program,
+                   obj_directory,
+                   classpaths,
+                   ':'.join(source_directories),
+                   java_source_paths[index:index + batch_size])
+        if not incremental_compile or \
+                (len(java_source_paths) == 0 and len(previous) == 0):
+            break
+        # Compile the sources using classes that changed, level by level
+        incremental.update(sources, obj_directory, hashes)
+        java_source_paths = incremental.dependents(sources,
+                                                   previous,
+                                                   obj_directory,
+                                                   java_sources)
+        incremental.saveManifest(obj_directory, configuration, sources,
+                                 previous)
+        if len(java_source_paths) == 0:
+            break
+        print 'Compiling ' + str(len(java_source_paths)) + \
+            ' dependent java sources...'
+
+
+def _predexLibraries(build_tools_target_folder, library_jars):
+    """
+    Converts the library jars into dex files, unless an earlier build
+    already did.
+
+    Args:
+    build_tools_target_folder: The build tools target folder.
+    library_jars: The list of library jars returned by libraries.index.
+    Returns:
+    A list of the dex file of each library jar.
+    """
+    # Libraries are only dexed once and kept in the user directory
+    result, library_dex_files = libraries.predex(build_tools_target_folder,
+                                                 library_jars)
+    if result != 0:
+        _printAndExit('Failed to pre-dex libraries')
+    return library_dex_files
+
+
+def _dexConfiguration(compile_options, build_tools_target_folder,
+                      java_program, library_dex_files):
+    """
+    Describes how the DEX file is created so that it is created again when
+    the dex program, build tools or pre-dexed libraries change.
+
+    Args:
+    compile_options: The build configuration options for compiling.
+    build_tools_target_folder: The build tools target folder.
+    java_program: The path to the java program, which runs the dx merger.
+    library_dex_files: The list of the dex files of the library jars.
+    Returns:
+    A string identifying the DEX configuration.
+    """
+    if compile_options.get('incremental_dex', False):
+        configuration = ['incremental_dex', dex.dexConfiguration(
+            dex.dexProgram(build_tools_target_folder))]
+    else:
+        configuration = ['dex', dex.dexConfiguration(
+            os.path.join(build_tools_target_folder, 'dx'))]
+    configuration.append(os.path.normpath(build_tools_target_folder))
+    configuration.append(java_program)
+    configuration.extend(library_dex_files)
+    return ':'.join(configuration)
+
+
+def _createDex(args, compile_options, build_tools_target_folder,
+               library_dex_files):
+    """
+    Creates the DEX file from the class files and the pre-dexed libraries.
+
+    Args:
+    args: The arguments given to the main function.
+    compile_options: The build configuration options for compiling.
+    build_tools_target_folder: The build tools target folder.
+    library_dex_files: The list of the dex files of the library jars.
+    """
+    obj_directory = os.path.join(args.output, 'obj')
     lib_directory = os.path.join(args.directory, 'lib')
-    for lib_file in os.listdir(lib_directory):
-        if os.path.isfile(lib_file) and os.path.splitext(lib_file)[1] == 'jar':
-            classpaths.append(os.path.join(lib_directory, lib_file))
-    java_source_paths = []
-    for root, dirnames, filenames in os.walk(src_directory):
-        for filename in filenames:
-            if os.path.splitext(filename)[1] == '.java':
-                java_source_paths.append(os.path.join(root, filename))
-    for java_source_path in java_source_paths:
-        result = subprocess.check_call([javac_program,
-                                        '-d', obj_directory,
-                                        '-classpath', ':'.join(classpaths),
-                                        '-sourcepath', src_directory,
-                                        java_source_path])
-        if result != 0:
-            _printAndExit('Failed to compile')
-    # Create the DEX file
+    classes_dex_file = os.path.join(args.output, 'bin/classes.dex')
+    java_program = os.path.join(args.java, 'bin/java')
+    configuration = _dexConfiguration(compile_options,
+                                      build_tools_target_folder,
+                                      java_program,
+                                      library_dex_files)
+    if _isUpToDate(classes_dex_file,
+                   [obj_directory, lib_directory] + args.libraries +
+                   args.classpath,
+                   configuration):
+        print 'DEX file is up to date'
+        return
     print 'Creating a DEX file...'
-    dx_program = os.path.join(build_tools_target_folder, 'dx')
-    classes_dex_file = os.path.join(args.directory, 'bin/classes.dex')
-    result = subprocess.call([dx_program,
-                              '--dex',
-                              '--output=' + classes_dex_file,
-                              obj_directory,
-                              lib_directory])
+    configuration_file = _configurationFile(classes_dex_file)
+    if os.path.exists(configuration_file):
+        os.remove(configuration_file)
+    if compile_options.get('incremental_dex', False):
+        result = dex.dexIncremental(build_tools_target_folder,
+                                    java_program,
+                                    obj_directory,
+                                    os.path.join(args.output, 'dex'),
+                                    classes_dex_file,
+                                    args.classpath,
+                                    library_dex_files)
+    else:
+        dx_program = os.path.join(build_tools_target_folder, 'dx')
+        project_dex_file = classes_dex_file
+        if len(library_dex_files) > 0:
+            project_dex_file = os.path.join(args.output, 'bin/project.dex')
+        result = cache.call([dx_program,
+                             '--dex',
+                             '--output=' + project_dex_file,
+                             obj_directory] + args.classpath,
+                            [obj_directory] + args.classpath,
+                            [project_dex_file])
+        if result == 0 and len(library_dex_files) > 0:
+            result = dex.merge(build_tools_target_folder,
+                               java_program,
+                               [project_dex_file] + library_dex_files,
+                               classes_dex_file)
     if result != 0:
         _printAndExit('Failed to create DEX')
-    # Execute the after scripts
-    for after_script in compile_options['after']:
-        subprocess.call(after_script, shell=True)
-    return build_tools_target_folder
+    files.saveJson(configuration_file, {'configuration': configuration})
 
 
-def _package(args, package_options, build_tools_target_folder, target):
+def _removeApks(args):
     """
-    Performs the package steps to create an unsigned APK.
+    Removes the APKs written by earlier builds from the bin folder.
 
     Args:
     args: The arguments given to the main function.
-    package_options: The build configuration options for packaging.
-    target: The target to package with.
-    Returns:
-    A string with the absolute path to the unsigned APK file.
     """
-    # Execute the before scripts
-    for before_script in package_options['before']:
-        subprocess.call(before_script, shell=True)
-    print 'Packaging APK...'
-    # Remove the apks in the bin folder
-    bin_directory = os.path.join(args.directory, 'bin')
+    bin_directory = os.path.join(args.output, 'bin')
     for bin_file in os.listdir(bin_directory):
         if bin_file.split('.')[-1] == 'apk':
             os.remove(os.path.join(bin_directory, bin_file))
-    # Package the APK
+
+
+def _crunchDrawables(args, build_tools_target_folder):
+    """
+    Crunches the drawable images, unless an earlier build already did, and
+    merges them with the other resources.
+
+    Args:
+    args: The arguments given to the main function.
+    build_tools_target_folder: The build tools target folder.
+    Returns:
+    A string with the path to the merged resources directory.
+    """
+    # Images are only crunched once and kept in the user directory
+    result, res_directory = drawables.crunch(
+        build_tools_target_folder,
+        os.path.join(args.directory, 'res'),
+        os.path.join(args.output, 'crunched'))
+    if result != 0:
+        _printAndExit('Failed to crunch drawables')
+    return res_directory
+
+
+def _packageResources(args, package_options, build_tools_target_folder,
+                      target, res_directory=None):
+    """
+    Packages the resources and manifest into the resources archive with
+    aapt.
+
+    Args:
+    args: The arguments given to the main function.
+    package_options: The build configuration options for packaging.
+    build_tools_target_folder: The build tools target folder.
+    target: The target to package with.
+    res_directory: The resources directory with the drawables already
+    crunched, or None to package the resources of the project and let aapt
+    crunch them.
+    Returns:
+    A string with the path to the resources archive.
+    """
+    print 'Packaging resources...'
     aapt_program = os.path.join(build_tools_target_folder, 'aapt')
     manifest_file = os.path.join(args.directory, android_manifest_file)
-    res_directory = os.path.join(args.directory, 'res')
+    crunch_arguments = ['--no-crunch']
+    if res_directory is None:
+        res_directory = os.path.join(args.directory, 'res')
+        crunch_arguments = []
     platforms_directory = os.path.join(args.android, 'platforms')
     target_directory = os.path.join(platforms_directory, target)
     android_jar_file = os.path.join(target_directory, 'android.jar')
-    unsigned_apk_filename = package_options['name'] + '.unsigned.apk'
-    unsigned_apk_file = os.path.join(bin_directory, unsigned_apk_filename)
-    result = subprocess.call([aapt_program,
-                              'package',
-                              '-f',
-                              '-M', manifest_file,
-                              '-S', res_directory,
-                              '-I', android_jar_file,
-                              '-F', unsigned_apk_file,
-                              bin_directory])
+    resources_file = _resourcesFile(args, package_options)
+    aapt_arguments = [aapt_program,
+                      'package',
+                      '-f',
+                      '-M', manifest_file,
+                      '-S', res_directory,
+                      '-I', android_jar_file,
+                      '-F', resources_file] + crunch_arguments
+    if 'rename' in package_options:
+        aapt_arguments += ['--rename-manifest-package',
+                           package_options['rename']]
+    result = cache.call(aapt_arguments,
+                        [manifest_file, res_directory, android_jar_file],
+                        [resources_file])
     if result != 0:
         _printAndExit('Failed to package APK')
-    # Execute the after scripts
-    for after_script in package_options['after']:
-        subprocess.call(after_script, shell=True)
+    return resources_file
+
+
+def _package(args, package_options, resources_file):
+    """
+    Performs the package step, adding the DEX to the resources archive to
+    create an unsigned APK.
+
+    Args:
+    args: The arguments given to the main function.
+    package_options: The build configuration options for packaging.
+    resources_file: The resources archive.
+    Returns:
+    A string with the absolute path to the unsigned APK file.
+    """
+    print 'Packaging APK...'
+    bin_directory = os.path.join(args.output, 'bin')
+    unsigned_apk_file = os.path.join(bin_directory,
+                                     package_options['name'] +
+                                     '.unsigned.apk')
+    classes_dex_file = os.path.join(bin_directory, 'classes.dex')
+    writer = apk.ApkWriter(unsigned_apk_file)
+    writer.copyArchive(resources_file)
+    if os.path.isfile(classes_dex_file):
+        writer.addFile('classes.dex', classes_dex_file)
+    writer.close()
     return unsigned_apk_file
 
 
-def _sign(args, sign_options, unsigned_apk_file, build_tools_target_folder):
+def _createKeystore(args, sign_options):
     """
-    Performs the package steps to create a signed APK.
+    Creates the keystore used to sign APKs if it does not exist yet.
 
     Args:
     args: The arguments given to the main function.
     sign_options: The build configuration options for signing.
-    unsigned_apk_file: The path to the unsigned APK file.
-    build_tools_target_folder: The build tools target folder.
     Returns:
-    A string with the absolute path to the zipaligned APK file.
+    A string with the absolute path to the keystore file.
     """
-    # Execute the before scripts
-    for before_script in sign_options['before']:
-        subprocess.call(before_script, shell=True)
-    # Check if we have a keystore
     keystore = sign_options['keystore']
     keystore_file = os.path.join(args.directory, 'key.keystore')
     if not os.path.exists(keystore_file):
@@ -312,97 +830,875 @@ def _sign(args, sign_options, unsigned_apk_file, build_tools_target_folder):
         key_parameters += 'L=' + keystore['location'] + ',\n'
         key_parameters += 'S=' + keystore['state'] + ',\n'
         key_parameters += 'C=' + keystore['country']
-        result = subprocess.check_call([keytool_program,
-                                        '-genkeypair',
-                                        '-validity', '1000',
-                                        '-dname', key_parameters,
-                                        '-keystore', keystore_file,
-                                        '-storepass',
-                                        sign_options['storepass'],
-                                        '-keypass', sign_options['keypass'],
-                                        '-alias', sign_options['key_alias'],
-                                        '-keyalg', 'RSA'])
+        result = process.call([keytool_program,
+                               '-genkeypair',
+                               '-validity', '1000',
+                               '-dname', key_parameters,
+                               '-keystore', keystore_file,
+                               '-storepass',
+                               sign_options['storepass'],
+                               '-keypass', sign_options['keypass'],
+                               '-alias', sign_options['key_alias'],
+                               '-keyalg', 'RSA',
+                               '-storetype', 'JKS'])
         if result != 0:
             _printAndExit('Failed to create keystore')
-    print 'Signing APK...'
+    return keystore_file
+
+
+def _v1DigestAlgorithm(args):
+    """
+    Works out the digest algorithm of v1 signatures from the minimum API
+    level of the app, since Android before API level 18 only verifies SHA-1.
+
+    Args:
+    args: The arguments given to the main function.
+    Returns:
+    The name of the digest algorithm, SHA1 or SHA-256.
+    """
+    manifest_file = os.path.join(args.directory, android_manifest_file)
+    return signing.v1DigestAlgorithm(
+        resources.manifestMinSdkVersion(manifest_file))
+
+
+def _signers(args, sign_options, keystore_file):
+    """
+    Works out how to sign APKs, loading the key into the built in signer
+    when the keystore can be read.
+
+    Args:
+    args: The arguments given to the main function.
+    sign_options: The build configuration options for signing.
+    keystore_file: The path to the keystore file.
+    Returns:
+    A tuple of the v1 signer, the v2 signer (None when not signing with the
+    v2 scheme), the digest algorithm of the v1 manifest and a description
+    of the signers for cache keys.
+    """
+    v2 = sign_options.get('v2', True)
+    digest_algorithm = _v1DigestAlgorithm(args)
+    if sign_options.get('signer', 'builtin') != 'jarsigner':
+        try:
+            key = signing.loadKey(keystore_file,
+                                  sign_options['storepass'],
+                                  sign_options['keypass'],
+                                  sign_options['key_alias'])
+            return (signing.v1Signer(key, v2, digest_algorithm),
+                    signing.v2Signer(key) if v2 else None,
+                    digest_algorithm,
+                    ['builtin', 'v1', digest_algorithm] +
+                    (['v2'] if v2 else []))
+        except (IOError, ValueError) as e:
+            print 'Using jarsigner because the built in signer cannot ' + \
+                'load the key: ' + str(e)
     jarsigner_file = os.path.join(args.java, 'bin/jarsigner')
-    signed_apk_file = unsigned_apk_file.replace('unsigned.apk', 'signed.apk')
-    result = subprocess.check_call([jarsigner_file,
-                                    '-keystore', keystore_file,
-                                    '-storepass', sign_options['storepass'],
-                                    '-keypass', sign_options['keypass'],
-                                    '-signedjar', signed_apk_file,
-                                    unsigned_apk_file,
-                                    sign_options['key_alias']])
-    # Zip align the APK
-    zipalign_file = os.path.join(build_tools_target_folder, 'zipalign')
-    apk_file = signed_apk_file.replace('signed.apk', 'apk')
-    result = subprocess.call([zipalign_file,
-                              '-f',
-                              '4',
-                              signed_apk_file,
-                              apk_file])
-    # Execute the after scripts
-    for after_script in sign_options['after']:
-        subprocess.call(after_script, shell=True)
-    return zipalign_file
-
-
-def _install(args, install_options, profiles, apk_file):
+    return (apk.jarsignerSigner(jarsigner_file,
+                                keystore_file,
+                                sign_options['storepass'],
+                                sign_options['keypass'],
+                                sign_options['key_alias'],
+                                digest_algorithm),
+            None,
+            digest_algorithm,
+            [jarsigner_file, 'v1', digest_algorithm])
+
+
+def _writeSignedApk(args, sign_options, keystore_file, apk_file, inputs,
+                    add_entries):
     """
-    Performs the package steps to install an APK.
+    Writes a signed APK in a single pass, aligning uncompressed entries as
+    they are written.
+
+    Args:
+    args: The arguments given to the main function.
+    sign_options: The build configuration options for signing.
+    keystore_file: The path to the keystore file.
+    apk_file: The path to write the APK to.
+    inputs: A list of the files and directories the entries are read from.
+    add_entries: A function adding the entries to an ApkWriter.
+    Returns:
+    The result code, 0 on success.
+    """
+    alignment = sign_options.get('alignment', 4)
+    signer, v2_signer, digest_algorithm, description = _signers(
+        args, sign_options, keystore_file)
+
+    def write():
+        temporary_apk_file = apk_file + '.tmp'
+        try:
+            writer = apk.ApkWriter(temporary_apk_file, alignment,
+                                   digest_algorithm)
+            add_entries(writer)
+            writer.close(signer, v2_signer)
+            os.rename(temporary_apk_file, apk_file)
+        except (IOError, OSError) as e:
+            print str(e)
+            if os.path.exists(temporary_apk_file):
+                os.remove(temporary_apk_file)
+            return 1
+        return 0
+    return cache.run([description + ['-align', str(alignment),
+                                     '-keystore', keystore_file,
+                                     sign_options['key_alias']]],
+                     inputs + [keystore_file],
+                     [apk_file],
+                     write)
+
+
+def _sign(args, sign_options, keystore_file, unsigned_apk_file,
+          build_tools_target_folder):
+    """
+    Performs the package steps to create a signed APK.
+
+    Args:
+    args: The arguments given to the main function.
+    sign_options: The build configuration options for signing.
+    keystore_file: The path to the keystore file.
+    unsigned_apk_file: The path to the unsigned APK file.
+    build_tools_target_folder: The build tools target folder.
+    Returns:
+    A string with the absolute path to the signed and aligned APK file.
+    """
+    print 'Signing APK...'
+    apk_file = unsigned_apk_file.replace('unsigned.apk', 'apk')
+    if sign_options.get('signer', 'builtin') != 'jarsigner':
+        result = _writeSignedApk(
+            args,
+            sign_options,
+            keystore_file,
+            apk_file,
+            [unsigned_apk_file],
+            lambda writer: writer.copyArchive(unsigned_apk_file,
+                                              ['META-INF/']))
+    else:
+        jarsigner_file = os.path.join(args.java, 'bin/jarsigner')
+        signed_apk_file = unsigned_apk_file.replace('unsigned.apk',
+                                                    'signed.apk')
+        digest_algorithm = _v1DigestAlgorithm(args)
+        jarsigner_command = [jarsigner_file,
+                             '-digestalg', digest_algorithm,
+                             '-sigalg',
+                             signing.digest_algorithms[
+                                 digest_algorithm]['signature'],
+                             '-keystore', keystore_file,
+                             '-storepass', sign_options['storepass'],
+                             '-keypass', sign_options['keypass'],
+                             '-signedjar', signed_apk_file,
+                             unsigned_apk_file,
+                             sign_options['key_alias']]
+        # Zip align the APK
+        zipalign_file = os.path.join(build_tools_target_folder, 'zipalign')
+        zipalign_command = [zipalign_file,
+                            '-f',
+                            '4',
+                            signed_apk_file,
+                            apk_file]
+        result = cache.run([jarsigner_command, zipalign_command],
+                           [unsigned_apk_file, keystore_file],
+                           [signed_apk_file, apk_file],
+                           lambda: (process.call(jarsigner_command) or
+                                    process.call(zipalign_command)))
+    if result != 0:
+        _printAndExit('Failed to sign APK')
+    return apk_file
+
+
+def _assemble(args, sign_options, keystore_file, resources_file):
+    """
+    Performs the sign step in pipeline mode, streaming the resources,
+    classes.dex and assets into the final APK and aligning and signing it
+    as it is written.
+
+    Args:
+    args: The arguments given to the main function.
+    sign_options: The build configuration options for signing.
+    keystore_file: The path to the keystore file.
+    resources_file: The path to the resources archive written by aapt.
+    Returns:
+    A string with the absolute path to the signed APK file.
+    """
+    print 'Assembling and signing APK...'
+    classes_dex_file = os.path.join(args.output, 'bin', 'classes.dex')
+    assets_directory = os.path.join(args.directory, 'assets')
+    apk_file = os.path.splitext(resources_file)[0] + '.apk'
+
+    def addEntries(writer):
+        writer.copyArchive(resources_file, ['META-INF/'])
+        if os.path.isfile(classes_dex_file):
+            writer.addFile('classes.dex', classes_dex_file)
+        if os.path.isdir(assets_directory):
+            writer.addDirectory('assets/', assets_directory)
+    result = _writeSignedApk(args,
+                             sign_options,
+                             keystore_file,
+                             apk_file,
+                             [resources_file,
+                              classes_dex_file,
+                              assets_directory],
+                             addEntries)
+    if result != 0:
+        _printAndExit('Failed to sign APK')
+    return apk_file
+
+
+def _installTargets(args, install_options, profiles):
+    """
+    Works out the devices to install onto, creating the virtual devices
+    that do not exist yet.
 
     Args:
     args: The arguments given to the main function.
     install_options: The build configuration options for installing.
     profiles: A list containing the profiles in our build configuration.
+    Returns:
+    A list of dictionaries with the name, adb selector and serial of each
+    device.
+    """
+    platform_tools_directory = os.path.join(args.android, 'platform-tools')
+    adb_program = os.path.join(platform_tools_directory, 'adb')
+    profile_names = install_options.get('profiles')
+    if profile_names is None:
+        profile_names = [install_options['profile']]
+    serials = devices.connectedSerials(adb_program)
+    if serials is None:
+        _printAndExit('Failed to list the connected devices')
+    targets = []
+    if profile_names == 'all':
+        for serial in serials:
+            targets.append({'name': serial,
+                            'selector': ['-s', serial],
+                            'serial': serial})
+    else:
+        print 'Checking virtual devices...'
+        tools_directory = os.path.join(args.android, 'tools')
+        android_tools_program = os.path.join(tools_directory, 'android')
+        virtual_devices = sdk.virtualDevices(sdk.loadIndex(args.android))
+        if virtual_devices is None:
+            result, virtual_devices_output = process.run(['android',
+                                                          'list',
+                                                          'avd'],
+                                                         cwd=tools_directory)
+            if result != 0:
+                _printAndExit('Failed to list the virtual devices\n' +
+                              virtual_devices_output)
+            virtual_devices = _parseVirtualDevices(virtual_devices_output)
+        emulators = devices.emulatorSerials(adb_program, serials)
+        for profile_name in profile_names:
+            final_profile = None
+            for profile in profiles:
+                if profile['name'] == profile_name:
+                    final_profile = profile
+                    break
+            if final_profile is None:
+                if profile_name not in virtual_devices:
+                    _printAndExit('Could not find a profile to install the '
+                                  'app onto: ' + profile_name)
+                final_profile = {'name': profile_name, 'type': 'emulator'}
+            if final_profile['type'] == 'emulator' and \
+                    profile_name not in virtual_devices:
+                # Create the virtual device
+                result = process.call([android_tools_program,
+                                       '--verbose',
+                                       'create', 'avd',
+                                       '--name', final_profile['name'],
+                                       '--target', final_profile['target'],
+                                       '--sdcard', final_profile['sdcard'],
+                                       '--abi', final_profile['abi']])
+                if result != 0:
+                    _printAndExit('Failed to create virtual device')
+            serial = final_profile.get('serial', emulators.get(profile_name))
+            if serial is None and final_profile['type'] == 'device':
+                # Without a serial the profile is the only connected device
+                device_serials = [device_serial for device_serial in serials
+                                  if not device_serial.startswith('emulator-')]
+                if len(device_serials) > 1:
+                    _printAndExit('More than one device is connected, set '
+                                  'the serial of the profile: ' +
+                                  profile_name)
+                if len(device_serials) == 1:
+                    serial = device_serials[0]
+            if serial is None:
+                _printAndExit('The device to install the app onto is not '
+                              'running: ' + profile_name)
+            targets.append({'name': profile_name,
+                            'selector': ['-s', serial],
+                            'serial': serial})
+    return targets
+
+
+def _install(args, install_options, package_options, targets, apk_file):
+    """
+    Performs the package steps to install an APK.
+
+    Args:
+    args: The arguments given to the main function.
+    install_options: The build configuration options for installing.
+    package_options: The build configuration options for packaging.
+    targets: The list of devices returned by _installTargets.
     apk_file: The signed APK file.
     """
-    # Execute the before scripts
-    for before_script in install_options['before']:
-        subprocess.call(before_script, shell=True)
-    print 'Checking virtual devices...'
-    tools_directory = os.path.join(args.android, 'tools')
-    android_tools_program = os.path.join(tools_directory, 'android')
-    virtual_devices_output = subprocess.check_output(['android',
-                                                      'list',
-                                                      'avd'],
-                                                     cwd=tools_directory)
-    virtual_devices = _parseVirtualDevices(virtual_devices_output)
-    final_profile = None
-    for profile in profiles:
-        if profile['name'] == install_options['profile']:
-            final_profile = profile
-            break
-    if install_options['profile'] not in virtual_devices:
-        # Create the virtual device
-        if final_profile is None:
-            _printAndExit('Could not find a profile to install the app onto')
-        if final_profile['type'] == 'emulator':
-            result = subprocess.call([android_tools_program,
-                                      '--verbose',
-                                      'create', 'avd',
-                                      '--name', final_profile['name'],
-                                      '--target', final_profile['target'],
-                                      '--sdcard', final_profile['sdcard'],
-                                      '--abi', final_profile['abi']])
-        if result != 0:
-            _printAndExit('Failed to create virtual device')
-    # Install
-    print 'Installing the app...'
     platform_tools_directory = os.path.join(args.android, 'platform-tools')
     adb_program = os.path.join(platform_tools_directory, 'adb')
-    device_type = '-e'
-    if final_profile['type'] == 'device':
-        device_type = '-d'
-    result = subprocess.call([adb_program,
-                              device_type,
-                              apk_file])
-    if result != 0:
-        _printAndExit('Failed to install the APK')
-    # Execute the after scripts
-    for after_script in install_options['after']:
-        subprocess.call(after_script, shell=True)
+    package = package_options.get('rename')
+    if package is None:
+        package = resources.manifestPackage(
+            os.path.join(args.directory, android_manifest_file))
+    print 'Installing the app onto ' + str(len(targets)) + ' devices...'
+    results = devices.install(adb_program,
+                              targets,
+                              apk_file,
+                              package,
+                              install_options.get('jobs'),
+                              install_options.get('force', False),
+                              install_options.get('delta', True))
+    kinds = {'installed': 'installed',
+             'delta': 'installed changes',
+             'skipped': 'up to date'}
+    failed_targets = []
+    statuses = {}
+    for target, result, output, kind in results:
+        if result != 0:
+            failed_targets.append(target['name'])
+            statuses[target['name']] = 'failed'
+        else:
+            statuses[target['name']] = kinds[kind]
+    for target in targets:
+        print target['name'] + ': ' + statuses[target['name']]
+    if len(failed_targets) > 0:
+        _printAndExit('Failed to install the APK onto ' +
+                      ', '.join(failed_targets))
+
+
+def _runSteps(args, build_config, changed=None):
+    """
+    Runs the build steps as a graph of tasks, stopping at the first step
+    that is not configured.
+
+    Each task names the values it reads and writes, such as the build tools
+    folder or the DEX file, and tasks that do not depend on each other run
+    at the same time, so the keystore is created, old APKs are removed, the
+    resources are packaged and the libraries are pre-dexed while javac
+    runs. The before and after hooks of a step wait for every task before
+    them, and every task after them waits for them.
+
+    Args:
+    args: The arguments given to the main function.
+    build_config: The build configuration.
+    changed: The set of paths changed since the last build in watch mode, or
+    None if anything may have changed.
+    """
+    for create_directory in ['obj', 'bin']:
+        full_create_directory = os.path.join(args.output, create_directory)
+        if not os.path.exists(full_create_directory):
+            os.makedirs(full_create_directory)
+    graph = []
+    barrier = []
+
+    def addTask(name, step, run, inputs=(), outputs=()):
+        graph.append(tasks.task(name, step, run, list(inputs) + barrier,
+                                outputs))
+
+    def addHooks(step, options, when):
+        if not options.get(when):
+            return
+        name = step + ' ' + when
+        addTask(name,
+                step,
+                lambda values: _runHooks(options, when),
+                [output for task in graph for output in task['outputs']],
+                [name])
+        barrier[:] = [name]
+    if 'compile' in build_config:
+        compile_options = build_config['compile']
+        package_options = build_config.get('package')
+        link_resources = compile_options.get('link_resources', False)
+        addHooks('compile', compile_options, 'before')
+        addTask('target',
+                'compile',
+                lambda values: {'build_tools': _findTarget(args,
+                                                           compile_options)},
+                outputs=['build_tools'])
+        def createRJava(values):
+            resources_file, r_java_changed = _createRJava(
+                args,
+                compile_options,
+                values['build_tools'],
+                changed,
+                package_options)
+            return {'resources_archive': resources_file,
+                    'r_java': r_java_changed}
+        addTask('R.java',
+                'compile',
+                createRJava,
+                ['build_tools'],
+                ['r_java'] + (['resources_archive'] if link_resources
+                              else []))
+        addTask('libraries',
+                'compile',
+                lambda values: {'library_jars': libraries.index(
+                    [os.path.join(args.directory, 'lib')] + args.libraries)},
+                outputs=['library_jars'])
+        addTask('javac',
+                'compile',
+                lambda values: _compileJava(args,
+                                            compile_options,
+                                            values['library_jars'],
+                                            changed,
+                                            values['r_java']),
+                ['r_java', 'library_jars'],
+                ['classes'])
+        addTask('predex',
+                'compile',
+                lambda values: {'library_dex_files': _predexLibraries(
+                    values['build_tools'],
+                    values['library_jars'])},
+                ['build_tools', 'library_jars'],
+                ['library_dex_files'])
+        addTask('dex',
+                'compile',
+                lambda values: _createDex(args,
+                                          compile_options,
+                                          values['build_tools'],
+                                          values['library_dex_files']),
+                ['build_tools', 'classes', 'library_dex_files'],
+                ['classes_dex'])
+        addHooks('compile', compile_options, 'after')
+        if package_options is not None:
+            pipeline = package_options.get('pipeline', False) and \
+                'sign' in build_config
+            addHooks('package', package_options, 'before')
+            addTask('remove APKs',
+                    'package',
+                    lambda values: _removeApks(args),
+                    outputs=['old_apks_removed'])
+            if not link_resources:
+                crunch = package_options.get('crunch', True)
+                if crunch:
+                    addTask('drawables',
+                            'package',
+                            lambda values: {'crunched_res': _crunchDrawables(
+                                args, values['build_tools'])},
+                            ['build_tools'],
+                            ['crunched_res'])
+                addTask('package resources',
+                        'package',
+                        lambda values: {'resources_archive':
+                                        _packageResources(
+                                            args,
+                                            package_options,
+                                            values['build_tools'],
+                                            compile_options['target'],
+                                            values.get('crunched_res'))},
+                        ['build_tools', 'old_apks_removed'] +
+                        (['crunched_res'] if crunch else []),
+                        ['resources_archive'])
+            if not pipeline:
+                addTask('package',
+                        'package',
+                        lambda values: {'unsigned_apk': _package(
+                            args,
+                            package_options,
+                            values['resources_archive'])},
+                        ['resources_archive',
+                         'classes_dex',
+                         'old_apks_removed'],
+                        ['unsigned_apk'])
+            addHooks('package', package_options, 'after')
+            if 'sign' in build_config:
+                sign_options = build_config['sign']
+                addHooks('sign', sign_options, 'before')
+                addTask('keystore',
+                        'sign',
+                        lambda values: {'keystore': _createKeystore(
+                            args, sign_options)},
+                        outputs=['keystore'])
+                if pipeline:
+                    addTask('sign',
+                            'sign',
+                            lambda values: {'apk': _assemble(
+                                args,
+                                sign_options,
+                                values['keystore'],
+                                values['resources_archive'])},
+                            ['keystore',
+                             'resources_archive',
+                             'classes_dex',
+                             'old_apks_removed'],
+                            ['apk'])
+                else:
+                    addTask('sign',
+                            'sign',
+                            lambda values: {'apk': _sign(
+                                args,
+                                sign_options,
+                                values['keystore'],
+                                values['unsigned_apk'],
+                                values['build_tools'])},
+                            ['keystore', 'unsigned_apk', 'build_tools'],
+                            ['apk'])
+                addHooks('sign', sign_options, 'after')
+                if 'install' in build_config:
+                    install_options = build_config['install']
+                    addHooks('install', install_options, 'before')
+                    addTask('devices',
+                            'install',
+                            lambda values: {'install_targets':
+                                            _installTargets(
+                                                args,
+                                                install_options,
+                                                build_config.get('profiles',
+                                                                 []))},
+                            outputs=['install_targets'])
+                    addTask('install',
+                            'install',
+                            lambda values: _install(args,
+                                                    install_options,
+                                                    package_options,
+                                                    values['install_targets'],
+                                                    values['apk']),
+                            ['install_targets', 'apk'],
+                            ['installed'])
+                    addHooks('install', install_options, 'after')
+    tasks.run(graph)
+    if args.explain:
+        tasks.printCriticalPath(graph)
+
+
+def _roots(args):
+    """
+    Lists the directories the build cache and remote workers replace with
+    placeholders, so paths do not depend on where the build is run.
+
+    Args:
+    args: The arguments given to the main function.
+    Returns:
+    A list of tuples of directories and their placeholders.
+    """
+    return [(args.output, '$OUT'),
+            (args.directory, '$DIR'),
+            (args.android, '$ANDROID'),
+            (args.java, '$JAVA')]
+
+
+def _build(args, build_config, changed=None):
+    """
+    Configures the hooks, tasks, cache and remote workers, runs the build
+    steps and prints the build statistics.
+
+    Args:
+    args: The arguments given to the main function.
+    build_config: The build configuration.
+    changed: The set of paths changed since the last build in watch mode, or
+    None if anything may have changed.
+    """
+    hooks.configure(build_config.get('hook_jobs'))
+    tasks.configure(build_config.get('task_jobs'))
+    jvm.configure(build_config.get('jvm_workers'), args.java)
+    cache.configure(build_config.get('cache'), _roots(args))
+    remote.configure(build_config.get('remote'), _roots(args))
+    _runSteps(args, build_config, changed)
+    tracing.printSummary()
+    process.printReport()
+    if args.cache_stats:
+        cache.printStatistics()
+    if remote.isEnabled():
+        remote.printStatistics()
+    if drawables.statistics['images'] > 0:
+        drawables.printStatistics()
+    print 'Build completed'
+
+
+def _variantConfig(build_config, variant):
+    """
+    Creates the build configuration of a variant.
+
+    Args:
+    build_config: The build configuration.
+    variant: The variant options, each step section in it overrides the
+    options of that step.
+    Returns:
+    A dictionary with the build configuration of the variant.
+    """
+    variant_config = copy.deepcopy(build_config)
+    del variant_config['variants']
+    for step in ['compile', 'package', 'sign', 'install']:
+        if step in variant and step in variant_config:
+            variant_config[step].update(variant[step])
+    return variant_config
+
+
+def _buildVariant(variant_job):
+    """
+    Builds a variant in a worker process, capturing its output.
+
+    Args:
+    variant_job: A tuple of the arguments, the build configuration of the
+    variant and the variant name.
+    Returns:
+    A tuple of the variant name, the exit status, the captured output and
+    the trace events recorded.
+    """
+    args, variant_config, name = variant_job
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    log_file = os.path.join(args.output, 'build.log')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    stdout_fd = os.dup(1)
+    stderr_fd = os.dup(2)
+    status = 0
+    with open(log_file, 'w') as log_f:
+        os.dup2(log_f.fileno(), 1)
+        os.dup2(log_f.fileno(), 2)
+        try:
+            _build(args, variant_config)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(stdout_fd, 1)
+            os.dup2(stderr_fd, 2)
+            os.close(stdout_fd)
+            os.close(stderr_fd)
+    with open(log_file) as log_f:
+        output = log_f.read()
+    events = [event for event in tracing.events
+              if event['pid'] == os.getpid()]
+    return name, status, output, events
+
+
+def _buildVariants(args, build_config):
+    """
+    Builds every variant in its own output directory on a pool of worker
+    processes.
+
+    Args:
+    args: The arguments given to the main function.
+    build_config: The build configuration containing the variants.
+    """
+    if 'compile' in build_config and 'package' in build_config and \
+            'sign' in build_config:
+        # Create the shared keystore before the variants race to create it
+        _createKeystore(args, build_config['sign'])
+    variant_jobs = []
+    for variant in build_config['variants']:
+        variant_args = copy.copy(args)
+        variant_args.output = os.path.join(args.output,
+                                           'build',
+                                           variant['name'])
+        variant_jobs.append((variant_args,
+                             _variantConfig(build_config, variant),
+                             variant['name']))
+    print 'Building ' + str(len(variant_jobs)) + ' variants with ' + \
+        str(args.jobs) + ' workers...'
+    pool = multiprocessing.Pool(min(args.jobs, len(variant_jobs)),
+                                maxtasksperchild=1)
+    failed_variants = []
+    for name, status, output, events in pool.imap_unordered(_buildVariant,
+                                                            variant_jobs):
+        tracing.events.extend(events)
+        for line in output.splitlines():
+            print '[' + name + '] ' + line
+        if status != 0:
+            failed_variants.append(name)
+    pool.close()
+    pool.join()
+    for variant_args, variant_config, name in variant_jobs:
+        print name + ': ' + ('failed' if name in failed_variants else 'ok')
+    if len(failed_variants) > 0:
+        _printAndExit(str(len(failed_variants)) + ' of ' +
+                      str(len(variant_jobs)) + ' variants failed')
+
+
+def _buildWorkspace(args):
+    """
+    Builds the modules listed in a workspace file in dependency order,
+    building modules that do not depend on each other at the same time on
+    a pool of worker threads.
+
+    The classes of every module are packaged into bin/classes.jar, which is
+    put on the classpath of the modules depending on it along with the jars
+    in its lib directory.
+
+    Args:
+    args: The arguments given to the main function.
+    """
+    workspace_file = os.path.join(args.directory, args.workspace)
+    if not os.path.isfile(workspace_file):
+        _printAndExit('Error: Cannot find file ' + workspace_file)
+    with open(workspace_file) as workspace_f:
+        try:
+            workspace_config = yaml.safe_load(workspace_f)
+        except yaml.YAMLError as e:
+            _printAndExit('Error: Cannot load YAML file ' + workspace_file +
+                          '\n' + str(e))
+    if not isinstance(workspace_config, dict):
+        _printAndExit('Error: Cannot load YAML file ' + workspace_file)
+    try:
+        modules = workspace.parse(workspace_config)
+    except ValueError as e:
+        _printAndExit('Error: ' + str(e))
+    module_builds = {}
+    for module in modules:
+        module_args = copy.copy(args)
+        module_args.directory = os.path.join(args.directory,
+                                             module['directory'])
+        module_args.output = module_args.directory
+        if args.output != args.directory:
+            module_args.output = os.path.join(args.output, module['name'])
+        for required in ['src', 'res', 'lib', android_manifest_file]:
+            if not os.path.exists(os.path.join(module_args.directory,
+                                               required)):
+                _printAndExit('Module ' + module['name'] + ' has no ' +
+                              required)
+        module_config = _loadBuildConfig(module_args)
+        if 'variants' in module_config:
+            _printAndExit('Module ' + module['name'] +
+                          ' cannot have variants')
+        module_args.classpath = list(args.classpath)
+        module_args.libraries = list(args.libraries)
+        for dependency in workspace.dependencies(modules, module):
+            dependency_args = module_builds[dependency['name']][0]
+            module_args.classpath.append(
+                os.path.join(dependency_args.output, 'bin',
+                             workspace.classes_jar_file))
+            module_args.libraries.append(
+                os.path.join(dependency_args.directory, 'lib'))
+        module_builds[module['name']] = (module_args, module_config)
+    hooks.configure(workspace_config.get('hook_jobs'))
+    tasks.configure(workspace_config.get('task_jobs'))
+    jvm.configure(workspace_config.get('jvm_workers'), args.java)
+    cache.configure(workspace_config.get('cache'), _roots(args))
+    remote.configure(workspace_config.get('remote'), _roots(args))
+
+    def buildModule(module):
+        module_args, module_config = module_builds[module['name']]
+        with process.redirectOutput():
+            _runSteps(module_args, module_config)
+        if 'compile' in module_config:
+            workspace.packageClasses(
+                os.path.join(module_args.output, 'obj'),
+                os.path.join(module_args.output, 'bin',
+                             workspace.classes_jar_file))
+    jobs = workspace_config.get('jobs') or multiprocessing.cpu_count()
+    print 'Building ' + str(len(modules)) + ' modules with ' + \
+        str(jobs) + ' workers...'
+    results = workspace.build(modules, buildModule, jobs)
+    failed_modules = []
+    for module in modules:
+        result = results.get(module['name'])
+        if result is None:
+            print module['name'] + ': skipped'
+            failed_modules.append(module['name'])
+        elif result != 0:
+            print module['name'] + ': failed'
+            failed_modules.append(module['name'])
+        else:
+            print module['name'] + ': ok'
+    tracing.printSummary()
+    process.printReport()
+    if args.cache_stats:
+        cache.printStatistics()
+    if remote.isEnabled():
+        remote.printStatistics()
+    if drawables.statistics['images'] > 0:
+        drawables.printStatistics()
+    if len(failed_modules) > 0:
+        _printAndExit(str(len(failed_modules)) + ' of ' +
+                      str(len(modules)) + ' modules were not built')
+    print 'Build completed'
+
+
+def _loadBuildConfig(args):
+    """
+    Reads the build configuration.
+
+    Args:
+    args: The arguments given to the main function.
+    Returns:
+    A dictionary with the build configuration.
+    """
+    build_file = os.path.join(str(args.directory), str(args.build))
+    if not os.path.isfile(build_file):
+        _printAndExit('Error: Cannot find file ' + build_file)
+    with open(build_file) as build_f:
+        try:
+            build_config = yaml.safe_load(build_f)
+        except yaml.YAMLError as e:
+            _printAndExit('Error: Cannot load YAML file ' + build_file +
+                          '\n' + str(e))
+    if build_config is None:
+        _printAndExit('Error: Cannot load YAML file ' + build_file)
+    if args.target is not None:
+        build_config['compile']['target'] = args.target
+    return build_config
+
+
+def _watch(args, build_config):
+    """
+    Builds the project, then rebuilds it whenever its sources, resources,
+    libraries, manifest or build configuration change until interrupted.
+
+    The build configuration, SDK index and signing key stay in memory
+    between rebuilds. R.java is only created again when the resources or
+    manifest change, and the sources are only compiled and dexed again when
+    a source, library or R.java changes. A rebuild after a failed one runs
+    every step.
+
+    Args:
+    args: The arguments given to the main function.
+    build_config: The build configuration.
+    """
+    state = {'build_config': build_config, 'failed': False}
+
+    def rebuild(changed):
+        if changed is not None:
+            print 'Changed: ' + ', '.join(sorted(changed))
+            if args.build in changed:
+                try:
+                    state['build_config'] = _loadBuildConfig(args)
+                except SystemExit:
+                    print 'Keeping the previous build configuration'
+                    return
+                changed = None
+            if state['failed']:
+                # The steps that failed have to run again
+                changed = None
+        process.statistics['processes'] = 0
+        process.statistics['jvms'] = 0
+        for statistic in jvm.statistics:
+            jvm.statistics[statistic] = 0
+        for statistic in drawables.statistics:
+            drawables.statistics[statistic] = 0
+        for statistic in cache.statistics:
+            cache.statistics[statistic] = 0
+        for statistic in remote.statistics:
+            remote.statistics[statistic] = 0
+        # The summary and the trace only cover the latest rebuild
+        del tracing.events[:]
+        state['failed'] = True
+        try:
+            if 'variants' in state['build_config']:
+                _buildVariants(args, state['build_config'])
+            else:
+                _build(args, state['build_config'], changed)
+            state['failed'] = False
+        except SystemExit:
+            print 'Build failed'
+        sys.stdout.flush()
+    rebuild(None)
+    try:
+        watch.run(args.directory,
+                  ['src', 'res', 'lib', android_manifest_file, args.build],
+                  rebuild,
+                  float(state['build_config'].get('watch_debounce', 0.3)),
+                  lambda path: os.path.basename(path) == 'R.java')
+    except KeyboardInterrupt:
+        print 'Stopped watching'
 
 
 def _main():
@@ -417,32 +1713,77 @@ def _main():
                         help='The file name of the build configuration',
                         required=False,
                         default='androidbuildsystem.yaml')
+    parser.add_argument('--cache-stats',
+                        help='Prints a summary of the build cache use',
+                        required=False,
+                        default=False,
+                        action='store_true')
     parser.add_argument('-d',
                         '--directory',
                         help='The directory of the build script',
                         required=False,
                         default=os.getcwd())
+    parser.add_argument('--explain',
+                        help='Prints the critical path of the build tasks',
+                        required=False,
+                        default=False,
+                        action='store_true')
     parser.add_argument('-i',
                         '--init',
                         help='Initialises a build system folder structure',
                         required=False,
                         default=False,
                         action='store_true')
+    parser.add_argument('-J',
+                        '--jobs',
+                        help='The number of variants to build in parallel',
+                        required=False,
+                        default=1,
+                        type=int)
     parser.add_argument('-j',
                         '--java',
                         help='The directory of the Java SDK',
                         required=False,
                         default=os.environ.get('JAVA_HOME'))
+    parser.add_argument('-o',
+                        '--output',
+                        help='The directory to write obj and bin to',
+                        required=False)
     parser.add_argument('-t',
                         '--target',
                         help='The target to compile against',
                         required=False)
+    parser.add_argument('--trace',
+                        help='Writes a Chrome trace of the build to a file',
+                        required=False)
     parser.add_argument('-v',
                         '--version',
                         help='Prints the version of android build system',
                         required=False,
                         default=False,
                         action='store_true')
+    parser.add_argument('-w',
+                        '--watch',
+                        help='Rebuilds whenever the project changes',
+                        required=False,
+                        default=False,
+                        action='store_true')
+    parser.add_argument('--worker',
+                        help='Runs a remote worker listening on '
+                        '[HOST:]PORT',
+                        required=False)
+    parser.add_argument('--worker-max-size',
+                        help='The megabytes of inputs a remote worker keeps',
+                        required=False,
+                        default=remote.worker_max_size,
+                        type=int)
+    parser.add_argument('--workspace',
+                        help='The file name of a workspace listing modules '
+                        'to build',
+                        required=False)
+    # The jars and lib directories of the workspace modules a module
+    # depends on
+    parser.set_defaults(classpath=[], libraries=[])
     args = parser.parse_args()
     if args.version:
         print 'android build system version 1.0.0'
@@ -459,15 +1800,26 @@ def _main():
         _printAndExit('Failed to define the Java SDK Path (-j)')
     if args.android is None:
         _printAndExit('Failed to define the Android SDK Path (-a)')
+    if args.worker is not None:
+        try:
+            remote.serve(args.worker, args.android, args.java,
+                         max_size=args.worker_max_size)
+        except (socket.error, ValueError) as e:
+            _printAndExit('Failed to start the remote worker: ' + str(e))
+        return
+    if args.workspace is not None:
+        if args.output is None:
+            args.output = args.directory
+        if args.trace is not None:
+            tracing.enable()
+        try:
+            _buildWorkspace(args)
+        finally:
+            if args.trace is not None:
+                tracing.write(args.trace)
+        return
     # Read our build configuration
-    build_file = os.path.join(str(args.directory), str(args.build))
-    if os.path.isfile(build_file):
-        with open(build_file) as build_f:
-            build_config = yaml.safe_load(build_f)
-            if build_config is None:
-                _printAndExit('Error: Cannot load YAML file ' + build_file)
-    else:
-        _printAndExit('Error: Cannot find file ' + build_file)
+    build_config = _loadBuildConfig(args)
     # Check our build system directory
     check_directories = ['src',
                          'res',
@@ -483,11 +1835,9 @@ def _main():
             else:
                 _printAndExit('Required directory not available: ' +
                               check_directory)
-    create_directories = ['obj', 'bin', 'doc']
-    for create_directory in create_directories:
-        full_check_directory = os.path.join(args.directory, create_directory)
-        if not os.path.exists(full_check_directory):
-            os.makedirs(full_check_directory)
+    doc_directory = os.path.join(args.directory, 'doc')
+    if not os.path.exists(doc_directory):
+        os.makedirs(doc_directory)
     manifest_file = os.path.join(args.directory, android_manifest_file)
     res_directory = os.path.join(args.directory, 'res')
     values_directory = os.path.join(res_directory, 'values')
@@ -499,30 +1849,24 @@ def _main():
             open(strings_xml_file, 'w').write(android_strings_xml)
         print 'Successfully initialised the required build directories'
         return 0
-    if not os.path.exists(android_manifest_file):
+    if not os.path.exists(manifest_file):
         _printAndExit('Could not find ' +
                       android_manifest_file +
                       ' in the build directory')
-    if args.target is not None:
-        build_config['compile']['target'] = args.target
-    if 'compile' in build_config:
-        build_tools_target_folder = _compile(args, build_config['compile'])
-        if 'package' in build_config:
-            unsigned_apk_file = _package(args,
-                                         build_config['package'],
-                                         build_tools_target_folder,
-                                         build_config['compile']['target'])
-            if 'sign' in build_config:
-                apk_file = _sign(args,
-                                 build_config['sign'],
-                                 unsigned_apk_file,
-                                 build_tools_target_folder)
-                if 'install' in build_config:
-                    _install(args,
-                             build_config['install'],
-                             build_config['profiles'],
-                             apk_file)
-    print 'Build completed'
+    if args.output is None:
+        args.output = args.directory
+    if args.trace is not None:
+        tracing.enable()
+    try:
+        if args.watch:
+            _watch(args, build_config)
+        elif 'variants' in build_config:
+            _buildVariants(args, build_config)
+        else:
+            _build(args, build_config)
+    finally:
+        if args.trace is not None:
+            tracing.write(args.trace)
 
 
 if __name__ == "__main__":
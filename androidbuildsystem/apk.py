@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+import zlib
+
+from androidbuildsystem import process
+from androidbuildsystem import signing
+
+
+chunk_size = 1024 * 1024
+alignment_extra_id = 0xd935
+# 1980-01-01 00:00 so that archives built from the same inputs are identical
+dos_time = 0
+dos_date = (1 << 5) | 1
+stored_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.wav', '.mp2', '.mp3',
+                     '.ogg', '.aac', '.mpg', '.mpeg', '.mid', '.midi',
+                     '.smf', '.jet', '.rtttl', '.imy', '.xmf', '.mp4',
+                     '.m4a', '.m4v', '.3gp', '.3gpp', '.3g2', '.3gpp2',
+                     '.amr', '.awb', '.wma', '.wmv', '.webm', '.mkv']
+
+
+class ApkWriter(object):
+    """
+    Writes an APK in a single pass, aligning uncompressed entries as they are
+    written and recording the digest of every entry for signing.
+    """
+
+    def __init__(self, path, alignment=4, digest_algorithm='SHA-256'):
+        """
+        Opens the APK for writing.
+
+        Args:
+        path: The path to write the APK to.
+        alignment: The alignment in bytes of uncompressed entry data.
+        digest_algorithm: The name of the digest algorithm of the v1
+        manifest, as returned by signing.v1DigestAlgorithm.
+        """
+        self.path = path
+        self.alignment = alignment
+        self.digest_algorithm = digest_algorithm
+        self.digest = signing.digest_algorithms[digest_algorithm]['hash']
+        self.file = open(path, 'w+b')
+        self.entries = []
+        self.digests = []
+        self.names = set()
+
+    def _writeLocalHeader(self, name, method, crc, compressed_size, size,
+                          align):
+        """
+        Writes the local file header of an entry, padding its extra field so
+        the data that follows is aligned.
+
+        Returns:
+        The offset of the local file header.
+        """
+        offset = self.file.tell()
+        extra = b''
+        if align:
+            data_offset = offset + 30 + len(name) + 6
+            padding = (self.alignment - data_offset % self.alignment) % \
+                self.alignment
+            extra = struct.pack('<HHH', alignment_extra_id, 2 + padding,
+                                self.alignment) + b'\0' * padding
+        self.file.write(struct.pack('<IHHHHHIIIHH',
+                                    0x04034b50,
+                                    20,
+                                    0x0800,
+                                    method,
+                                    dos_time,
+                                    dos_date,
+                                    crc,
+                                    compressed_size,
+                                    size,
+                                    len(name),
+                                    len(extra)))
+        self.file.write(name)
+        self.file.write(extra)
+        return offset
+
+    def _patchLocalHeader(self, offset, crc, compressed_size, size):
+        """
+        Fills in the CRC and sizes of a local file header once the entry data
+        has been written.
+        """
+        end = self.file.tell()
+        self.file.seek(offset + 14)
+        self.file.write(struct.pack('<III', crc, compressed_size, size))
+        self.file.seek(end)
+
+    def _addEntry(self, name, method, offset, crc, compressed_size, size,
+                  digest):
+        """
+        Records an entry for the central directory and the signature.
+        """
+        self.entries.append((name, method, offset, crc, compressed_size,
+                             size))
+        self.digests.append((name, base64.b64encode(digest.digest())))
+        self.names.add(name)
+
+    def addStream(self, name, stream, compress=True):
+        """
+        Adds an entry, reading its contents from a file object in chunks.
+
+        Args:
+        name: The name of the entry in the APK.
+        stream: A file object to read the contents from.
+        compress: Whether to deflate the entry, uncompressed entries are
+        aligned.
+        """
+        name = name.encode('utf-8') if not isinstance(name, bytes) else name
+        method = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        offset = self._writeLocalHeader(name, method, 0, 0, 0, not compress)
+        compressor = None
+        if compress:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        digest = self.digest()
+        crc = 0
+        size = 0
+        compressed_size = 0
+        chunk = stream.read(chunk_size)
+        while chunk:
+            digest.update(chunk)
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            self.file.write(chunk)
+            compressed_size += len(chunk)
+            chunk = stream.read(chunk_size)
+        if compressor is not None:
+            chunk = compressor.flush()
+            self.file.write(chunk)
+            compressed_size += len(chunk)
+        crc &= 0xffffffff
+        self._patchLocalHeader(offset, crc, compressed_size, size)
+        self._addEntry(name, method, offset, crc, compressed_size, size,
+                       digest)
+
+    def addFile(self, name, path, compress=None):
+        """
+        Adds a file as an entry.
+
+        Args:
+        name: The name of the entry in the APK.
+        path: The path to the file.
+        compress: Whether to deflate the entry, by default files that are
+        already compressed are stored.
+        """
+        if compress is None:
+            compress = os.path.splitext(name)[1].lower() not in \
+                stored_extensions
+        with open(path, 'rb') as f:
+            self.addStream(name, f, compress)
+
+    def addBytes(self, name, data, compress=True):
+        """
+        Adds an entry from a string of bytes.
+
+        Args:
+        name: The name of the entry in the APK.
+        data: The contents of the entry.
+        compress: Whether to deflate the entry.
+        """
+        self.addStream(name, _BytesReader(data), compress)
+
+    def copyArchive(self, archive_path, exclude_prefixes=()):
+        """
+        Copies the entries of another archive without recompressing them.
+
+        Args:
+        archive_path: The path to the archive to copy, such as the resources
+        archive written by aapt.
+        exclude_prefixes: Entry name prefixes not to copy.
+        """
+        with zipfile.ZipFile(archive_path) as archive:
+            with open(archive_path, 'rb') as raw:
+                for info in archive.infolist():
+                    if info.filename.endswith('/') or \
+                            info.filename.startswith(tuple(exclude_prefixes)):
+                        continue
+                    raw.seek(info.header_offset)
+                    header = raw.read(30)
+                    name_length, extra_length = struct.unpack('<HH',
+                                                              header[26:30])
+                    raw.seek(info.header_offset + 30 + name_length +
+                             extra_length)
+                    name = info.filename.encode('utf-8')
+                    stored = info.compress_type == zipfile.ZIP_STORED
+                    offset = self._writeLocalHeader(name,
+                                                    info.compress_type,
+                                                    info.CRC,
+                                                    info.compress_size,
+                                                    info.file_size,
+                                                    stored)
+                    digest = self.digest()
+                    remaining = info.compress_size
+                    while remaining > 0:
+                        chunk = raw.read(min(chunk_size, remaining))
+                        if not chunk:
+                            raise IOError('Truncated entry ' + info.filename)
+                        if stored:
+                            digest.update(chunk)
+                        self.file.write(chunk)
+                        remaining -= len(chunk)
+                    if not stored:
+                        with archive.open(info) as entry:
+                            chunk = entry.read(chunk_size)
+                            while chunk:
+                                digest.update(chunk)
+                                chunk = entry.read(chunk_size)
+                    self._addEntry(name,
+                                   info.compress_type,
+                                   offset,
+                                   info.CRC,
+                                   info.compress_size,
+                                   info.file_size,
+                                   digest)
+
+    def addDirectory(self, prefix, directory):
+        """
+        Adds every file in a directory tree, such as the assets.
+
+        Args:
+        prefix: The entry name prefix, such as assets/.
+        directory: The directory to add.
+        """
+        for root, dirnames, filenames in os.walk(directory):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(root, filename)
+                name = prefix + os.path.relpath(path, directory).replace(
+                    os.sep, '/')
+                self.addFile(name, path)
+
+    def _readSection(self, start, end):
+        """
+        Creates a function reading a section of the APK written so far in
+        chunks.
+
+        Args:
+        start: The offset of the section.
+        end: The offset after the section.
+        Returns:
+        A function returning the next chunk given its maximum size.
+        """
+        position = [start]
+
+        def read(size):
+            size = min(size, end - position[0])
+            if size <= 0:
+                return b''
+            self.file.seek(position[0])
+            chunk = self.file.read(size)
+            position[0] += len(chunk)
+            return chunk
+        return read
+
+    def close(self, signer=None, v2_signer=None):
+        """
+        Signs the APK if signers are given, then writes the central directory.
+
+        Args:
+        signer: A function taking the v1 manifest and returning a list of
+        tuples of META-INF entry names and contents to add.
+        v2_signer: A function taking the v2 content digest and returning the
+        APK signing block to write before the central directory.
+        """
+        if signer is not None:
+            manifest = v1Manifest(self.digests, self.digest_algorithm)
+            for name, data in signer(manifest):
+                self.addBytes(name, data)
+        central_directory_offset = self.file.tell()
+        central_directory = []
+        for name, method, offset, crc, compressed_size, size in self.entries:
+            central_directory.append(struct.pack('<IHHHHHHIIIHHHHHII',
+                                                 0x02014b50,
+                                                 20,
+                                                 20,
+                                                 0x0800,
+                                                 method,
+                                                 dos_time,
+                                                 dos_date,
+                                                 crc,
+                                                 compressed_size,
+                                                 size,
+                                                 len(name),
+                                                 0,
+                                                 0,
+                                                 0,
+                                                 0,
+                                                 0,
+                                                 offset))
+            central_directory.append(name)
+        central_directory = b''.join(central_directory)
+        if v2_signer is not None:
+            end_of_central_directory = _endOfCentralDirectory(
+                len(self.entries),
+                len(central_directory),
+                central_directory_offset)
+            content_digest = signing.contentDigest([
+                self._readSection(0, central_directory_offset),
+                _BytesReader(central_directory).read,
+                _BytesReader(end_of_central_directory).read])
+            self.file.seek(central_directory_offset)
+            self.file.write(v2_signer(content_digest))
+            central_directory_offset = self.file.tell()
+        self.file.write(central_directory)
+        self.file.write(_endOfCentralDirectory(len(self.entries),
+                                               len(central_directory),
+                                               central_directory_offset))
+        self.file.close()
+
+
+class _BytesReader(object):
+    """
+    Reads a string of bytes in chunks like a file.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, size):
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += len(chunk)
+        return chunk
+
+
+def _endOfCentralDirectory(count, central_directory_size,
+                           central_directory_offset):
+    """
+    Creates the end of central directory record.
+
+    Args:
+    count: The number of entries.
+    central_directory_size: The size of the central directory.
+    central_directory_offset: The offset of the central directory.
+    Returns:
+    The encoded record.
+    """
+    return struct.pack('<IHHHHIIH',
+                       0x06054b50,
+                       0,
+                       0,
+                       count,
+                       count,
+                       central_directory_size,
+                       central_directory_offset,
+                       0)
+
+
+def _manifestLine(line):
+    """
+    Wraps a manifest line at 72 bytes as the JAR specification requires.
+
+    Args:
+    line: The line to wrap.
+    Returns:
+    The wrapped line ending with CRLF.
+    """
+    wrapped = line[:72]
+    line = line[72:]
+    while line:
+        wrapped += b'\r\n ' + line[:71]
+        line = line[71:]
+    return wrapped + b'\r\n'
+
+
+def v1Manifest(digests, digest_algorithm='SHA-256'):
+    """
+    Creates the JAR manifest listing the digest of every entry.
+
+    Args:
+    digests: A list of tuples of entry names and base64 digests.
+    digest_algorithm: The name of the digest algorithm, SHA1 or SHA-256.
+    Returns:
+    The contents of META-INF/MANIFEST.MF.
+    """
+    manifest = b'Manifest-Version: 1.0\r\nCreated-By: androidbuildsystem\r\n' \
+        b'\r\n'
+    for name, digest in digests:
+        if name.startswith(b'META-INF/'):
+            continue
+        manifest += _manifestLine(b'Name: ' + name)
+        manifest += _manifestLine(digest_algorithm + b'-Digest: ' + digest)
+        manifest += b'\r\n'
+    return manifest
+
+
+def jarsignerSigner(jarsigner_program, keystore_file, storepass, keypass,
+                    key_alias, digest_algorithm='SHA-256'):
+    """
+    Creates a signer that has jarsigner sign only the manifest.
+
+    jarsigner signs every section of an existing manifest, so signing a
+    stub jar containing just the manifest gives the same signature files as
+    signing the whole APK without jarsigner reading or writing it.
+
+    Args:
+    jarsigner_program: The path to the jarsigner program.
+    keystore_file: The path to the keystore.
+    storepass: The keystore password.
+    keypass: The key password.
+    key_alias: The alias of the key in the keystore.
+    digest_algorithm: The name of the digest algorithm of the manifest.
+    Returns:
+    A signer function for ApkWriter.close.
+    """
+    def signer(manifest):
+        temporary_directory = tempfile.mkdtemp()
+        try:
+            stub_file = os.path.join(temporary_directory, 'stub.jar')
+            signed_stub_file = os.path.join(temporary_directory,
+                                            'signed.jar')
+            with zipfile.ZipFile(stub_file, 'w') as stub:
+                stub.writestr('META-INF/MANIFEST.MF', manifest)
+            result, output = process.run([jarsigner_program,
+                                          '-keystore', keystore_file,
+                                          '-storepass', storepass,
+                                          '-keypass', keypass,
+                                          '-digestalg', digest_algorithm,
+                                          '-sigalg',
+                                          signing.digest_algorithms[
+                                              digest_algorithm]['signature'],
+                                          '-signedjar', signed_stub_file,
+                                          stub_file,
+                                          key_alias])
+            if result != 0:
+                raise IOError('jarsigner failed\n' + output)
+            signature_entries = []
+            with zipfile.ZipFile(signed_stub_file) as signed_stub:
+                for info in signed_stub.infolist():
+                    if info.filename.startswith('META-INF/') and \
+                            not info.filename.endswith('/'):
+                        signature_entries.append(
+                            (info.filename, signed_stub.read(info)))
+            return signature_entries
+        finally:
+            shutil.rmtree(temporary_directory, ignore_errors=True)
+    return signer
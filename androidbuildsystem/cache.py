@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+from androidbuildsystem import files
+from androidbuildsystem import process
+from androidbuildsystem import tracing
+
+
+cache_version = '1'
+settings = {'directory': None,
+            'max_size': 0,
+            'roots': []}
+statistics = {'hits': 0,
+              'misses': 0,
+              'restored_bytes': 0,
+              'stored_bytes': 0,
+              'evicted': 0}
+_file_hashes = {}
+_statistics_lock = threading.Lock()
+
+
+def configure(cache_options, roots):
+    """
+    Enables the build cache.
+
+    Args:
+    cache_options: The build configuration options for the cache, or None to
+    disable it.
+    roots: A list of tuples of directories and the placeholders they are
+    replaced with in cache keys, so that checkouts in different places share
+    cache entries.
+    """
+    if cache_options is None:
+        settings['directory'] = None
+        return
+    settings['directory'] = os.path.expanduser(
+        cache_options.get('directory', files.userDirectory('cache')))
+    settings['max_size'] = int(cache_options.get('max_size', 1024)) * \
+        1024 * 1024
+    settings['roots'] = sorted(roots, key=lambda root: -len(root[0]))
+
+
+def isEnabled():
+    """
+    Checks whether the build cache is enabled.
+
+    Returns:
+    True if a cache directory has been configured.
+    """
+    return settings['directory'] is not None
+
+
+def _hashFile(path):
+    """
+    Hashes a file, remembering the hash until the file is modified.
+
+    Args:
+    path: The path to the file.
+    Returns:
+    A string with the hex digest of the file.
+    """
+    path_stat = os.stat(path)
+    memo_key = (path, path_stat.st_size, path_stat.st_mtime)
+    if memo_key not in _file_hashes:
+        _file_hashes[memo_key] = files.hashFile(path)
+    return _file_hashes[memo_key]
+
+
+def _normalise(argument, outputs):
+    """
+    Replaces output paths and root directories in a tool argument.
+
+    Args:
+    argument: The argument to normalise.
+    outputs: A list of the output paths of the tool.
+    Returns:
+    The normalised argument.
+    """
+    for index, output in enumerate(outputs):
+        argument = argument.replace(output, '$OUTPUT' + str(index))
+    for root, placeholder in settings['roots']:
+        argument = argument.replace(root, placeholder)
+    return argument
+
+
+def _key(commands, inputs, outputs):
+    """
+    Works out the cache key of a set of tool invocations.
+
+    Args:
+    commands: A list of the commands that produce the outputs.
+    inputs: A list of the files and directories the commands read.
+    outputs: A list of the files and directories the commands write.
+    Returns:
+    A string with the hex digest identifying the outputs.
+    """
+    digest = hashlib.sha256()
+    digest.update(cache_version)
+    for command in commands:
+        digest.update('\0command\0' + _normalise(command[0], outputs))
+        if os.path.isfile(command[0]):
+            digest.update(_hashFile(command[0]))
+        for argument in command[1:]:
+            digest.update('\0' + _normalise(argument, outputs))
+    for path in inputs:
+        digest.update('\0input\0' + _normalise(path, outputs))
+        if os.path.isfile(path):
+            digest.update(_hashFile(path))
+        elif os.path.isdir(path):
+            for root, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.startswith('.'):
+                        # Build state such as the compile manifest
+                        continue
+                    file_path = os.path.join(root, filename)
+                    digest.update('\0' + os.path.relpath(file_path, path))
+                    digest.update(_hashFile(file_path))
+    return digest.hexdigest()
+
+
+def _entryDirectory(key):
+    """
+    Works out the directory a cache entry is kept in.
+
+    Args:
+    key: The cache key.
+    Returns:
+    A string with the path to the entry directory.
+    """
+    return os.path.join(settings['directory'], key[:2], key)
+
+
+def _copy(source, destination):
+    """
+    Copies a file or directory tree, giving the copies a fresh mtime.
+
+    Args:
+    source: The file or directory to copy.
+    destination: The path to copy it to.
+    Returns:
+    The number of bytes copied.
+    """
+    if os.path.isfile(source):
+        destination_directory = os.path.dirname(destination)
+        if destination_directory and \
+                not os.path.exists(destination_directory):
+            os.makedirs(destination_directory)
+        shutil.copyfile(source, destination)
+        return os.path.getsize(destination)
+    size = 0
+    for root, dirnames, filenames in os.walk(source):
+        for filename in filenames:
+            file_path = os.path.join(root, filename)
+            size += _copy(file_path,
+                          os.path.join(destination,
+                                       os.path.relpath(file_path, source)))
+    return size
+
+
+def _restore(key, outputs):
+    """
+    Restores outputs from a cache entry.
+
+    Args:
+    key: The cache key.
+    outputs: A list of the output paths to restore.
+    Returns:
+    True if the entry existed and was restored.
+    """
+    entry_directory = _entryDirectory(key)
+    if not os.path.isdir(entry_directory):
+        return False
+    for index in range(len(outputs)):
+        if not os.path.exists(os.path.join(entry_directory, str(index))):
+            return False
+    for index, output in enumerate(outputs):
+        size = _copy(os.path.join(entry_directory, str(index)), output)
+        with _statistics_lock:
+            statistics['restored_bytes'] += size
+    # The entry mtime records when it was last used for eviction
+    os.utime(entry_directory, None)
+    return True
+
+
+def _store(key, outputs):
+    """
+    Stores outputs in a cache entry and evicts old entries if the cache has
+    grown too large.
+
+    Args:
+    key: The cache key.
+    outputs: A list of the output paths to store.
+    """
+    entry_directory = _entryDirectory(key)
+    if os.path.isdir(entry_directory):
+        return
+    parent_directory = os.path.dirname(entry_directory)
+    if not os.path.exists(parent_directory):
+        os.makedirs(parent_directory)
+    temporary_directory = tempfile.mkdtemp(dir=parent_directory,
+                                           prefix='.tmp')
+    for index, output in enumerate(outputs):
+        size = _copy(output, os.path.join(temporary_directory, str(index)))
+        with _statistics_lock:
+            statistics['stored_bytes'] += size
+    try:
+        os.rename(temporary_directory, entry_directory)
+    except OSError:
+        # Another build stored the same entry first
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+        return
+    _evict()
+
+
+def _entries():
+    """
+    Lists the entries in the cache.
+
+    Returns:
+    A list of tuples of the last use time, size and directory of each entry.
+    """
+    entries = []
+    if not os.path.isdir(settings['directory']):
+        return entries
+    for prefix in os.listdir(settings['directory']):
+        prefix_directory = os.path.join(settings['directory'], prefix)
+        if not os.path.isdir(prefix_directory):
+            continue
+        for key in os.listdir(prefix_directory):
+            if key.startswith('.'):
+                continue
+            entry_directory = os.path.join(prefix_directory, key)
+            size = 0
+            for root, dirnames, filenames in os.walk(entry_directory):
+                for filename in filenames:
+                    size += os.path.getsize(os.path.join(root, filename))
+            entries.append((os.path.getmtime(entry_directory),
+                            size,
+                            entry_directory))
+    return entries
+
+
+def _evict():
+    """
+    Removes the least recently used entries until the cache fits its size
+    limit.
+    """
+    entries = sorted(_entries())
+    total_size = sum(entry[1] for entry in entries)
+    for mtime, size, entry_directory in entries:
+        if total_size <= settings['max_size']:
+            break
+        shutil.rmtree(entry_directory, ignore_errors=True)
+        total_size -= size
+        with _statistics_lock:
+            statistics['evicted'] += 1
+
+
+def run(commands, inputs, outputs, action):
+    """
+    Restores the outputs of tool invocations from the cache, or runs them
+    and stores their outputs.
+
+    Args:
+    commands: A list of the commands that produce the outputs, used to work
+    out the cache key.
+    inputs: A list of the files and directories the commands read.
+    outputs: A list of the files and directories the commands write.
+    action: A function running the commands and returning the result code.
+    Returns:
+    The result code of the action, 0 on a cache hit.
+    """
+    if not isEnabled():
+        return action()
+    start = tracing.now()
+    key = _key(commands, inputs, outputs)
+    if _restore(key, outputs):
+        with _statistics_lock:
+            statistics['hits'] += 1
+        tracing.record(os.path.basename(commands[0][0]) + ' (cached)',
+                       'cache',
+                       start,
+                       tracing.now() - start)
+        return 0
+    with _statistics_lock:
+        statistics['misses'] += 1
+    result = action()
+    if result == 0:
+        _store(key, outputs)
+    return result
+
+
+def call(command, inputs, outputs, cwd=None):
+    """
+    Runs a build tool through the cache.
+
+    Args:
+    command: A list containing the program and its arguments.
+    inputs: A list of the files and directories the program reads.
+    outputs: A list of the files and directories the program writes.
+    cwd: The working directory to run the program in.
+    Returns:
+    The return code of the program, 0 on a cache hit.
+    """
+    return run([command], inputs, outputs,
+               lambda: process.call(command, cwd=cwd))
+
+
+def printStatistics():
+    """
+    Prints a summary of the cache use during the build and its size.
+    """
+    if not isEnabled():
+        print 'Build cache is disabled'
+        return
+    entries = _entries()
+    print 'Cache directory: ' + settings['directory']
+    print 'Cache hits: ' + str(statistics['hits'])
+    print 'Cache misses: ' + str(statistics['misses'])
+    print 'Cache bytes restored: ' + str(statistics['restored_bytes'])
+    print 'Cache bytes stored: ' + str(statistics['stored_bytes'])
+    print 'Cache entries evicted: ' + str(statistics['evicted'])
+    print 'Cache size: ' + str(sum(entry[1] for entry in entries)) + \
+        ' bytes in ' + str(len(entries)) + ' entries (limit ' + \
+        str(settings['max_size']) + ' bytes)'
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import multiprocessing
+import zipfile
+from multiprocessing.pool import ThreadPool
+
+from androidbuildsystem import files
+from androidbuildsystem import process
+from androidbuildsystem import tracing
+
+
+installs_file = 'installs.json'
+installs_version = 2
+# Larger changes are installed in full, as fast deploy would transfer most
+# of the APK anyway
+delta_changed_fraction = 0.5
+
+
+def connectedSerials(adb_program):
+    """
+    Lists the serials of the devices and emulators connected to adb.
+
+    Args:
+    adb_program: The path to the adb program.
+    Returns:
+    A list of the serials of the devices that are online, or None if adb
+    failed.
+    """
+    result, output = process.run([adb_program, 'devices'])
+    if result != 0:
+        return None
+    serials = []
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[1] == 'device':
+            serials.append(fields[0])
+    return serials
+
+
+def emulatorSerials(adb_program, serials):
+    """
+    Works out which virtual device each running emulator is.
+
+    Args:
+    adb_program: The path to the adb program.
+    serials: A list of connected serials.
+    Returns:
+    A dictionary of emulator serials keyed by virtual device name.
+    """
+    emulators = {}
+    for serial in serials:
+        if not serial.startswith('emulator-'):
+            continue
+        result, output = process.run([adb_program,
+                                      '-s', serial,
+                                      'emu', 'avd', 'name'])
+        lines = output.splitlines()
+        if result == 0 and len(lines) > 0:
+            emulators[lines[0].strip()] = serial
+    return emulators
+
+
+def _entryCrcs(apk_file):
+    """
+    Reads the CRC and size of every entry of an APK except its signature
+    files.
+
+    Args:
+    apk_file: The APK file.
+    Returns:
+    A dictionary of lists of the CRC and uncompressed size keyed by entry
+    name.
+    """
+    with zipfile.ZipFile(apk_file) as apk:
+        return dict((info.filename, [info.CRC, info.file_size])
+                    for info in apk.infolist()
+                    if not info.filename.startswith('META-INF/'))
+
+
+def _changedFraction(entries, previous_entries):
+    """
+    Works out how much of an APK changed since an earlier build of it.
+
+    Args:
+    entries: The entries of the APK returned by _entryCrcs.
+    previous_entries: The entries of the earlier build.
+    Returns:
+    The fraction of the uncompressed bytes of the APK in entries that are
+    new or changed.
+    """
+    total = sum(size for crc, size in entries.values())
+    if total == 0:
+        return 1.0
+    changed = sum(size for name, (crc, size) in entries.items()
+                  if previous_entries.get(name, [None])[0] != crc)
+    return float(changed) / total
+
+
+def _deviceIdentity(adb_program, target):
+    """
+    Identifies the device behind a serial, since emulator serials are
+    reused by different virtual devices.
+
+    Args:
+    adb_program: The path to the adb program.
+    target: The target to identify.
+    Returns:
+    A string with the serial, the serial number the device reports and the
+    virtual device name of emulators, or None if the device cannot be
+    identified.
+    """
+    serial = target.get('serial')
+    if serial is None:
+        return None
+    result, output = process.run([adb_program] + target['selector'] +
+                                 ['shell', 'getprop', 'ro.serialno'])
+    if result != 0:
+        return None
+    identity = [serial, output.strip()]
+    if serial.startswith('emulator-'):
+        result, output = process.run([adb_program] + target['selector'] +
+                                     ['emu', 'avd', 'name'])
+        lines = output.splitlines()
+        if result != 0 or len(lines) == 0:
+            return None
+        identity.append(lines[0].strip())
+    return '/'.join(identity)
+
+
+def _installedPath(adb_program, target, package):
+    """
+    Asks a device where the APK of a package is installed.
+
+    Args:
+    adb_program: The path to the adb program.
+    target: The target to ask.
+    package: The package name of the app.
+    Returns:
+    A string with the path of the installed APK, or None if the package is
+    not installed.
+    """
+    result, output = process.run([adb_program] + target['selector'] +
+                                 ['shell', 'pm', 'path', package])
+    paths = [line.strip() for line in output.splitlines()
+             if line.startswith('package:')]
+    if result != 0 or len(paths) == 0:
+        return None
+    return '\n'.join(paths)
+
+
+def _installOne(job):
+    """
+    Installs an APK onto one device on a worker thread.
+
+    The device is skipped if the APK recorded for it is the same and the
+    device still has it installed at the same path. A delta install uses
+    adb fast deploy, which only transfers the parts of the APK that differ
+    from the installed one, falling back to a full install if the device
+    or adb does not support it.
+
+    Args:
+    job: A tuple of the adb program, the target, the APK file, the package
+    name, the SHA-256 and entries of the APK, the recorded installs,
+    whether to force the install, whether to allow a delta and the build
+    step.
+    Returns:
+    A tuple of the target, the return code, the captured output, the kind
+    of install (installed, delta or skipped), the identity of the device
+    and the path of the installed APK on it.
+    """
+    adb_program, target, apk_file, package, apk_hash, entries, installs, \
+        force, delta, step = job
+    identity = None
+    path = None
+    try:
+        with tracing.inStep(step):
+            identity = _deviceIdentity(adb_program, target)
+            previous = None
+            if identity is not None:
+                previous = installs.get(identity, {}).get(apk_file)
+                if previous is not None:
+                    path = _installedPath(adb_program, target, package)
+                    if path is None or path != previous['path']:
+                        # Uninstalled or replaced since it was recorded
+                        previous = None
+            if previous is not None and previous['sha256'] == apk_hash and \
+                    not force:
+                return target, 0, '', 'skipped', identity, path
+            command = [adb_program] + target['selector'] + ['install', '-r']
+            kind = 'installed'
+            if delta and previous is not None and \
+                    _changedFraction(entries, previous['entries']) <= \
+                    delta_changed_fraction:
+                result, output = process.run(command +
+                                             ['--fastdeploy', apk_file])
+                if result == 0 and 'Failure' not in output:
+                    kind = 'delta'
+            if kind != 'delta':
+                result, output = process.run(command + [apk_file])
+            # adb reports some install failures with a zero exit code
+            if result == 0 and 'Failure' in output:
+                result = 1
+            if result == 0 and identity is not None:
+                path = _installedPath(adb_program, target, package)
+    except Exception as e:
+        result, output, kind = 1, str(e) + '\n', 'installed'
+    return target, result, output, kind, identity, path
+
+
+def install(adb_program, targets, apk_file, package, jobs=None, force=False,
+            delta=True):
+    """
+    Installs an APK onto several devices at the same time.
+
+    The SHA-256 of the APK last installed onto each device, and where the
+    device installed it, are recorded in the user directory, and devices
+    that still have the same APK are skipped.
+
+    Args:
+    adb_program: The path to the adb program.
+    targets: A list of dictionaries with the name of each target, the adb
+    arguments selecting it, such as -s and its serial, and the serial if it
+    is known.
+    apk_file: The APK file to install.
+    package: The package name of the app.
+    jobs: The number of devices to install onto at once, None for one per
+    CPU.
+    force: Whether to install onto devices that already have the APK.
+    delta: Whether to only transfer the changed parts of the APK to devices
+    that have an earlier build of it, when at most delta_changed_fraction
+    of it changed.
+    Returns:
+    A list of tuples of each target, its return code, the adb output and
+    the kind of install (installed, delta or skipped), in the order the
+    installs finished.
+    """
+    if len(targets) == 0:
+        return []
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    installs_path = files.userDirectory(installs_file)
+    installs = files.loadJson(installs_path, {})
+    if installs.get('version') != installs_version:
+        installs = {'version': installs_version, 'devices': {}}
+    apk_hash = files.hashFile(apk_file, hashlib.sha256)
+    entries = _entryCrcs(apk_file)
+    step = tracing.currentStep()
+    install_jobs = [(adb_program, target, apk_file, package, apk_hash,
+                     entries, installs['devices'], force, delta, step)
+                    for target in targets]
+    results = []
+    updates = []
+    pool = ThreadPool(max(min(int(jobs), len(install_jobs)), 1))
+    try:
+        for target, result, output, kind, identity, path in \
+                pool.imap_unordered(_installOne, install_jobs):
+            for line in output.splitlines():
+                print '[' + target['name'] + '] ' + line
+            results.append((target, result, output, kind))
+            if result == 0 and kind != 'skipped' and identity is not None \
+                    and path is not None:
+                updates.append((identity, {'sha256': apk_hash,
+                                           'path': path,
+                                           'entries': entries}))
+    finally:
+        pool.close()
+        pool.join()
+    if len(updates) > 0:
+        def update(installs):
+            # Other builds may have installed onto devices since it was read
+            if installs.get('version') != installs_version:
+                installs = {'version': installs_version, 'devices': {}}
+            for identity, record in updates:
+                installs['devices'].setdefault(identity, {})[apk_file] = \
+                    record
+            return installs
+        files.updateJson(installs_path, update, {})
+    return results
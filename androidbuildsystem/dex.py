@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import zipfile
+from multiprocessing.pool import ThreadPool
+
+from androidbuildsystem import files
+from androidbuildsystem import process
+from androidbuildsystem import remote
+from androidbuildsystem import tracing
+
+
+index_file = 'shards.json'
+index_version = 1
+
+
+def _hashClasses(obj_directory, previous_classes):
+    """
+    Hashes the class files in the classes directory, reusing the hashes of
+    files that have not been modified.
+
+    Args:
+    obj_directory: The directory containing the class files.
+    previous_classes: The class hashes recorded by the last build.
+    Returns:
+    A dictionary of the size, mtime and hash of each class file keyed by its
+    path relative to the classes directory.
+    """
+    classes = {}
+    for root, dirnames, filenames in os.walk(obj_directory):
+        for filename in filenames:
+            if os.path.splitext(filename)[1] != '.class':
+                continue
+            class_file = os.path.join(root, filename)
+            relative_path = os.path.relpath(class_file, obj_directory)
+            class_stat = os.stat(class_file)
+            previous = previous_classes.get(relative_path)
+            if previous is not None and \
+                    previous[0] == class_stat.st_size and \
+                    previous[1] == class_stat.st_mtime:
+                classes[relative_path] = previous
+            else:
+                classes[relative_path] = [class_stat.st_size,
+                                          class_stat.st_mtime,
+                                          files.hashFile(class_file)]
+    return classes
+
+
+def _shards(obj_directory, classes, configuration, library_jars=()):
+    """
+    Splits the classes into one shard per java package and one per jar.
+
+    Args:
+    obj_directory: The directory containing the class files.
+    classes: The dictionary returned by _hashClasses.
+    configuration: The dex configuration returned by dexConfiguration,
+    which is part of the hash of every shard.
+    library_jars: A list of jars to dex, such as the classes of the
+    workspace modules the project depends on.
+    Returns:
+    A dictionary of shards keyed by name, each with the hash identifying
+    its contents and the dex configuration and the class files or jar in
+    it.
+    """
+    packages = {}
+    for relative_path in sorted(classes):
+        package = os.path.dirname(relative_path) or '(default)'
+        packages.setdefault(package, []).append(relative_path)
+    shards = {}
+    for package, relative_paths in packages.items():
+        digest = hashlib.sha1(configuration + '\0')
+        for relative_path in relative_paths:
+            digest.update(relative_path + '\0' + classes[relative_path][2])
+        shards['package:' + package] = {
+            'key': digest.hexdigest(),
+            'classes': relative_paths,
+            'jar': None}
+    for jar_file in library_jars:
+        shards['jar:' + jar_file] = {
+            'key': hashlib.sha1(configuration + '\0' +
+                                files.hashFile(jar_file)).hexdigest(),
+            'classes': [],
+            'jar': jar_file}
+    return shards
+
+
+def dexProgram(build_tools_folder):
+    """
+    Works out which program converts class files into dex files.
+
+    Args:
+    build_tools_folder: The build tools folder.
+    Returns:
+    The path to d8 when the build tools have it, and to dx otherwise.
+    """
+    dex_program = os.path.join(build_tools_folder, 'd8')
+    if not os.path.isfile(dex_program):
+        dex_program = os.path.join(build_tools_folder, 'dx')
+    return dex_program
+
+
+def dexOptions(dex_program):
+    """
+    Works out the options the dex program converts jars with.
+
+    Args:
+    dex_program: The path to the d8 or dx program.
+    Returns:
+    A list of the options given before the output and the jar.
+    """
+    if os.path.basename(dex_program) == 'd8':
+        return ['--intermediate']
+    return ['--dex']
+
+
+def dexConfiguration(dex_program):
+    """
+    Describes what a dex file depends on besides the classes converted.
+
+    Args:
+    dex_program: The path to the d8 or dx program.
+    Returns:
+    A string made of the build tools version, the dex program and its
+    options, such as 23.0.1-dx --dex.
+    """
+    return ' '.join([os.path.basename(os.path.dirname(dex_program)) + '-' +
+                     os.path.basename(dex_program)] +
+                    dexOptions(dex_program))
+
+
+def dexJar(dex_program, jar_file, dex_file):
+    """
+    Converts the classes of a jar into a dex file.
+
+    The dex file is written to a temporary directory next to it and then
+    renamed, so it never exists half written.
+
+    Args:
+    dex_program: The path to the d8 or dx program.
+    jar_file: The jar to convert.
+    dex_file: The dex file to write.
+    Returns:
+    A tuple of the return code and the captured output.
+    """
+    temporary_directory = tempfile.mkdtemp(dir=os.path.dirname(dex_file))
+    try:
+        if os.path.basename(dex_program) == 'd8':
+            result, output = remote.run([dex_program] +
+                                        dexOptions(dex_program) +
+                                        ['--output', temporary_directory,
+                                         jar_file],
+                                        [jar_file],
+                                        [temporary_directory])
+            built_file = os.path.join(temporary_directory, 'classes.dex')
+        else:
+            built_file = os.path.join(temporary_directory, 'shard.dex')
+            result, output = remote.run([dex_program] +
+                                        dexOptions(dex_program) +
+                                        ['--output=' + built_file,
+                                         jar_file],
+                                        [jar_file],
+                                        [built_file])
+        if result == 0:
+            os.rename(built_file, dex_file)
+    finally:
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+    return result, output
+
+
+def _dexShard(job):
+    """
+    Converts the classes of a shard into a dex file on a worker thread.
+
+    Args:
+    job: A tuple of the shard name, the shard, the dex program, the classes
+    directory, the dex file to write and the build step.
+    Returns:
+    A tuple of the shard name, the return code and the captured output.
+    """
+    name, shard, dex_program, obj_directory, dex_file, step = job
+    temporary_directory = tempfile.mkdtemp(dir=os.path.dirname(dex_file))
+    try:
+        jar_file = shard['jar']
+        if jar_file is None:
+            jar_file = os.path.join(temporary_directory, 'classes.jar')
+            with zipfile.ZipFile(jar_file, 'w', zipfile.ZIP_STORED) as jar:
+                for relative_path in shard['classes']:
+                    jar.write(os.path.join(obj_directory, relative_path),
+                              relative_path.replace(os.sep, '/'))
+        with tracing.inStep(step):
+            result, output = dexJar(dex_program, jar_file, dex_file)
+    except Exception as e:
+        result, output = 1, str(e) + '\n'
+    finally:
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+    return name, result, output
+
+
+def merge(build_tools_folder, java_program, dex_files, classes_dex_file):
+    """
+    Merges shard dex files into the final dex file.
+
+    Args:
+    build_tools_folder: The build tools folder.
+    java_program: The path to the java program, used to run the dx merger
+    when d8 is not available.
+    dex_files: A list of the shard dex files.
+    classes_dex_file: The path to write the merged dex file to.
+    Returns:
+    The return code of the merge.
+    """
+    if len(dex_files) == 1:
+        shutil.copyfile(dex_files[0], classes_dex_file)
+        return 0
+    d8_program = os.path.join(build_tools_folder, 'd8')
+    if os.path.isfile(d8_program):
+        output_directory = tempfile.mkdtemp(
+            dir=os.path.dirname(classes_dex_file))
+        try:
+            result = process.call([d8_program,
+                                   '--output', output_directory] + dex_files)
+            if result == 0:
+                shutil.move(os.path.join(output_directory, 'classes.dex'),
+                            classes_dex_file)
+        finally:
+            shutil.rmtree(output_directory, ignore_errors=True)
+        return result
+    dx_jar_file = os.path.join(build_tools_folder, 'lib', 'dx.jar')
+    return process.call([java_program,
+                         '-cp', dx_jar_file,
+                         'com.android.dx.merge.DexMerger',
+                         classes_dex_file] + dex_files)
+
+
+def dexIncremental(build_tools_folder, java_program, obj_directory,
+                   dex_directory, classes_dex_file, library_jars=(),
+                   library_dex_files=()):
+    """
+    Creates the dex file from shards, only re-dexing the shards whose
+    classes have changed since the last build.
+
+    Classes are sharded by java package and every jar given is its own
+    shard. Shard dex files are kept in the dex directory named by the hash
+    of their contents and of the build tools, dex program and options
+    converting them, and are converted on a pool of worker threads, then
+    merged with the dex files of the pre-dexed libraries.
+
+    Args:
+    build_tools_folder: The build tools folder.
+    java_program: The path to the java program.
+    obj_directory: The directory containing the class files.
+    dex_directory: The directory to keep the shard dex files in.
+    classes_dex_file: The path to write the merged dex file to.
+    library_jars: A list of jars to dex, each its own shard.
+    library_dex_files: A list of dex files of pre-dexed libraries to merge.
+    Returns:
+    The return code of the first failing tool, or 0.
+    """
+    if not os.path.exists(dex_directory):
+        os.makedirs(dex_directory)
+    index = files.loadJson(os.path.join(dex_directory, index_file), {})
+    if index.get('version') != index_version:
+        index = {'version': index_version, 'classes': {}}
+    classes = _hashClasses(obj_directory, index['classes'])
+    dex_program = dexProgram(build_tools_folder)
+    shards = _shards(obj_directory, classes, dexConfiguration(dex_program),
+                     library_jars)
+    jobs = []
+    dex_files = []
+    step = tracing.currentStep()
+    for name in sorted(shards):
+        dex_file = os.path.join(dex_directory, shards[name]['key'] + '.dex')
+        dex_files.append(dex_file)
+        if not os.path.exists(dex_file):
+            jobs.append((name, shards[name], dex_program, obj_directory,
+                         dex_file, step))
+    print 'Dexing ' + str(len(jobs)) + ' of ' + str(len(shards)) + \
+        ' shards...'
+    result = 0
+    if len(jobs) > 0:
+        pool = ThreadPool(min(multiprocessing.cpu_count(), len(jobs)))
+        try:
+            for name, shard_result, output in pool.imap_unordered(_dexShard,
+                                                                  jobs):
+                if output:
+                    for line in output.splitlines():
+                        print '[' + name + '] ' + line
+                if shard_result != 0:
+                    print 'Failed to dex shard ' + name
+                    result = shard_result
+        finally:
+            pool.close()
+            pool.join()
+    if result != 0:
+        return result
+    # Remove the dex files of shards that no longer exist
+    for filename in os.listdir(dex_directory):
+        dex_file = os.path.join(dex_directory, filename)
+        if os.path.splitext(filename)[1] == '.dex' and \
+                dex_file not in dex_files:
+            os.remove(dex_file)
+    files.saveJson(os.path.join(dex_directory, index_file),
+                   {'version': index_version, 'classes': classes})
+    dex_files.extend(library_dex_files)
+    if len(dex_files) == 0:
+        return 0
+    return merge(build_tools_folder, java_program, dex_files,
+                 classes_dex_file)
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+from androidbuildsystem import files
+from androidbuildsystem import process
+from androidbuildsystem import tracing
+
+
+drawables_directory = 'drawables'
+index_file = 'index.json'
+index_version = 1
+statistics = {'images': 0,
+              'crunched': 0,
+              'cached': 0,
+              'saved_bytes': 0}
+_statistics_lock = threading.Lock()
+
+
+def _isDrawable(relative_path):
+    """
+    Checks whether a resource is a PNG that aapt would crunch.
+
+    Args:
+    relative_path: The path of the resource relative to the resources
+    directory.
+    Returns:
+    True if the resource is a PNG in a drawable directory.
+    """
+    resource_type = relative_path.split(os.sep)[0]
+    return resource_type.startswith('drawable') and \
+        relative_path.lower().endswith('.png')
+
+
+def _listResources(res_directory):
+    """
+    Lists the resource files aapt packages.
+
+    Args:
+    res_directory: The resources directory.
+    Returns:
+    A sorted list of the paths of the resources relative to the resources
+    directory.
+    """
+    resources = []
+    for root, dirnames, filenames in os.walk(res_directory):
+        # aapt ignores hidden files and directories
+        dirnames[:] = [dirname for dirname in dirnames
+                       if not dirname.startswith('.')]
+        for filename in filenames:
+            if not filename.startswith('.'):
+                resources.append(os.path.relpath(os.path.join(root,
+                                                              filename),
+                                                 res_directory))
+    return sorted(resources)
+
+
+def _hashImages(res_directory, images, previous_images):
+    """
+    Hashes the drawable images, reusing the hashes of images that have not
+    been modified.
+
+    Args:
+    res_directory: The resources directory.
+    images: A list of the paths of the images relative to the resources
+    directory.
+    previous_images: The image hashes recorded by the last build.
+    Returns:
+    A dictionary of the size, mtime and hash of each image keyed by its
+    path relative to the resources directory.
+    """
+    hashes = {}
+    for relative_path in images:
+        image_file = os.path.join(res_directory, relative_path)
+        image_stat = os.stat(image_file)
+        previous = previous_images.get(relative_path)
+        if previous is not None and previous[0] == image_stat.st_size and \
+                previous[1] == image_stat.st_mtime:
+            hashes[relative_path] = previous
+        else:
+            hashes[relative_path] = [image_stat.st_size,
+                                     image_stat.st_mtime,
+                                     files.hashFile(image_file)]
+    return hashes
+
+
+def _crunchImage(job):
+    """
+    Crunches one image with aapt on a worker thread.
+
+    The crunched image is kept in the cache, unless it is a plain image
+    larger than the source image, in which case the source image is kept
+    instead. Nine-patch images are always kept crunched, as crunching
+    removes their border and records it in the image.
+
+    Args:
+    job: A tuple of the path of the image relative to the resources
+    directory, the aapt program, the image file, the cached file to write
+    and the build step.
+    Returns:
+    A tuple of the image path, the return code and the captured output.
+    """
+    relative_path, aapt_program, image_file, cached_file, step = job
+    temporary_fd, temporary_file = tempfile.mkstemp(
+        dir=os.path.dirname(cached_file), suffix=os.path.basename(cached_file))
+    os.close(temporary_fd)
+    try:
+        with tracing.inStep(step):
+            result, output = process.run([aapt_program,
+                                          'singleCrunch',
+                                          '-i', image_file,
+                                          '-o', temporary_file])
+        if result == 0:
+            if not image_file.lower().endswith('.9.png') and \
+                    os.path.getsize(temporary_file) > \
+                    os.path.getsize(image_file):
+                shutil.copyfile(image_file, temporary_file)
+            # Another build crunching the same image writes the same file
+            os.rename(temporary_file, cached_file)
+    except Exception as e:
+        result, output = 1, str(e) + '\n'
+    finally:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+    return relative_path, result, output
+
+
+def _linkFile(source_file, destination_file):
+    """
+    Makes a file in the merged resources directory refer to a source or
+    cached file, leaving it alone if it already does.
+
+    Args:
+    source_file: The file to link to.
+    destination_file: The file in the merged resources directory.
+    """
+    source_stat = os.stat(source_file)
+    if os.path.isfile(destination_file):
+        destination_stat = os.stat(destination_file)
+        if os.path.samestat(source_stat, destination_stat) or \
+                (destination_stat.st_size == source_stat.st_size and
+                 destination_stat.st_mtime == source_stat.st_mtime):
+            return
+        os.remove(destination_file)
+    destination_directory = os.path.dirname(destination_file)
+    if not os.path.exists(destination_directory):
+        os.makedirs(destination_directory)
+    try:
+        os.link(source_file, destination_file)
+    except OSError:
+        # The cache is on another file system
+        shutil.copy2(source_file, destination_file)
+
+
+def crunch(build_tools_folder, res_directory, crunched_directory):
+    """
+    Crunches the PNG images of the drawables once, and merges them with the
+    other resources into a directory aapt can package without crunching.
+
+    The crunched images are kept in the user directory named by the hash of
+    the source image and the build tools used, so each image is only
+    crunched once for every build of every project, and images that have
+    not been crunched yet are crunched on a pool of worker threads. The
+    merged resources directory links to the crunched and source files
+    rather than copying them.
+
+    Args:
+    build_tools_folder: The build tools folder.
+    res_directory: The resources directory.
+    crunched_directory: The directory to keep the merged resources in.
+    Returns:
+    A tuple of the return code of the first failing crunch, or 0, and the
+    path to the merged resources directory.
+    """
+    aapt_program = os.path.join(build_tools_folder, 'aapt')
+    cache_directory = files.userDirectory(
+        drawables_directory,
+        os.path.basename(os.path.normpath(build_tools_folder)))
+    if not os.path.exists(cache_directory):
+        try:
+            os.makedirs(cache_directory)
+        except OSError:
+            # Another build created it first
+            if not os.path.isdir(cache_directory):
+                raise
+    merged_directory = os.path.join(crunched_directory, 'res')
+    index = files.loadJson(os.path.join(crunched_directory, index_file), {})
+    if index.get('version') != index_version:
+        index = {'version': index_version, 'images': {}}
+    resources = _listResources(res_directory)
+    images = _hashImages(res_directory,
+                         [relative_path for relative_path in resources
+                          if _isDrawable(relative_path)],
+                         index['images'])
+    step = tracing.currentStep()
+    jobs = []
+    sources = {}
+    for relative_path in resources:
+        source_file = os.path.join(res_directory, relative_path)
+        if relative_path not in images:
+            sources[relative_path] = source_file
+            continue
+        # Nine-patch images are crunched differently to plain images
+        extension = '.9.png' if relative_path.lower().endswith('.9.png') \
+            else '.png'
+        cached_file = os.path.join(cache_directory,
+                                   images[relative_path][2] + extension)
+        sources[relative_path] = cached_file
+        if not os.path.exists(cached_file) and \
+                cached_file not in [job[3] for job in jobs]:
+            jobs.append((relative_path, aapt_program, source_file,
+                         cached_file, step))
+    with _statistics_lock:
+        statistics['images'] += len(images)
+        # Copies of an image are served by crunching it once
+        statistics['cached'] += len(images) - len(jobs)
+    print 'Crunching ' + str(len(jobs)) + ' of ' + str(len(images)) + \
+        ' drawables...'
+    result = 0
+    if len(jobs) > 0:
+        pool = ThreadPool(min(multiprocessing.cpu_count(), len(jobs)))
+        try:
+            for relative_path, image_result, output in \
+                    pool.imap_unordered(_crunchImage, jobs):
+                for line in output.splitlines():
+                    print '[' + relative_path + '] ' + line
+                if image_result != 0:
+                    print 'Failed to crunch drawable ' + relative_path
+                    result = image_result
+                else:
+                    with _statistics_lock:
+                        statistics['crunched'] += 1
+        finally:
+            pool.close()
+            pool.join()
+    if result != 0:
+        return result, merged_directory
+    saved_bytes = 0
+    for relative_path in images:
+        saved_bytes += images[relative_path][0] - \
+            os.path.getsize(sources[relative_path])
+    with _statistics_lock:
+        statistics['saved_bytes'] += saved_bytes
+    for relative_path in resources:
+        _linkFile(sources[relative_path],
+                  os.path.join(merged_directory, relative_path))
+    # Remove the resources that were deleted since the last build
+    for root, dirnames, filenames in os.walk(merged_directory,
+                                             topdown=False):
+        for filename in filenames:
+            merged_file = os.path.join(root, filename)
+            if os.path.relpath(merged_file, merged_directory) not in sources:
+                os.remove(merged_file)
+        if root != merged_directory and len(os.listdir(root)) == 0:
+            os.rmdir(root)
+    files.saveJson(os.path.join(crunched_directory, index_file),
+                   {'version': index_version, 'images': images})
+    return result, merged_directory
+
+
+def printStatistics():
+    """
+    Prints a summary of the drawables crunched and served from the cache.
+    """
+    print 'Drawables crunched: ' + str(statistics['crunched'])
+    print 'Drawables from the cache: ' + str(statistics['cached'])
+    print 'Drawable bytes saved: ' + str(statistics['saved_bytes'])
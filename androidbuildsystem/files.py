@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where shared files are updated without a lock
+    fcntl = None
+
+
+hash_chunk_size = 1024 * 1024
+
+
+def hashFile(path, algorithm=hashlib.sha1):
+    """
+    Hashes the contents of a file.
+
+    Args:
+    path: The path to the file.
+    algorithm: The hashlib constructor of the digest to use.
+    Returns:
+    A string with the hex digest of the file contents, SHA-1 by default.
+    """
+    digest = algorithm()
+    with open(path, 'rb') as f:
+        chunk = f.read(hash_chunk_size)
+        while chunk:
+            digest.update(chunk)
+            chunk = f.read(hash_chunk_size)
+    return digest.hexdigest()
+
+
+def loadJson(path, default=None):
+    """
+    Loads a JSON file, falling back to a default if it is missing or corrupt.
+
+    Args:
+    path: The path to the JSON file.
+    default: The value to return if the file cannot be loaded.
+    Returns:
+    The decoded JSON value.
+    """
+    if not os.path.isfile(path):
+        return default
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        return default
+
+
+def saveJson(path, value):
+    """
+    Atomically writes a value to a JSON file.
+
+    Args:
+    path: The path to the JSON file.
+    value: The value to encode.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    temporary_fd, temporary_path = tempfile.mkstemp(dir=directory or '.',
+                                                    suffix='.tmp')
+    with os.fdopen(temporary_fd, 'w') as f:
+        json.dump(value, f, indent=1, sort_keys=True)
+    os.rename(temporary_path, path)
+
+
+def updateJson(path, update, default=None):
+    """
+    Reads, changes and writes a JSON file shared by several processes.
+
+    An exclusive lock on a lock file next to the JSON file is held from
+    reading it until the change is written, so builds updating it at the
+    same time, such as variants built in parallel, keep each other's
+    changes.
+
+    Args:
+    path: The path to the JSON file.
+    update: A function given the loaded value, or the default if the file
+    is missing or corrupt, returning the value to write.
+    default: The value to give update if the file cannot be loaded.
+    Returns:
+    The value written.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another build created it first
+            if not os.path.isdir(directory):
+                raise
+    lock_fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        value = update(loadJson(path, default))
+        saveJson(path, value)
+    finally:
+        # Closing the lock file releases the lock
+        os.close(lock_fd)
+    return value
+
+
+def userDirectory(*paths):
+    """
+    Works out a path in the per-user android build system directory.
+
+    The directory defaults to ~/.androidbuildsystem and can be moved with the
+    ANDROIDBUILDSYSTEM_HOME environment variable.
+
+    Args:
+    paths: Path components to join to the user directory.
+    Returns:
+    A string with the absolute path.
+    """
+    user_directory = os.environ.get('ANDROIDBUILDSYSTEM_HOME',
+                                    os.path.join(os.path.expanduser('~'),
+                                                 '.androidbuildsystem'))
+    return os.path.join(user_directory, *paths)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import Queue
+import sys
+from multiprocessing.pool import ThreadPool
+
+from androidbuildsystem import process
+from androidbuildsystem import tracing
+
+
+settings = {'jobs': multiprocessing.cpu_count()}
+
+
+def configure(jobs):
+    """
+    Sets how many hooks can run at the same time.
+
+    Args:
+    jobs: The number of hooks to run concurrently, None for one per CPU.
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    settings['jobs'] = max(int(jobs), 1)
+
+
+def _parse(hook_specs):
+    """
+    Parses the hooks of a step into scripts with their dependencies.
+
+    A plain string hook, or a hook without parallel set, waits for every
+    hook before it. A parallel hook only waits for the hooks named in its
+    depends_on and the serial hook before it. Only a failure of a hook named
+    in depends_on stops a hook from running.
+
+    Args:
+    hook_specs: A list of hook scripts, or dictionaries with a run script
+    and optionally a name, depends_on, parallel and fail_build.
+    Returns:
+    A list of hook dictionaries with a name, script, the sets of hook names
+    it depends on and runs after, and whether it runs in parallel or fails
+    the build.
+    """
+    hooks = []
+    names = set()
+    last_serial = None
+    for index, hook_spec in enumerate(hook_specs):
+        if not isinstance(hook_spec, dict):
+            hook_spec = {'run': hook_spec}
+        if 'run' not in hook_spec:
+            raise ValueError('Hook ' + str(index + 1) + ' has no run script')
+        name = str(hook_spec.get('name', hook_spec['run']))
+        if name in names:
+            name += ' #' + str(index + 1)
+        depends_on = hook_spec.get('depends_on', [])
+        if not isinstance(depends_on, list):
+            depends_on = [depends_on]
+        depends_on = set(str(dependency) for dependency in depends_on)
+        for dependency in depends_on:
+            if dependency not in names:
+                raise ValueError('Hook ' + name + ' depends on unknown hook ' +
+                                 dependency)
+        parallel = hook_spec.get('parallel', False)
+        after = set(depends_on)
+        if parallel:
+            if last_serial is not None:
+                after.add(last_serial)
+        else:
+            after.update(hook['name'] for hook in hooks)
+            last_serial = name
+        hooks.append({'name': name,
+                      'script': hook_spec['run'],
+                      'depends_on': depends_on,
+                      'after': after,
+                      'parallel': parallel,
+                      'fail_build': hook_spec.get('fail_build', False)})
+        names.add(name)
+    return hooks
+
+
+def _runHook(hook, step):
+    """
+    Runs a hook on a worker thread.
+
+    Args:
+    hook: The hook dictionary returned by _parse.
+    step: The build step the hook belongs to.
+    Returns:
+    A tuple of the hook name, its return code and its captured output
+    (None for serial hooks, which write straight to the console).
+    """
+    try:
+        with tracing.inStep(step):
+            if hook['parallel']:
+                result, output = process.runShell(hook['script'],
+                                                  name=hook['name'])
+            else:
+                result, output = process.callShell(hook['script'],
+                                                   name=hook['name']), None
+    except Exception as e:
+        result, output = 1, str(e) + '\n'
+    return hook['name'], result, output
+
+
+def run(hook_specs):
+    """
+    Runs the hooks of a step on a bounded pool, following their dependencies.
+
+    Hooks whose dependencies failed are skipped.
+
+    Args:
+    hook_specs: The list of hooks from the build configuration.
+    Returns:
+    A list of the names of the failed hooks that fail the build.
+    """
+    hooks = _parse(hook_specs or [])
+    if len(hooks) == 0:
+        return []
+    step = tracing.currentStep()
+    completed = Queue.Queue()
+    pool = ThreadPool(min(settings['jobs'], len(hooks)))
+    results = {}
+    running = set()
+    try:
+        while len(results) < len(hooks):
+            for hook in hooks:
+                if hook['name'] in results or hook['name'] in running:
+                    continue
+                if not hook['after'].issubset(results):
+                    continue
+                if any(results[dependency] != 0
+                       for dependency in hook['depends_on']):
+                    print 'Skipping hook ' + hook['name'] + \
+                        ' because a hook it depends on failed'
+                    results[hook['name']] = None
+                    continue
+                running.add(hook['name'])
+                pool.apply_async(_runHook, (hook, step),
+                                 callback=completed.put)
+            if len(running) == 0:
+                break
+            # A timeout keeps the wait interruptible with Ctrl-C
+            name, result, output = completed.get(True, 86400)
+            running.remove(name)
+            results[name] = result
+            if output:
+                for line in output.splitlines():
+                    print '[' + name + '] ' + line
+            if result != 0:
+                print 'Hook ' + name + ' failed with exit code ' + str(result)
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+    failures = []
+    for hook in hooks:
+        if hook['fail_build'] and results.get(hook['name']) != 0:
+            failures.append(hook['name'])
+    return failures
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import re
+import struct
+
+from androidbuildsystem import files
+
+
+manifest_file = '.manifest.json'
+manifest_version = 2
+access_private = 0x0002
+access_synthetic = 0x1000
+descriptor_pattern = re.compile(r'L([\w/$]+);')
+constant_pool_sizes = {3: 4, 4: 4, 5: 8, 6: 8, 7: 2, 8: 2, 9: 4, 10: 4,
+                       11: 4, 12: 4, 15: 3, 16: 2, 17: 4, 18: 4, 19: 2,
+                       20: 2}
+
+
+def _readMembers(data, offset, utf8s, values):
+    """
+    Reads the fields or methods table of a class file.
+
+    Args:
+    data: The contents of the class file.
+    offset: The offset of the members count.
+    utf8s: A dictionary of the constant pool UTF-8 strings.
+    values: A dictionary of the constant pool values fields can have.
+    Returns:
+    A tuple of the offset after the table and a list of a tuple of the
+    access flags, name, descriptor and constant value (None for members
+    without one) of each member that other classes can use.
+    """
+    members = []
+    count = struct.unpack_from('>H', data, offset)[0]
+    offset += 2
+    for _ in range(count):
+        access, name_index, descriptor_index, attribute_count = \
+            struct.unpack_from('>HHHH', data, offset)
+        offset += 8
+        value = None
+        for _ in range(attribute_count):
+            attribute_index, length = struct.unpack_from('>HI', data, offset)
+            if utf8s.get(attribute_index) == 'ConstantValue':
+                value = values.get(
+                    struct.unpack_from('>H', data, offset + 6)[0])
+            offset += 6 + length
+        if access & (access_private | access_synthetic) == 0:
+            members.append((access, utf8s[name_index],
+                            utf8s[descriptor_index], value))
+    return offset, members
+
+
+def readClass(class_file):
+    """
+    Reads the name, source file, references and signature of a java class
+    file.
+
+    Args:
+    class_file: The path to the class file.
+    Returns:
+    A dictionary containing the internal class name, the source file name
+    (None if it was not recorded), the referenced class names, the hash of
+    the parts of the class other classes can use, and the hash of the
+    compile time constants it declares (None if it declares none).
+    """
+    with open(class_file, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'\xca\xfe\xba\xbe':
+        raise ValueError('Not a class file: ' + class_file)
+    count = struct.unpack_from('>H', data, 8)[0]
+    offset = 10
+    utf8s = {}
+    classes = {}
+    values = {}
+    strings = {}
+    index = 1
+    while index < count:
+        tag = struct.unpack_from('>B', data, offset)[0]
+        if tag == 1:
+            length = struct.unpack_from('>H', data, offset + 1)[0]
+            utf8s[index] = data[offset + 3:offset + 3 + length].decode(
+                'utf-8', 'replace')
+            offset += 3 + length
+        else:
+            if tag == 7:
+                classes[index] = struct.unpack_from('>H', data, offset + 1)[0]
+            elif tag == 8:
+                strings[index] = struct.unpack_from('>H', data,
+                                                    offset + 1)[0]
+            elif tag in (3, 4, 5, 6):
+                values[index] = repr(
+                    data[offset + 1:offset + 1 + constant_pool_sizes[tag]])
+            offset += 1 + constant_pool_sizes[tag]
+        index += 2 if tag in (5, 6) else 1
+    for string_index, utf8_index in strings.items():
+        values[string_index] = utf8s[utf8_index]
+    access, this_index, super_index, interface_count = \
+        struct.unpack_from('>HHHH', data, offset)
+    name = utf8s[classes[this_index]]
+    api = [access, name, utf8s[classes[super_index]] if super_index else None]
+    for interface in range(interface_count):
+        api.append(utf8s[classes[struct.unpack_from(
+            '>H', data, offset + 8 + 2 * interface)[0]]])
+    offset += 8 + 2 * interface_count
+    offset, fields = _readMembers(data, offset, utf8s, values)
+    offset, methods = _readMembers(data, offset, utf8s, values)
+    constants = sorted(field for field in fields if field[3] is not None)
+    api.extend(sorted(field[:3] for field in fields))
+    api.extend(sorted(method[:3] for method in methods))
+    source = None
+    attribute_count = struct.unpack_from('>H', data, offset)[0]
+    offset += 2
+    for _ in range(attribute_count):
+        name_index, length = struct.unpack_from('>HI', data, offset)
+        if utf8s.get(name_index) == 'SourceFile':
+            source_index = struct.unpack_from('>H', data, offset + 6)[0]
+            source = utf8s[source_index]
+        offset += 6 + length
+    references = set()
+    for utf8_index in classes.values():
+        class_name = utf8s[utf8_index]
+        if not class_name.startswith('['):
+            references.add(class_name)
+    for utf8 in utf8s.values():
+        references.update(descriptor_pattern.findall(utf8))
+    references.discard(name)
+    return {'name': name,
+            'source': source,
+            'references': references,
+            'signature': _hash(api),
+            'constants': _hash(constants) if constants else None}
+
+
+def _hash(value):
+    """
+    Hashes a list of strings, numbers and tuples of them.
+    """
+    return hashlib.sha1(json.dumps(value)).hexdigest()
+
+
+def _sourceForClass(class_info):
+    """
+    Works out the source path, relative to the source directory, of a class.
+
+    Args:
+    class_info: The dictionary returned by readClass.
+    Returns:
+    A string with the relative source path.
+    """
+    package = os.path.dirname(class_info['name'])
+    source = class_info['source']
+    if source is None:
+        source = os.path.basename(class_info['name']).split('$')[0] + '.java'
+    return os.path.join(package, source)
+
+
+def loadManifest(obj_directory, configuration):
+    """
+    Loads the incremental compile manifest from the classes directory.
+
+    Args:
+    obj_directory: The directory containing the class files.
+    configuration: A string identifying the compiler configuration, a
+    manifest written with a different configuration is discarded.
+    Returns:
+    A tuple of a dictionary mapping relative source paths to their hash,
+    class files, class names, referenced class names, signature and
+    constants, and a dictionary of the earlier entries of the sources being
+    recompiled whose dependents have not been checked yet.
+    """
+    manifest = files.loadJson(os.path.join(obj_directory, manifest_file))
+    if manifest is None or \
+            manifest.get('version') != manifest_version or \
+            manifest.get('configuration') != configuration:
+        return {}, {}
+    return manifest['sources'], manifest['previous']
+
+
+def saveManifest(obj_directory, configuration, sources, previous):
+    """
+    Saves the incremental compile manifest to the classes directory.
+
+    Args:
+    obj_directory: The directory containing the class files.
+    configuration: A string identifying the compiler configuration.
+    sources: The dictionary of sources returned by loadManifest.
+    previous: The dictionary of earlier entries returned by loadManifest.
+    """
+    files.saveJson(os.path.join(obj_directory, manifest_file),
+                   {'version': manifest_version,
+                    'configuration': configuration,
+                    'sources': sources,
+                    'previous': previous})
+
+
+def _forget(sources, previous, obj_directory, relative_paths):
+    """
+    Removes the class files and manifest entries of sources that are about
+    to be compiled, keeping their entries to compare the new classes with.
+
+    Args:
+    sources: The dictionary of sources returned by loadManifest.
+    previous: The dictionary of earlier entries returned by loadManifest.
+    obj_directory: The directory containing the class files.
+    relative_paths: The relative paths of the sources.
+    """
+    for relative_path in relative_paths:
+        if relative_path not in sources:
+            continue
+        for class_path in sources[relative_path]['classes']:
+            class_file = os.path.join(obj_directory, class_path)
+            if os.path.exists(class_file):
+                os.remove(class_file)
+        # A build that did not finish already kept the older entry
+        previous.setdefault(relative_path, sources.pop(relative_path))
+
+
+def plan(sources, previous, obj_directory, java_sources):
+    """
+    Works out which sources need compiling first and removes their stale
+    class files.
+
+    These are the sources that were added, changed or deleted, those with
+    missing class files and those a build that did not finish was
+    compiling. The sources using their classes are only compiled once
+    dependents finds the classes changed.
+
+    Args:
+    sources: The dictionary of sources returned by loadManifest, entries
+    for sources that need compiling are moved to previous.
+    previous: The dictionary of earlier entries returned by loadManifest.
+    obj_directory: The directory containing the class files.
+    java_sources: A dictionary of the java sources currently on disk, keyed
+    by their path relative to the source directory they are in.
+    Returns:
+    A tuple of the source paths to compile and a dictionary of the hashes
+    of every current source keyed by relative path.
+    """
+    hashes = {}
+    for relative_path, java_source_path in java_sources.items():
+        hashes[relative_path] = files.hashFile(java_source_path)
+    dirty = set(previous)
+    for relative_path, source_hash in hashes.items():
+        if relative_path not in sources or \
+                sources[relative_path]['hash'] != source_hash:
+            dirty.add(relative_path)
+        elif not all(os.path.exists(os.path.join(obj_directory, class_path))
+                     for class_path in sources[relative_path]['classes']):
+            dirty.add(relative_path)
+    for relative_path in sources:
+        if relative_path not in hashes:
+            dirty.add(relative_path)
+    _forget(sources, previous, obj_directory, dirty)
+    compile_paths = []
+    for relative_path in sorted(dirty):
+        if relative_path in java_sources:
+            compile_paths.append(java_sources[relative_path])
+    return compile_paths, hashes
+
+
+def dependents(sources, previous, obj_directory, java_sources):
+    """
+    Works out which sources need compiling because the classes compiled
+    since the last call changed, and removes their stale class files.
+
+    Only the sources directly using a class whose signature changed, or
+    that was added or removed, are compiled. If the compile time constants
+    of a class changed, which javac inlines into the classes using them
+    without referring to the class, every other source is compiled.
+
+    Args:
+    sources: The dictionary of sources updated by update.
+    previous: The dictionary of earlier entries returned by loadManifest,
+    which is replaced by the earlier entries of the sources returned.
+    obj_directory: The directory containing the class files.
+    java_sources: A dictionary of the java sources currently on disk, keyed
+    by their path relative to the source directory they are in.
+    Returns:
+    The source paths to compile next.
+    """
+    changed_classes = set()
+    constants_changed = False
+    for relative_path, earlier in previous.items():
+        source = sources.get(relative_path, {'names': [],
+                                             'signature': None,
+                                             'constants': None})
+        if source['constants'] != earlier['constants']:
+            constants_changed = True
+        if source['signature'] != earlier['signature']:
+            changed_classes.update(earlier['names'])
+            changed_classes.update(source['names'])
+    compiled = set(previous)
+    previous.clear()
+    dirty = set()
+    for relative_path, source in sources.items():
+        if relative_path in compiled:
+            continue
+        if constants_changed or \
+                changed_classes.intersection(source['references']):
+            dirty.add(relative_path)
+    _forget(sources, previous, obj_directory, dirty)
+    return [java_sources[relative_path] for relative_path in sorted(dirty)
+            if relative_path in java_sources]
+
+
+def update(sources, obj_directory, hashes):
+    """
+    Records the class files produced by a compile in the manifest.
+
+    Args:
+    sources: The dictionary of sources returned by loadManifest.
+    obj_directory: The directory containing the class files.
+    hashes: The dictionary of source hashes returned by plan.
+    """
+    owned_class_files = set()
+    for source in sources.values():
+        owned_class_files.update(source['classes'])
+    signatures = {}
+    for root, dirnames, filenames in os.walk(obj_directory):
+        for filename in filenames:
+            class_file = os.path.join(root, filename)
+            class_path = os.path.relpath(class_file, obj_directory)
+            if os.path.splitext(filename)[1] != '.class' or \
+                    class_path in owned_class_files:
+                continue
+            class_info = readClass(class_file)
+            relative_path = _sourceForClass(class_info)
+            if relative_path not in hashes:
+                continue
+            source = sources.setdefault(relative_path,
+                                        {'hash': hashes[relative_path],
+                                         'classes': [],
+                                         'names': [],
+                                         'references': [],
+                                         'signature': None,
+                                         'constants': None})
+            source['classes'].append(class_path)
+            source['names'].append(class_info['name'])
+            source['references'] = sorted(
+                class_info['references'].union(source['references']))
+            signatures.setdefault(relative_path, []).append(
+                (class_info['name'], class_info['signature'],
+                 class_info['constants']))
+    for relative_path, class_signatures in signatures.items():
+        class_signatures.sort()
+        source = sources[relative_path]
+        source['signature'] = _hash([signature[:2]
+                                     for signature in class_signatures])
+        constants = [signature[::2] for signature in class_signatures
+                     if signature[2] is not None]
+        source['constants'] = _hash(constants) if constants else None
+    project_classes = set()
+    for source in sources.values():
+        project_classes.update(source['names'])
+    # Other entries keep references to removed classes for dependents
+    for relative_path in signatures:
+        source = sources[relative_path]
+        source['references'] = sorted(
+            project_classes.intersection(source['references']).difference(
+                source['names']))
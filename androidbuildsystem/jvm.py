@@ -0,0 +1,520 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import hashlib
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+
+from androidbuildsystem import files
+from androidbuildsystem import tracing
+
+
+worker_class = 'AndroidBuildSystemWorker'
+worker_source = """import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
+import java.io.IOException;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.security.Permission;
+import java.util.Arrays;
+import javax.tools.JavaCompiler;
+import javax.tools.ToolProvider;
+
+/**
+ * Runs the main method of Java build tools in a long lived JVM. Each request
+ * is a count of strings followed by the strings, each as a length and UTF-8
+ * bytes: the main class, or javac, and the tool arguments. No strings is a
+ * health check, answered with UNSUPPORTED when System.exit cannot be
+ * trapped, as on JDK 18 and later, since a tool exiting would take the
+ * worker down with it. Each response is the exit status and the length and
+ * bytes of the tool output.
+ */
+public class AndroidBuildSystemWorker {
+    static final int UNSUPPORTED = -1000;
+
+    static class ExitException extends SecurityException {
+        final int status;
+
+        ExitException(int status) {
+            super("System.exit(" + status + ")");
+            this.status = status;
+        }
+    }
+
+    public static void main(String[] arguments) throws IOException {
+        DataInputStream in = new DataInputStream(System.in);
+        DataOutputStream out = new DataOutputStream(System.out);
+        boolean exitTrapped = true;
+        try {
+            System.setSecurityManager(new SecurityManager() {
+                @Override
+                public void checkPermission(Permission permission) {
+                }
+
+                @Override
+                public void checkExit(int status) {
+                    throw new ExitException(status);
+                }
+            });
+        } catch (UnsupportedOperationException | SecurityException e) {
+            exitTrapped = false;
+        }
+        while (true) {
+            int count;
+            try {
+                count = in.readInt();
+            } catch (EOFException e) {
+                return;
+            }
+            String[] request = new String[count];
+            for (int i = 0; i < count; i++) {
+                byte[] data = new byte[in.readInt()];
+                in.readFully(data);
+                request[i] = new String(data, "UTF-8");
+            }
+            ByteArrayOutputStream buffer = new ByteArrayOutputStream();
+            int status;
+            if (count == 0) {
+                status = exitTrapped ? 0 : UNSUPPORTED;
+            } else {
+                status = run(request, buffer);
+            }
+            byte[] output = buffer.toByteArray();
+            out.writeInt(status);
+            out.writeInt(output.length);
+            out.write(output);
+            out.flush();
+        }
+    }
+
+    static int run(String[] request, ByteArrayOutputStream buffer) {
+        PrintStream capture = new PrintStream(buffer, true);
+        PrintStream stdout = System.out;
+        PrintStream stderr = System.err;
+        System.setOut(capture);
+        System.setErr(capture);
+        String[] toolArguments = Arrays.copyOfRange(request, 1,
+                                                    request.length);
+        try {
+            if (request[0].equals("javac")) {
+                JavaCompiler compiler = ToolProvider.getSystemJavaCompiler();
+                if (compiler == null) {
+                    return UNSUPPORTED;
+                }
+                return compiler.run(null, capture, capture, toolArguments);
+            }
+            Method main = Class.forName(request[0]).getMethod(
+                "main", String[].class);
+            main.invoke(null, (Object) toolArguments);
+            return 0;
+        } catch (InvocationTargetException e) {
+            if (e.getCause() instanceof ExitException) {
+                return ((ExitException) e.getCause()).status;
+            }
+            e.getCause().printStackTrace(capture);
+            return 1;
+        } catch (ExitException e) {
+            return e.status;
+        } catch (ReflectiveOperationException | LinkageError e) {
+            return UNSUPPORTED;
+        } finally {
+            capture.flush();
+            System.setOut(stdout);
+            System.setErr(stderr);
+        }
+    }
+}
+"""
+unsupported_status = -1000
+health_check_interval = 30
+main_classes = {'javac': 'javac',
+                'keytool': 'sun.security.tools.keytool.Main',
+                'jarsigner': 'sun.security.tools.jarsigner.Main',
+                'dx': 'com.android.dx.command.Main',
+                'd8': 'com.android.tools.r8.D8'}
+settings = {'max_workers': 0,
+            'java': None}
+statistics = {'started': 0,
+              'startup_seconds': 0.0,
+              'requests': 0,
+              'restarts': 0}
+_pools = {}
+_unsupported = set()
+_failed = set()
+_condition = threading.Condition()
+_compile_lock = threading.Lock()
+_statistics_lock = threading.Lock()
+
+
+def configure(max_workers, java_directory):
+    """
+    Enables running Java tools on persistent workers.
+
+    Args:
+    max_workers: The number of workers to start at most for each tool, 0 or
+    None to start a JVM for every run.
+    java_directory: The directory of the Java SDK.
+    """
+    settings['max_workers'] = max(int(max_workers or 0), 0)
+    settings['java'] = java_directory
+
+
+def isEnabled():
+    """
+    Checks whether Java tools run on persistent workers.
+
+    Returns:
+    True if at least one worker can be started for each tool.
+    """
+    return settings['max_workers'] > 0
+
+
+class _Worker(object):
+    """
+    A JVM running the worker class, taking requests on its stdin and
+    answering on its stdout.
+    """
+
+    def __init__(self, command, cwd):
+        self.process = subprocess.Popen(command,
+                                        cwd=cwd,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        close_fds=True)
+        self.last_used = time.time()
+
+    def _read(self, size):
+        data = self.process.stdout.read(size)
+        if len(data) != size:
+            raise IOError('The worker exited')
+        return data
+
+    def request(self, arguments):
+        """
+        Runs a tool on the worker.
+
+        Args:
+        arguments: A list of the main class and the tool arguments, or an
+        empty list to check the worker is responding.
+        Returns:
+        A tuple of the exit status and the output of the tool.
+        """
+        data = [struct.pack('>i', len(arguments))]
+        for argument in arguments:
+            if isinstance(argument, unicode):
+                argument = argument.encode('utf-8')
+            data.append(struct.pack('>i', len(argument)) + argument)
+        self.process.stdin.write(''.join(data))
+        self.process.stdin.flush()
+        status, length = struct.unpack('>ii', self._read(8))
+        output = self._read(length)
+        self.last_used = time.time()
+        return status, output
+
+    def isHealthy(self):
+        """
+        Checks the worker is still running, and that it still responds if it
+        has not been used for a while.
+
+        Returns:
+        True if the worker can take requests.
+        """
+        if self.process.poll() is not None:
+            return False
+        if time.time() - self.last_used < health_check_interval:
+            return True
+        try:
+            return self.request([])[0] == 0
+        except (IOError, OSError, ValueError, struct.error):
+            return False
+
+    def close(self):
+        """
+        Stops the worker, killing it if it does not exit when its stdin is
+        closed.
+        """
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        for attempt in range(10):
+            if self.process.poll() is not None:
+                return
+            time.sleep(0.1)
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        self.process.wait()
+
+
+def _spec(command):
+    """
+    Works out how to run a tool on a worker.
+
+    Args:
+    command: A list containing the program and its arguments.
+    Returns:
+    A tuple of the java program, the classpath of the tool, its main class
+    and its arguments, or None if the tool cannot run on a worker.
+    """
+    name = os.path.basename(command[0])
+    if name == 'java':
+        # Only a classpath and main class, without other JVM options
+        if len(command) < 4 or command[1] not in ['-cp', '-classpath'] or \
+                command[3].startswith('-'):
+            return None
+        return command[0], command[2].split(':'), command[3], command[4:]
+    if name not in main_classes:
+        return None
+    if name in ['dx', 'd8']:
+        if settings['java'] is None:
+            return None
+        java_program = os.path.join(settings['java'], 'bin', 'java')
+        jar_file = os.path.join(os.path.dirname(command[0]), 'lib',
+                                name + '.jar')
+        if not os.path.isfile(jar_file):
+            return None
+        classpath = [jar_file]
+    else:
+        bin_directory = os.path.dirname(command[0])
+        java_program = os.path.join(bin_directory, 'java')
+        # Older JDKs keep javac and jarsigner in tools.jar
+        tools_jar_file = os.path.join(os.path.dirname(bin_directory), 'lib',
+                                      'tools.jar')
+        classpath = []
+        if os.path.isfile(tools_jar_file):
+            classpath.append(tools_jar_file)
+    if not os.path.isfile(java_program):
+        return None
+    return java_program, classpath, main_classes[name], command[1:]
+
+
+def _compileWorker(java_program):
+    """
+    Compiles the worker class with the javac next to a java program, once
+    for each JDK and version of the worker.
+
+    Args:
+    java_program: The path to the java program.
+    Returns:
+    A string with the directory containing the worker class, or None if it
+    could not be compiled.
+    """
+    javac_program = os.path.join(os.path.dirname(java_program), 'javac')
+    source_hash = hashlib.sha1(worker_source + javac_program).hexdigest()
+    worker_directory = files.userDirectory('jvm', source_hash)
+    with _compile_lock:
+        if os.path.isfile(os.path.join(worker_directory,
+                                       worker_class + '.class')):
+            return worker_directory
+        parent_directory = os.path.dirname(worker_directory)
+        if not os.path.exists(parent_directory):
+            os.makedirs(parent_directory)
+        temporary_directory = tempfile.mkdtemp(dir=parent_directory)
+        try:
+            source_file = os.path.join(temporary_directory,
+                                       worker_class + '.java')
+            with open(source_file, 'w') as f:
+                f.write(worker_source)
+            child = subprocess.Popen([javac_program,
+                                      '-d', temporary_directory,
+                                      source_file],
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT,
+                                     close_fds=True)
+            output = child.communicate()[0]
+            if child.returncode != 0:
+                print 'Failed to compile the JVM worker\n' + output
+                return None
+            os.remove(source_file)
+            try:
+                os.rename(temporary_directory, worker_directory)
+            except OSError:
+                # Another build compiled it first
+                if not os.path.isdir(worker_directory):
+                    raise
+        finally:
+            if os.path.isdir(temporary_directory):
+                shutil.rmtree(temporary_directory)
+    return worker_directory
+
+
+def _startWorker(key):
+    """
+    Starts a worker and waits for it to respond, timing how long the JVM
+    took to start.
+
+    Args:
+    key: A tuple of the java program, the classpath and the working
+    directory.
+    Returns:
+    The worker, or None if it could not be started.
+    """
+    java_program, classpath, cwd = key
+    worker_directory = _compileWorker(java_program)
+    if worker_directory is None:
+        return None
+    start = tracing.now()
+    try:
+        worker = _Worker([java_program,
+                          '-cp', ':'.join([worker_directory] +
+                                          list(classpath)),
+                          worker_class],
+                         cwd)
+    except OSError:
+        return None
+    try:
+        status = worker.request([])[0]
+    except (IOError, OSError, ValueError, struct.error):
+        worker.close()
+        return None
+    if status != 0:
+        # The JVM cannot stop tools exiting it, so they run as processes
+        print 'Not using JVM workers for ' + java_program + \
+            ' as it cannot trap System.exit'
+        worker.close()
+        return None
+    duration = tracing.now() - start
+    with _statistics_lock:
+        statistics['started'] += 1
+        statistics['startup_seconds'] += duration / 1e6
+    tracing.record('java (worker startup)', 'tool', start, duration)
+    return worker
+
+
+def _acquire(key):
+    """
+    Takes an idle worker from the pool of a tool, starting a new one while
+    the pool is not full and restarting workers that are no longer healthy.
+
+    Args:
+    key: A tuple of the java program, the classpath and the working
+    directory.
+    Returns:
+    The worker, or None if no worker could be started.
+    """
+    with _condition:
+        pool = _pools.setdefault(key, {'idle': [], 'count': 0})
+        while len(pool['idle']) == 0 and \
+                pool['count'] >= settings['max_workers']:
+            # A timeout keeps the wait interruptible with Ctrl-C
+            _condition.wait(1)
+        worker = None
+        if len(pool['idle']) > 0:
+            worker = pool['idle'].pop()
+        else:
+            pool['count'] += 1
+    if worker is not None and not worker.isHealthy():
+        worker.close()
+        with _statistics_lock:
+            statistics['restarts'] += 1
+        worker = None
+    if worker is None:
+        worker = _startWorker(key)
+        if worker is None:
+            with _condition:
+                pool['count'] -= 1
+                _failed.add(key)
+                _condition.notify()
+    return worker
+
+
+def _release(key, worker):
+    """
+    Returns a worker to the pool of its tool, or removes it from the pool
+    when it is None.
+    """
+    with _condition:
+        if worker is None:
+            _pools[key]['count'] -= 1
+        else:
+            _pools[key]['idle'].append(worker)
+        _condition.notify()
+
+
+def run(command, cwd=None):
+    """
+    Runs a Java tool on a persistent worker instead of starting a JVM.
+
+    Args:
+    command: A list containing the program and its arguments.
+    cwd: The working directory to run the tool in.
+    Returns:
+    A tuple of the return code and the output of the tool, or None if the
+    tool has to be run as a process. A worker dying while running the tool
+    fails the run rather than running the tool again.
+    """
+    if not isEnabled():
+        return None
+    spec = _spec(command)
+    if spec is None:
+        return None
+    java_program, classpath, main_class, arguments = spec
+    key = (java_program, tuple(classpath), os.path.abspath(cwd or '.'))
+    if key in _failed or (key, main_class) in _unsupported:
+        return None
+    worker = _acquire(key)
+    if worker is None:
+        return None
+    try:
+        status, output = worker.request([main_class] + arguments)
+    except (IOError, OSError, ValueError, struct.error):
+        # The tool may have written its outputs before the worker died, so
+        # it is not run again
+        worker.close()
+        with _statistics_lock:
+            statistics['restarts'] += 1
+        _release(key, None)
+        return 1, 'The JVM worker exited while running ' + \
+            os.path.basename(command[0]) + '\n'
+    _release(key, worker)
+    if status == unsupported_status:
+        _unsupported.add((key, main_class))
+        return None
+    with _statistics_lock:
+        statistics['requests'] += 1
+    return status, output
+
+
+def shutdown():
+    """
+    Stops the idle workers.
+    """
+    with _condition:
+        workers = []
+        for pool in _pools.values():
+            workers.extend(pool['idle'])
+            pool['count'] -= len(pool['idle'])
+            pool['idle'] = []
+    for worker in workers:
+        worker.close()
+
+
+atexit.register(shutdown)
+
+
+def printStatistics():
+    """
+    Prints how many tool runs the workers took and how much JVM startup time
+    they saved.
+    """
+    saved = statistics['requests'] - statistics['started']
+    average_startup = 0.0
+    if statistics['started'] > 0:
+        average_startup = statistics['startup_seconds'] / \
+            statistics['started']
+    print 'JVM worker requests: ' + str(statistics['requests'])
+    print 'JVM workers started: ' + str(statistics['started']) + \
+        ' (' + '%.3f' % average_startup + 's each)'
+    print 'JVM workers restarted: ' + str(statistics['restarts'])
+    print 'JVM startups saved: ' + str(max(saved, 0)) + ' (about ' + \
+        '%.3f' % (max(saved, 0) * average_startup) + 's)'
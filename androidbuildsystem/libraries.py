@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+from androidbuildsystem import dex
+from androidbuildsystem import files
+from androidbuildsystem import tracing
+
+
+libraries_directory = 'libraries'
+index_file = 'index.json'
+index_version = 1
+_index = {'loaded': False, 'jars': {}}
+_index_lock = threading.Lock()
+
+
+def _loadIndex():
+    """
+    Loads the jar hashes recorded by earlier builds into memory.
+    """
+    if _index['loaded']:
+        return
+    index = files.loadJson(files.userDirectory(libraries_directory,
+                                               index_file), {})
+    if index.get('version') == index_version:
+        _index['jars'].update(index['jars'])
+    _index['loaded'] = True
+
+
+def _hashJar(jar_file):
+    """
+    Hashes a jar, reusing the hash recorded for it while its size and
+    modification time are unchanged.
+
+    Args:
+    jar_file: The path to the jar.
+    Returns:
+    A tuple of the SHA-1 of the jar and whether it had to be hashed.
+    """
+    jar_stat = os.stat(jar_file)
+    with _index_lock:
+        _loadIndex()
+        previous = _index['jars'].get(jar_file)
+    if previous is not None and previous[0] == jar_stat.st_size and \
+            previous[1] == jar_stat.st_mtime:
+        return previous[2], False
+    jar_hash = files.hashFile(jar_file)
+    with _index_lock:
+        _index['jars'][jar_file] = [jar_stat.st_size,
+                                    jar_stat.st_mtime,
+                                    jar_hash]
+    return jar_hash, True
+
+
+def index(lib_directories):
+    """
+    Indexes the jars in library directories by the hash of their contents.
+
+    The hashes are kept in the user directory, so jars are only hashed
+    again when they are modified.
+
+    Args:
+    lib_directories: A list of directories containing jars.
+    Returns:
+    A list of dictionaries with the path and SHA-1 of each jar, sorted by
+    directory and name.
+    """
+    jars = []
+    hashed_jars = []
+    for lib_directory in lib_directories:
+        if not os.path.isdir(lib_directory):
+            continue
+        for lib_file in sorted(os.listdir(lib_directory)):
+            jar_file = os.path.abspath(os.path.join(lib_directory, lib_file))
+            if not os.path.isfile(jar_file) or \
+                    os.path.splitext(lib_file)[1] != '.jar':
+                continue
+            jar_hash, hashed = _hashJar(jar_file)
+            if hashed:
+                hashed_jars.append(jar_file)
+            jars.append({'path': jar_file, 'sha1': jar_hash})
+    if len(hashed_jars) > 0:
+        def update(saved_index):
+            # Other builds may have hashed other jars since it was loaded
+            if saved_index.get('version') != index_version:
+                saved_index = {'version': index_version, 'jars': {}}
+            for jar_file in hashed_jars:
+                saved_index['jars'][jar_file] = _index['jars'][jar_file]
+            return saved_index
+        with _index_lock:
+            files.updateJson(files.userDirectory(libraries_directory,
+                                                 index_file),
+                             update, {})
+    return jars
+
+
+def _predexJar(job):
+    """
+    Converts a library jar into a dex file on a worker thread.
+
+    Args:
+    job: A tuple of the jar, the dex program, the dex file to write and the
+    build step.
+    Returns:
+    A tuple of the jar, the return code and the captured output.
+    """
+    jar, dex_program, dex_file, step = job
+    try:
+        with tracing.inStep(step):
+            result, output = dex.dexJar(dex_program, jar['path'], dex_file)
+    except Exception as e:
+        result, output = 1, str(e) + '\n'
+    return jar, result, output
+
+
+def predex(build_tools_folder, jars):
+    """
+    Converts library jars into dex files once, keeping them in the user
+    directory so every build of every project reuses them.
+
+    The dex files are named by the hash of the jar and the build tools used,
+    and jars that have not been converted yet are converted on a pool of
+    worker threads.
+
+    Args:
+    build_tools_folder: The build tools folder.
+    jars: The list of jars returned by index.
+    Returns:
+    A tuple of the return code of the first failing conversion, or 0, and
+    the list of the dex file of each jar.
+    """
+    dex_program = dex.dexProgram(build_tools_folder)
+    cache_directory = files.userDirectory(
+        libraries_directory,
+        os.path.basename(os.path.normpath(build_tools_folder)) + '-' +
+        os.path.basename(dex_program))
+    if not os.path.exists(cache_directory):
+        try:
+            os.makedirs(cache_directory)
+        except OSError:
+            # Another build created it first
+            if not os.path.isdir(cache_directory):
+                raise
+    step = tracing.currentStep()
+    jobs = []
+    dex_files = []
+    for jar in jars:
+        dex_file = os.path.join(cache_directory, jar['sha1'] + '.dex')
+        dex_files.append(dex_file)
+        if not os.path.exists(dex_file) and \
+                dex_file not in [job[2] for job in jobs]:
+            jobs.append((jar, dex_program, dex_file, step))
+    if len(jobs) == 0:
+        return 0, dex_files
+    print 'Pre-dexing ' + str(len(jobs)) + ' of ' + str(len(jars)) + \
+        ' libraries...'
+    result = 0
+    pool = ThreadPool(min(multiprocessing.cpu_count(), len(jobs)))
+    try:
+        for jar, jar_result, output in pool.imap_unordered(_predexJar, jobs):
+            name = os.path.basename(jar['path'])
+            for line in output.splitlines():
+                print '[' + name + '] ' + line
+            if jar_result != 0:
+                print 'Failed to pre-dex library ' + name
+                result = jar_result
+    finally:
+        pool.close()
+        pool.join()
+    return result, dex_files
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import errno
+import os
+import subprocess
+import sys
+import threading
+
+from androidbuildsystem import jvm
+from androidbuildsystem import tracing
+
+
+java_programs = ['android',
+                 'apksigner',
+                 'd8',
+                 'dx',
+                 'jarsigner',
+                 'java',
+                 'javac',
+                 'keytool']
+statistics = {'processes': 0,
+              'jvms': 0}
+_redirect = threading.local()
+_statistics_lock = threading.Lock()
+
+
+class ThreadOutput(object):
+    """
+    A stream that sends what each thread writes to a buffer of its own, so
+    the output of work done at the same time is not interleaved.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._buffers = threading.local()
+
+    def capture(self):
+        """
+        Starts collecting what this thread writes.
+        """
+        self._buffers.lines = []
+
+    def release(self):
+        """
+        Stops collecting what this thread writes.
+
+        Returns:
+        A string with everything written since capture was called.
+        """
+        lines = self._buffers.lines
+        self._buffers.lines = None
+        return ''.join(lines)
+
+    def write(self, data):
+        lines = getattr(self._buffers, 'lines', None)
+        if lines is None:
+            self.stream.write(data)
+        else:
+            lines.append(data)
+
+    def flush(self):
+        if getattr(self._buffers, 'lines', None) is None:
+            self.stream.flush()
+
+
+def isJavaProgram(program):
+    """
+    Checks whether a program starts a Java virtual machine.
+
+    Args:
+    program: The path or name of the program.
+    Returns:
+    True if the program runs on a Java virtual machine.
+    """
+    return os.path.basename(program) in java_programs
+
+
+@contextlib.contextmanager
+def redirectOutput():
+    """
+    Writes the output of the programs run on this thread that would go
+    straight to the console to sys.stdout instead, so that it is captured
+    along with what the build prints.
+    """
+    _redirect.enabled = True
+    try:
+        yield
+    finally:
+        _redirect.enabled = False
+
+
+def _record(command):
+    """
+    Records a program launch in the build statistics.
+
+    Args:
+    command: A list containing the program and its arguments.
+    """
+    with _statistics_lock:
+        statistics['processes'] += 1
+        if isJavaProgram(command[0]):
+            statistics['jvms'] += 1
+
+
+def _execute(command, cwd, capture, shell=False, category='tool', name=None):
+    """
+    Runs a program, recording its wall time, CPU time and peak memory use.
+    Java tools run on a persistent JVM worker instead when workers are
+    enabled.
+
+    Args:
+    command: A list containing the program and its arguments, or a shell
+    command string if shell is set.
+    cwd: The working directory to run the program in.
+    capture: Whether to capture the combined stdout and stderr output.
+    shell: Whether to run the command with the shell.
+    category: The trace category of the program.
+    name: The name to trace the program as, defaults to the program name.
+    Returns:
+    A tuple of the return code and the captured output (None when the
+    output is not captured).
+    """
+    if name is None:
+        name = command if shell else os.path.basename(command[0])
+    if not shell:
+        start = tracing.now()
+        worker_result = jvm.run(command, cwd)
+        if worker_result is not None:
+            returncode, output = worker_result
+            tracing.record(name, category, start, tracing.now() - start,
+                           {'worker': True,
+                            'returncode': returncode})
+            if not capture:
+                sys.stdout.write(output)
+                output = None
+            return returncode, output
+        _record(command)
+    redirect = not capture and getattr(_redirect, 'enabled', False)
+    start = tracing.now()
+    # Programs started by other threads at the same time must not inherit
+    # the pipes of this one, or reading the output waits for them to exit
+    child = subprocess.Popen(command,
+                             cwd=cwd,
+                             shell=shell,
+                             close_fds=True,
+                             stdout=subprocess.PIPE
+                             if capture or redirect else None,
+                             stderr=subprocess.STDOUT
+                             if capture or redirect else None)
+    output = None
+    if capture or redirect:
+        output = child.stdout.read()
+        child.stdout.close()
+    if redirect:
+        sys.stdout.write(output)
+        output = None
+    # Reap the child ourselves to get its resource usage
+    while True:
+        try:
+            status, rusage = os.wait4(child.pid, 0)[1:]
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        child.returncode = -os.WTERMSIG(status)
+    else:
+        child.returncode = os.WEXITSTATUS(status)
+    tracing.record(name, category, start, tracing.now() - start,
+                   {'cpu': rusage.ru_utime + rusage.ru_stime,
+                    'max_rss_kb': rusage.ru_maxrss,
+                    'returncode': child.returncode})
+    return child.returncode, output
+
+
+def call(command, cwd=None):
+    """
+    Runs a build tool and records it in the build statistics.
+
+    Args:
+    command: A list containing the program and its arguments.
+    cwd: The working directory to run the program in.
+    Returns:
+    The return code of the program.
+    """
+    return _execute(command, cwd, False)[0]
+
+
+def run(command, cwd=None):
+    """
+    Runs a build tool, capturing its combined stdout and stderr output.
+
+    Args:
+    command: A list containing the program and its arguments.
+    cwd: The working directory to run the program in.
+    Returns:
+    A tuple of the return code and the captured output.
+    """
+    return _execute(command, cwd, True)
+
+
+def callShell(script, cwd=None, name=None):
+    """
+    Runs a shell script such as a before or after hook.
+
+    Args:
+    script: The shell command to run.
+    cwd: The working directory to run the script in.
+    name: The name to trace the script as, defaults to the script.
+    Returns:
+    The return code of the script.
+    """
+    return _execute(script, cwd, False, shell=True, category='hook',
+                    name=name)[0]
+
+
+def runShell(script, cwd=None, name=None):
+    """
+    Runs a shell script, capturing its combined stdout and stderr output.
+
+    Args:
+    script: The shell command to run.
+    cwd: The working directory to run the script in.
+    name: The name to trace the script as, defaults to the script.
+    Returns:
+    A tuple of the return code and the captured output.
+    """
+    return _execute(script, cwd, True, shell=True, category='hook',
+                    name=name)
+
+
+def printReport():
+    """
+    Prints a summary of the processes started during the build.
+    """
+    print 'Processes started: ' + str(statistics['processes'] +
+                                      jvm.statistics['started'])
+    print 'JVMs started: ' + str(statistics['jvms'] +
+                                 jvm.statistics['started'])
+    if jvm.isEnabled():
+        jvm.printStatistics()
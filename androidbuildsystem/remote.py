@@ -0,0 +1,715 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import hashlib
+import hmac
+import json
+import multiprocessing
+import os
+import shlex
+import shutil
+import socket
+import SocketServer
+import struct
+import tempfile
+import threading
+
+from androidbuildsystem import files
+from androidbuildsystem import process
+from androidbuildsystem import tracing
+
+
+protocol_version = 1
+frame_header = struct.Struct('>I')
+receive_chunk_size = 1024 * 1024
+tool_placeholders = ['$ANDROID', '$JAVA']
+tool_names = ['javac', 'dx', 'd8', 'aapt', 'aapt2', 'zipalign']
+# Options that make the tools load code, such as JVM agents or annotation
+# processors, from the files sent with an action
+code_options = ['-J', '-processor', '--processor', '-Xplugin', '-proc:']
+token_variable = 'ANDROIDBUILDSYSTEM_WORKER_TOKEN'
+local_hosts = ['localhost', '127.0.0.1', '::1']
+arguments_placeholder = '$ARGS'
+worker_directory = 'worker'
+worker_max_size = 1024
+settings = {'workers': [],
+            'timeout': 10.0,
+            'token': None,
+            'roots': []}
+statistics = {'remote': 0,
+              'local': 0,
+              'uploaded_bytes': 0,
+              'downloaded_bytes': 0}
+_state = {'next': 0,
+          'unreachable': set()}
+_state_lock = threading.Lock()
+_statistics_lock = threading.Lock()
+_file_hashes = {}
+
+
+def _address(worker):
+    """
+    Parses a worker address.
+
+    Args:
+    worker: A string with HOST:PORT, or just the port for localhost.
+    Returns:
+    A tuple of the host and port.
+    """
+    host, _, port = str(worker).rpartition(':')
+    return host or 'localhost', int(port)
+
+
+def configure(remote_options, roots):
+    """
+    Enables running tools on remote workers.
+
+    Args:
+    remote_options: The build configuration options for remote execution,
+    with a list of worker addresses and optionally a connection timeout and
+    the token the workers expect, or None to run every tool locally.
+    roots: A list of tuples of directories and the placeholders they are
+    replaced with in actions. Files under the $ANDROID and $JAVA
+    placeholders are expected to be installed on the workers, and other
+    files are sent to them.
+    """
+    _state['unreachable'] = set()
+    if remote_options is None:
+        settings['workers'] = []
+        return
+    workers = remote_options.get('workers', [])
+    if not isinstance(workers, list):
+        workers = [workers]
+    settings['workers'] = [_address(worker) for worker in workers]
+    settings['timeout'] = float(remote_options.get('timeout', 10))
+    settings['token'] = remote_options.get('token',
+                                           os.environ.get(token_variable))
+    settings['roots'] = [(os.path.abspath(root), placeholder)
+                         for root, placeholder in roots]
+
+
+def isEnabled():
+    """
+    Checks whether remote workers have been configured.
+
+    Returns:
+    True if there is at least one remote worker.
+    """
+    return len(settings['workers']) > 0
+
+
+def _hashFile(path):
+    """
+    Hashes a file, remembering the hash until the file is modified.
+
+    Args:
+    path: The path to the file.
+    Returns:
+    A string with the SHA-1 of the file.
+    """
+    path_stat = os.stat(path)
+    memo_key = (path, path_stat.st_size, path_stat.st_mtime)
+    if memo_key not in _file_hashes:
+        _file_hashes[memo_key] = files.hashFile(path)
+    return _file_hashes[memo_key]
+
+
+def _writeFile(path, data):
+    """
+    Writes a file through a temporary file so it never exists half written.
+
+    Args:
+    path: The path to the file.
+    data: A string with the contents.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    temporary_fd, temporary_path = tempfile.mkstemp(dir=directory,
+                                                    suffix='.tmp')
+    with os.fdopen(temporary_fd, 'wb') as f:
+        f.write(data)
+    os.rename(temporary_path, path)
+
+
+def _sendFrame(connection, data):
+    """
+    Sends a length prefixed frame.
+
+    Args:
+    connection: The socket.
+    data: A string with the frame contents.
+    """
+    connection.sendall(frame_header.pack(len(data)))
+    connection.sendall(data)
+
+
+def _receiveExactly(connection, size):
+    """
+    Receives an exact number of bytes.
+
+    Args:
+    connection: The socket.
+    size: The number of bytes.
+    Returns:
+    A string with the bytes.
+    """
+    chunks = []
+    while size > 0:
+        chunk = connection.recv(min(size, receive_chunk_size))
+        if not chunk:
+            raise IOError('Connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _receiveFrame(connection):
+    """
+    Receives a length prefixed frame.
+
+    Args:
+    connection: The socket.
+    Returns:
+    A string with the frame contents.
+    """
+    size = frame_header.unpack(_receiveExactly(connection,
+                                               frame_header.size))[0]
+    return _receiveExactly(connection, size)
+
+
+def _sendMessage(connection, message):
+    """
+    Sends a JSON message in a frame.
+    """
+    _sendFrame(connection, json.dumps(message))
+
+
+def _receiveMessage(connection):
+    """
+    Receives a JSON message from a frame.
+
+    Returns:
+    The decoded message, with its strings encoded as UTF-8.
+    """
+    return _encode(json.loads(_receiveFrame(connection)))
+
+
+def _encode(value):
+    """
+    Converts the unicode strings of a decoded JSON value to UTF-8 strings.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_encode(key), _encode(item))
+                    for key, item in value.items())
+    return value
+
+
+def _mapPath(path, roots):
+    """
+    Maps a path to its path in an action.
+
+    Args:
+    path: The absolute path.
+    roots: A list of tuples of directories and their placeholders, longest
+    directory first.
+    Returns:
+    The path under a placeholder with / separators, or None if it is not
+    under any of the directories.
+    """
+    for root, placeholder in roots:
+        if path == root or path.startswith(root + os.sep):
+            return placeholder + path[len(root):].replace(os.sep, '/')
+    return None
+
+
+def _replaceText(text, roots):
+    """
+    Replaces the directories in a tool argument or argument file with their
+    placeholders.
+    """
+    for root, placeholder in roots:
+        text = text.replace(root, placeholder)
+    return text
+
+
+def _restoreText(text, roots):
+    """
+    Replaces the placeholders in tool output with their directories.
+    """
+    for root, placeholder in sorted(roots, key=lambda root: -len(root[1])):
+        text = text.replace(placeholder, root)
+    return text
+
+
+def _action(command, inputs, outputs):
+    """
+    Describes a tool invocation as a hermetic action.
+
+    Args:
+    command: A list containing the program and its arguments.
+    inputs: A list of the files and directories the program reads.
+    outputs: A list of the files and directories the program writes.
+    Returns:
+    A dictionary with the message describing the action, the contents of
+    its input files keyed by hash and the directories its placeholders
+    stand for, or None if the action cannot run remotely.
+    """
+    roots = list(settings['roots'])
+    for index, output in enumerate(outputs):
+        output = os.path.abspath(output)
+        if _mapPath(output, roots) is None:
+            roots.append((output, '$OUTPUT' + str(index)))
+    roots.sort(key=lambda root: -len(root[0]))
+    action_inputs = {}
+    blobs = {}
+    for path in inputs:
+        full_path = os.path.abspath(path)
+        remote_path = _mapPath(full_path, roots)
+        if remote_path is None:
+            return None
+        if remote_path.split('/')[0] in tool_placeholders:
+            # Installed on the workers
+            continue
+        if os.path.isfile(full_path):
+            file_paths = [(remote_path, full_path)]
+        else:
+            file_paths = []
+            for root, dirnames, filenames in os.walk(full_path):
+                for filename in filenames:
+                    file_path = os.path.join(root, filename)
+                    file_paths.append((_mapPath(file_path, roots), file_path))
+        for remote_file_path, file_path in file_paths:
+            file_hash = _hashFile(file_path)
+            action_inputs[remote_file_path] = file_hash
+            blobs[file_hash] = ('file', file_path)
+    remote_command = []
+    for index, argument in enumerate(command):
+        if argument.startswith('@') and os.path.isfile(argument[1:]):
+            with open(argument[1:], 'rb') as f:
+                contents = _replaceText(f.read(), roots)
+            contents_hash = hashlib.sha1(contents).hexdigest()
+            remote_path = arguments_placeholder + '/' + str(index)
+            action_inputs[remote_path] = contents_hash
+            blobs[contents_hash] = ('data', contents)
+            remote_command.append('@' + remote_path)
+        else:
+            remote_command.append(_replaceText(argument, roots))
+    if remote_command[0].split('/')[0] not in tool_placeholders or \
+            os.path.basename(command[0]) not in tool_names:
+        return None
+    placeholders = set(placeholder for root, placeholder in roots)
+    placeholders.add(arguments_placeholder)
+    return {'message': {'version': protocol_version,
+                        'token': settings['token'],
+                        'command': remote_command,
+                        'cwd': _mapPath(os.getcwd(), roots),
+                        'placeholders': sorted(placeholders),
+                        'inputs': action_inputs,
+                        'outputs': [[_mapPath(os.path.abspath(output), roots),
+                                     os.path.isdir(output)]
+                                    for output in outputs]},
+            'blobs': blobs,
+            'roots': roots,
+            'outputs': [os.path.abspath(output) for output in outputs]}
+
+
+def _workers():
+    """
+    Lists the reachable workers, starting from a different one each time to
+    spread the actions between them.
+
+    Returns:
+    A list of worker addresses.
+    """
+    with _state_lock:
+        workers = [worker for worker in settings['workers']
+                   if worker not in _state['unreachable']]
+        if len(workers) == 0:
+            return []
+        start = _state['next'] % len(workers)
+        _state['next'] += 1
+    return workers[start:] + workers[:start]
+
+
+def _execute(worker, action):
+    """
+    Runs an action on a worker, sending the inputs it does not have and
+    writing the output files it returns.
+
+    Args:
+    worker: The address of the worker.
+    action: The action returned by _action.
+    Returns:
+    A tuple of the return code and the output of the tool.
+    """
+    connection = socket.create_connection(worker, settings['timeout'])
+    try:
+        # Actions can wait for a free slot on the worker
+        connection.settimeout(None)
+        _sendMessage(connection, action['message'])
+        reply = _receiveMessage(connection)
+        if 'error' in reply:
+            raise ValueError(reply['error'])
+        for blob_hash in reply['missing']:
+            kind, value = action['blobs'][blob_hash]
+            if kind == 'file':
+                with open(value, 'rb') as f:
+                    value = f.read()
+            _sendFrame(connection, value)
+            with _statistics_lock:
+                statistics['uploaded_bytes'] += len(value)
+        reply = _receiveMessage(connection)
+        if 'error' in reply:
+            raise ValueError(reply['error'])
+        for remote_path in reply['files']:
+            data = _receiveFrame(connection)
+            with _statistics_lock:
+                statistics['downloaded_bytes'] += len(data)
+            local_path = _restoreText(remote_path, action['roots'])
+            if not any(local_path == output or
+                       local_path.startswith(output + os.sep)
+                       for output in action['outputs']):
+                raise ValueError('Worker returned a file that is not an '
+                                 'output: ' + remote_path)
+            _writeFile(local_path, data)
+    finally:
+        connection.close()
+    return reply['result'], _restoreText(reply['output'], action['roots'])
+
+
+def run(command, inputs, outputs):
+    """
+    Runs a build tool on a remote worker, or locally if no worker is
+    configured or reachable.
+
+    Args:
+    command: A list containing the program and its arguments.
+    inputs: A list of the files and directories the program reads.
+    outputs: A list of the files and directories the program writes.
+    Returns:
+    A tuple of the return code and the captured output.
+    """
+    if not isEnabled():
+        return process.run(command)
+    action = _action(command, inputs, outputs)
+    if action is not None:
+        for worker in _workers():
+            start = tracing.now()
+            try:
+                result, output = _execute(worker, action)
+            except (socket.error, IOError, ValueError) as e:
+                print 'Remote worker ' + worker[0] + ':' + str(worker[1]) + \
+                    ' failed, not using it for the rest of the build: ' + \
+                    str(e)
+                with _state_lock:
+                    _state['unreachable'].add(worker)
+                continue
+            with _statistics_lock:
+                statistics['remote'] += 1
+            tracing.record(os.path.basename(command[0]) + ' (remote)',
+                           'remote',
+                           start,
+                           tracing.now() - start,
+                           {'worker': worker[0] + ':' + str(worker[1]),
+                            'returncode': result})
+            return result, output
+    with _statistics_lock:
+        statistics['local'] += 1
+    return process.run(command)
+
+
+def printStatistics():
+    """
+    Prints a summary of the actions run on remote workers.
+    """
+    print 'Remote actions: ' + str(statistics['remote'])
+    print 'Remote actions run locally: ' + str(statistics['local'])
+    print 'Remote bytes uploaded: ' + str(statistics['uploaded_bytes'])
+    print 'Remote bytes downloaded: ' + str(statistics['downloaded_bytes'])
+
+
+def _sandboxPath(remote_path, directories):
+    """
+    Maps a path in an action to a path on the worker.
+
+    Args:
+    remote_path: The path under a placeholder.
+    directories: A dictionary of the directory of each placeholder.
+    Returns:
+    The path on the worker.
+    """
+    placeholder = remote_path.split('/')[0]
+    if placeholder not in directories:
+        raise ValueError('Unknown placeholder in ' + remote_path)
+    directory = directories[placeholder]
+    path = os.path.normpath(os.path.join(directory,
+                                         remote_path[len(placeholder):]
+                                         .lstrip('/')))
+    if path != directory and not path.startswith(directory + os.sep):
+        raise ValueError('Path outside of the action: ' + remote_path)
+    return path
+
+
+def _checkArguments(arguments):
+    """
+    Checks that tool arguments sent by a build do not make the tool load
+    code from the files sent with the action.
+
+    Args:
+    arguments: A list of the tool arguments.
+    Raises:
+    ValueError: If an argument is not allowed on a worker.
+    """
+    for argument in arguments:
+        if any(argument.startswith(option) for option in code_options):
+            raise ValueError('Option not allowed on a worker: ' + argument)
+
+
+def _toolProgram(remote_program, tools):
+    """
+    Maps the program of an action to a tool installed on the worker.
+
+    Args:
+    remote_program: The program path under a tool placeholder.
+    tools: A dictionary of the directory of each tool placeholder.
+    Returns:
+    The path to the tool on the worker.
+    Raises:
+    ValueError: If the program is not a known tool of the SDK or JDK.
+    """
+    program = _sandboxPath(remote_program, tools)
+    if os.path.basename(program) not in tool_names:
+        raise ValueError('Only ' + ', '.join(tool_names) + ' can run')
+    return program
+
+
+def _serveAction(connection, server):
+    """
+    Runs one action sent by a build.
+
+    Args:
+    connection: The socket connected to the build.
+    server: The worker server.
+    """
+    message = _receiveMessage(connection)
+    if message.get('version') != protocol_version:
+        _sendMessage(connection, {'error': 'Unsupported protocol version'})
+        return
+    if server.token is not None and \
+            not hmac.compare_digest(str(message.get('token') or ''),
+                                    server.token):
+        _sendMessage(connection, {'error': 'Invalid token'})
+        return
+    try:
+        program = _toolProgram(message['command'][0], server.tools)
+        _checkArguments(message['command'][1:])
+    except ValueError as e:
+        _sendMessage(connection, {'error': str(e)})
+        return
+    blob_directory = os.path.join(server.directory, 'blobs')
+    blob_hashes = set(message['inputs'].values())
+    missing = []
+    with server.blob_lock:
+        # Blobs of running actions are not evicted
+        server.blobs_in_use.update(blob_hashes)
+        for blob_hash in sorted(blob_hashes):
+            blob_file = os.path.join(blob_directory, blob_hash)
+            if os.path.isfile(blob_file):
+                # The blob mtime records when it was last used for eviction
+                os.utime(blob_file, None)
+            else:
+                missing.append(blob_hash)
+    sandbox_directory = None
+    try:
+        _sendMessage(connection, {'missing': missing})
+        for blob_hash in missing:
+            data = _receiveFrame(connection)
+            if hashlib.sha1(data).hexdigest() != blob_hash:
+                raise ValueError('Input does not match its hash')
+            _writeFile(os.path.join(blob_directory, blob_hash), data)
+        sandbox_directory = tempfile.mkdtemp(dir=server.directory,
+                                             prefix='action-')
+        directories = dict(server.tools)
+        for placeholder in message['placeholders']:
+            if placeholder not in directories:
+                directories[placeholder] = os.path.join(
+                    sandbox_directory, placeholder.lstrip('$'))
+        roots = [(directory, placeholder)
+                 for placeholder, directory in directories.items()]
+        roots.sort(key=lambda root: -len(root[0]))
+        for remote_path, blob_hash in message['inputs'].items():
+            path = _sandboxPath(remote_path, directories)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            blob_file = os.path.join(blob_directory, blob_hash)
+            if remote_path.split('/')[0] == arguments_placeholder:
+                # Argument files name the other inputs by placeholder
+                with open(blob_file, 'rb') as f:
+                    contents = _restoreText(f.read(), roots)
+                _checkArguments(shlex.split(contents))
+                with open(path, 'wb') as f:
+                    f.write(contents)
+            else:
+                shutil.copyfile(blob_file, path)
+        outputs = []
+        for remote_path, is_directory in message['outputs']:
+            path = _sandboxPath(remote_path, directories)
+            directory = path if is_directory else os.path.dirname(path)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            outputs.append((remote_path, path))
+        cwd = sandbox_directory
+        if message['cwd'] is not None:
+            cwd = _sandboxPath(message['cwd'], directories)
+            if not os.path.exists(cwd):
+                os.makedirs(cwd)
+        command = [program] + [_restoreText(argument, roots)
+                               for argument in message['command'][1:]]
+        if os.path.basename(program) == 'javac':
+            # Processors found on the classpath would run otherwise
+            command.insert(1, '-proc:none')
+        with server.slots:
+            result, output = process.run(command, cwd=cwd)
+        # Only return the files the tool wrote or changed
+        output_files = []
+        for remote_path, path in outputs:
+            if os.path.isdir(path):
+                for root, dirnames, filenames in os.walk(path):
+                    for filename in filenames:
+                        file_path = os.path.join(root, filename)
+                        output_files.append(
+                            (remote_path + '/' +
+                             os.path.relpath(file_path, path).replace(
+                                 os.sep, '/'),
+                             file_path))
+            elif os.path.isfile(path):
+                output_files.append((remote_path, path))
+        output_files = [(remote_path, path)
+                        for remote_path, path in output_files
+                        if message['inputs'].get(remote_path) !=
+                        files.hashFile(path)]
+        _sendMessage(connection,
+                     {'result': result,
+                      'output': _replaceText(output, roots),
+                      'files': [remote_path
+                                for remote_path, path in output_files]})
+        for remote_path, path in output_files:
+            with open(path, 'rb') as f:
+                _sendFrame(connection, f.read())
+    finally:
+        if sandbox_directory is not None:
+            shutil.rmtree(sandbox_directory, ignore_errors=True)
+        with server.blob_lock:
+            server.blobs_in_use.subtract(blob_hashes)
+        if len(missing) > 0:
+            _evictBlobs(server)
+
+
+def _evictBlobs(server):
+    """
+    Removes the least recently used blobs until the blobs of a worker fit
+    its size limit, keeping those of running actions.
+
+    Args:
+    server: The worker server.
+    """
+    blob_directory = os.path.join(server.directory, 'blobs')
+    with server.blob_lock:
+        blobs = []
+        for blob_hash in os.listdir(blob_directory):
+            blob_file = os.path.join(blob_directory, blob_hash)
+            if not blob_hash.endswith('.tmp') and os.path.isfile(blob_file):
+                blob_stat = os.stat(blob_file)
+                blobs.append((blob_stat.st_mtime, blob_stat.st_size,
+                              blob_hash))
+        blobs.sort()
+        total_size = sum(blob[1] for blob in blobs)
+        for mtime, size, blob_hash in blobs:
+            if total_size <= server.max_size:
+                break
+            if server.blobs_in_use[blob_hash] > 0:
+                continue
+            os.remove(os.path.join(blob_directory, blob_hash))
+            total_size -= size
+
+
+class _WorkerHandler(SocketServer.BaseRequestHandler):
+    """
+    Handles the connection of a build sending an action.
+    """
+
+    def handle(self):
+        try:
+            _serveAction(self.request, self.server)
+        except (socket.error, IOError, OSError, ValueError) as e:
+            print 'Action failed: ' + str(e)
+
+
+class _WorkerServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    Serves each build connection on its own thread.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def serve(address, android_directory, java_directory, jobs=None,
+          token=None, max_size=None):
+    """
+    Runs a worker that runs the actions sent by builds until interrupted.
+
+    Inputs are kept in the user directory by hash so they are only sent
+    once, removing the least recently used ones when they grow beyond the
+    size limit, and every action runs in its own temporary directory with the
+    SDK and JDK of the worker. Only the tools the build runs remotely can
+    run, and javac runs without annotation processors.
+
+    Args:
+    address: The address to listen on, HOST:PORT or just the port to only
+    accept connections from localhost.
+    android_directory: The directory of the Android SDK.
+    java_directory: The directory of the Java SDK.
+    jobs: The number of actions to run at once, None for one per CPU.
+    token: The token builds have to send, None to read it from the
+    environment. A token is required to listen on other addresses than
+    localhost.
+    max_size: The size in megabytes the stored inputs are kept under, None
+    for worker_max_size.
+    Raises:
+    ValueError: If the worker would accept connections from other machines
+    without a token.
+    """
+    if token is None:
+        token = os.environ.get(token_variable)
+    host, port = _address(address)
+    if not token and host not in local_hosts:
+        raise ValueError('Set ' + token_variable + ' to accept connections '
+                         'from other machines')
+    server = _WorkerServer((host, port), _WorkerHandler)
+    server.token = str(token) if token else None
+    server.tools = {'$ANDROID': os.path.abspath(android_directory),
+                    '$JAVA': os.path.abspath(java_directory)}
+    server.slots = threading.Semaphore(jobs or multiprocessing.cpu_count())
+    server.directory = files.userDirectory(worker_directory)
+    server.max_size = int(max_size or worker_max_size) * 1024 * 1024
+    server.blob_lock = threading.Lock()
+    server.blobs_in_use = collections.Counter()
+    if not os.path.exists(os.path.join(server.directory, 'blobs')):
+        os.makedirs(os.path.join(server.directory, 'blobs'))
+    host, port = server.server_address
+    print 'Remote worker listening on ' + host + ':' + str(port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
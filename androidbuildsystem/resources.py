@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
+from xml.dom import minidom
+
+from androidbuildsystem import cache
+from androidbuildsystem import files
+from androidbuildsystem import remote
+from androidbuildsystem import tracing
+
+
+index_file = 'compiled.json'
+index_version = 1
+
+
+def manifestPackage(manifest_file):
+    """
+    Reads the package name from an Android manifest.
+
+    Args:
+    manifest_file: The path to the AndroidManifest.xml.
+    Returns:
+    A string with the package name.
+    """
+    document = minidom.parse(manifest_file)
+    return document.documentElement.getAttribute('package')
+
+
+def manifestMinSdkVersion(manifest_file):
+    """
+    Reads the minimum API level from an Android manifest.
+
+    Args:
+    manifest_file: The path to the AndroidManifest.xml.
+    Returns:
+    The minSdkVersion of the uses-sdk element, 1 when there is none as on
+    Android, or None for a preview codename.
+    """
+    document = minidom.parse(manifest_file)
+    for uses_sdk in document.getElementsByTagName('uses-sdk'):
+        min_sdk_version = uses_sdk.getAttribute('android:minSdkVersion')
+        if min_sdk_version:
+            try:
+                return int(min_sdk_version)
+            except ValueError:
+                return None
+    return 1
+
+
+def _hashResources(res_directory, previous_resources):
+    """
+    Hashes the resource files, reusing the hashes of files that have not
+    been modified.
+
+    Args:
+    res_directory: The resources directory.
+    previous_resources: The resource hashes recorded by the last build.
+    Returns:
+    A dictionary of the size, mtime and hash of each resource file keyed by
+    its path relative to the resources directory.
+    """
+    resources = {}
+    for root, dirnames, filenames in os.walk(res_directory):
+        # aapt ignores hidden files and directories
+        dirnames[:] = [dirname for dirname in dirnames
+                       if not dirname.startswith('.')]
+        for filename in filenames:
+            if filename.startswith('.'):
+                continue
+            resource_file = os.path.join(root, filename)
+            relative_path = os.path.relpath(resource_file, res_directory)
+            resource_stat = os.stat(resource_file)
+            previous = previous_resources.get(relative_path)
+            if previous is not None and \
+                    previous[0] == resource_stat.st_size and \
+                    previous[1] == resource_stat.st_mtime:
+                resources[relative_path] = previous
+            else:
+                resources[relative_path] = [resource_stat.st_size,
+                                            resource_stat.st_mtime,
+                                            files.hashFile(resource_file)]
+    return resources
+
+
+def _compileResource(job):
+    """
+    Compiles one resource file with aapt2 on a worker thread.
+
+    Args:
+    job: A tuple of the path of the resource relative to the resources
+    directory, the aapt2 program, the resources directory, the compiled
+    file to write and the build step.
+    Returns:
+    A tuple of the resource path, the return code and the captured output.
+    """
+    relative_path, aapt2_program, res_directory, flat_file, step = job
+    temporary_directory = tempfile.mkdtemp(dir=os.path.dirname(flat_file))
+    try:
+        with tracing.inStep(step):
+            res_file = os.path.join(res_directory, relative_path)
+            result, output = remote.run([aapt2_program,
+                                         'compile',
+                                         '-o', temporary_directory,
+                                         res_file],
+                                        [res_file],
+                                        [temporary_directory])
+        if result == 0:
+            built_files = os.listdir(temporary_directory)
+            if len(built_files) != 1:
+                result = 1
+                output += 'aapt2 wrote ' + str(len(built_files)) + \
+                    ' files\n'
+            else:
+                os.rename(os.path.join(temporary_directory, built_files[0]),
+                          flat_file)
+    except Exception as e:
+        result, output = 1, str(e) + '\n'
+    finally:
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+    return relative_path, result, output
+
+
+def _compileResources(aapt2_program, res_directory, compiled_directory):
+    """
+    Compiles the resource files that changed since the last build.
+
+    The compiled file of each resource is kept in the compiled directory
+    named by the hash of its path and contents, so only new and modified
+    resources are compiled, on a pool of worker threads.
+
+    Args:
+    aapt2_program: The path to the aapt2 program.
+    res_directory: The resources directory.
+    compiled_directory: The directory to keep the compiled files in.
+    Returns:
+    A tuple of the return code of the first failing compile, or 0, and a
+    sorted list of the compiled files of every resource.
+    """
+    if not os.path.exists(compiled_directory):
+        os.makedirs(compiled_directory)
+    index = files.loadJson(os.path.join(compiled_directory, index_file), {})
+    if index.get('version') != index_version:
+        index = {'version': index_version, 'resources': {}}
+    resources = _hashResources(res_directory, index['resources'])
+    jobs = []
+    flat_files = []
+    step = tracing.currentStep()
+    for relative_path in sorted(resources):
+        key = hashlib.sha1(relative_path + '\0' +
+                           resources[relative_path][2]).hexdigest()
+        flat_file = os.path.join(compiled_directory, key + '.flat')
+        flat_files.append(flat_file)
+        if not os.path.exists(flat_file):
+            jobs.append((relative_path, aapt2_program, res_directory,
+                         flat_file, step))
+    print 'Compiling ' + str(len(jobs)) + ' of ' + str(len(resources)) + \
+        ' resources...'
+    result = 0
+    if len(jobs) > 0:
+        pool = ThreadPool(min(multiprocessing.cpu_count(), len(jobs)))
+        try:
+            for relative_path, resource_result, output in \
+                    pool.imap_unordered(_compileResource, jobs):
+                for line in output.splitlines():
+                    print '[' + relative_path + '] ' + line
+                if resource_result != 0:
+                    print 'Failed to compile resource ' + relative_path
+                    result = resource_result
+        finally:
+            pool.close()
+            pool.join()
+    if result != 0:
+        return result, flat_files
+    # Remove the compiled files of resources that changed or were deleted
+    for filename in os.listdir(compiled_directory):
+        flat_file = os.path.join(compiled_directory, filename)
+        if os.path.splitext(filename)[1] == '.flat' and \
+                flat_file not in flat_files:
+            os.remove(flat_file)
+    files.saveJson(os.path.join(compiled_directory, index_file),
+                   {'version': index_version, 'resources': resources})
+    return result, flat_files
+
+
+def link(build_tools_folder, manifest_file, res_directory, android_jar_file,
+         compiled_directory, resources_file, r_directory, rename=None):
+    """
+    Compiles the resources once into a resources archive and R.java, which
+    are used both to compile the java sources and to package the APK.
+
+    With aapt2 each resource file is compiled on its own and only changed
+    files are compiled again before the compiled files are linked. Older
+    build tools without aapt2 create the archive and R.java in a single
+    aapt package run.
+
+    Args:
+    build_tools_folder: The build tools folder.
+    manifest_file: The path to the AndroidManifest.xml.
+    res_directory: The resources directory.
+    android_jar_file: The path to the android.jar of the target.
+    compiled_directory: The directory to keep the compiled resources in.
+    resources_file: The path to write the resources archive to.
+    r_directory: The directory to write R.java to.
+    rename: The package name to rename the manifest package to, or None.
+    Returns:
+    The return code of the first failing tool, or 0.
+    """
+    rename_arguments = []
+    if rename is not None:
+        # Keep R.java in the package the sources import it from
+        rename_arguments = ['--rename-manifest-package', rename,
+                            '--custom-package',
+                            manifestPackage(manifest_file)]
+    aapt2_program = os.path.join(build_tools_folder, 'aapt2')
+    if not os.path.isfile(aapt2_program):
+        aapt_program = os.path.join(build_tools_folder, 'aapt')
+        return cache.call([aapt_program,
+                           'package',
+                           '-f',
+                           '-m',
+                           '-S', res_directory,
+                           '-J', r_directory,
+                           '-M', manifest_file,
+                           '-I', android_jar_file,
+                           '-F', resources_file] + rename_arguments,
+                          [res_directory, manifest_file, android_jar_file],
+                          [resources_file, r_directory])
+    result, flat_files = _compileResources(aapt2_program,
+                                           res_directory,
+                                           compiled_directory)
+    if result != 0:
+        return result
+    print 'Linking resources...'
+    return cache.call([aapt2_program,
+                       'link',
+                       '-o', resources_file,
+                       '-I', android_jar_file,
+                       '--manifest', manifest_file,
+                       '--java', r_directory] + rename_arguments +
+                      flat_files,
+                      flat_files + [manifest_file, android_jar_file],
+                      [resources_file, r_directory])
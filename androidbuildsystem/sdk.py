@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import re
+
+from androidbuildsystem import files
+
+
+index_version = 1
+version_pattern = re.compile(r'\d+')
+_indexes = {}
+
+
+def _readProperties(properties_file):
+    """
+    Reads a java properties file such as source.properties or an AVD ini.
+
+    Args:
+    properties_file: The path to the properties file.
+    Returns:
+    A dictionary of the properties, empty if the file does not exist.
+    """
+    properties = {}
+    if not os.path.isfile(properties_file):
+        return properties
+    with open(properties_file) as properties_f:
+        for line in properties_f:
+            line = line.strip()
+            if line.startswith('#') or '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            properties[key.strip()] = value.strip().replace('\\:', ':')
+    return properties
+
+
+def versionKey(version):
+    """
+    Converts a build tools version such as 23.0.3 into a sortable key.
+
+    Args:
+    version: The version string.
+    Returns:
+    A tuple of the numbers in the version, preview versions sort before
+    their release.
+    """
+    numbers = [int(number) for number in version_pattern.findall(version)]
+    release = 0 if ('-' in version or 'rc' in version) else 1
+    return tuple(numbers[:3] + [0] * (3 - len(numbers[:3])) + [release])
+
+
+def _listDirectories(directory):
+    """
+    Lists the sub directories of a directory.
+
+    Args:
+    directory: The directory to list.
+    Returns:
+    A sorted list of the sub directory names, empty if it does not exist.
+    """
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name for name in os.listdir(directory)
+                  if os.path.isdir(os.path.join(directory, name)))
+
+
+def _directoryMtimes(directory, depth):
+    """
+    Records the modification times of a directory tree to a given depth.
+
+    Args:
+    directory: The directory to stat.
+    depth: How many levels of sub directories to include.
+    Returns:
+    A dictionary of modification times keyed by path, a missing directory is
+    recorded as None.
+    """
+    if not os.path.isdir(directory):
+        return {directory: None}
+    mtimes = {directory: os.path.getmtime(directory)}
+    if depth > 0:
+        for name in _listDirectories(directory):
+            mtimes.update(_directoryMtimes(os.path.join(directory, name),
+                                           depth - 1))
+    return mtimes
+
+
+def _isCurrent(mtimes):
+    """
+    Checks whether recorded directory modification times are still valid.
+
+    Args:
+    mtimes: The dictionary returned by _directoryMtimes.
+    Returns:
+    True if no directory has been added, removed or modified.
+    """
+    for directory, mtime in mtimes.items():
+        if not os.path.isdir(directory):
+            if mtime is not None:
+                return False
+        elif mtime != os.path.getmtime(directory):
+            return False
+    return True
+
+
+def _avdDirectory():
+    """
+    Works out the directory the android tools keep virtual devices in.
+
+    Returns:
+    A string with the path to the AVD directory.
+    """
+    if 'ANDROID_AVD_HOME' in os.environ:
+        return os.environ['ANDROID_AVD_HOME']
+    android_home = os.environ.get('ANDROID_SDK_HOME', os.path.expanduser('~'))
+    return os.path.join(android_home, '.android', 'avd')
+
+
+def _scanPlatforms(sdk_directory):
+    """
+    Scans the platforms installed in the Android SDK.
+
+    Args:
+    sdk_directory: The directory of the Android SDK.
+    Returns:
+    A list of target dictionaries in the same format as the targets parsed
+    from the android tool.
+    """
+    platforms = []
+    platforms_directory = os.path.join(sdk_directory, 'platforms')
+    for name in _listDirectories(platforms_directory):
+        platform_directory = os.path.join(platforms_directory, name)
+        properties = _readProperties(os.path.join(platform_directory,
+                                                  'source.properties'))
+        api_level = properties.get('AndroidVersion.ApiLevel')
+        if api_level is None:
+            api_level = name.split('-')[-1]
+        version = properties.get('Platform.Version', api_level)
+        platforms.append({'identifiers': [name],
+                          'name': 'Android ' + version,
+                          'device_type': 'Platform',
+                          'api_level': api_level,
+                          'revision': properties.get('Pkg.Revision', '1'),
+                          'skins': _listDirectories(os.path.join(
+                              platform_directory, 'skins'))})
+    return platforms
+
+
+def _scanSystemImages(sdk_directory):
+    """
+    Scans the system images installed in the Android SDK.
+
+    Args:
+    sdk_directory: The directory of the Android SDK.
+    Returns:
+    A list of the system images as platform/tag/abi strings.
+    """
+    system_images = []
+    system_images_directory = os.path.join(sdk_directory, 'system-images')
+    for platform in _listDirectories(system_images_directory):
+        platform_directory = os.path.join(system_images_directory, platform)
+        for tag in _listDirectories(platform_directory):
+            for abi in _listDirectories(os.path.join(platform_directory, tag)):
+                system_images.append('/'.join([platform, tag, abi]))
+    return system_images
+
+
+def _scanVirtualDevices(avd_directory):
+    """
+    Scans the virtual devices that have been created.
+
+    Args:
+    avd_directory: The directory the virtual devices are kept in.
+    Returns:
+    A dictionary of the virtual device targets keyed by name.
+    """
+    virtual_devices = {}
+    if not os.path.isdir(avd_directory):
+        return virtual_devices
+    for filename in sorted(os.listdir(avd_directory)):
+        name, extension = os.path.splitext(filename)
+        if extension != '.ini':
+            continue
+        properties = _readProperties(os.path.join(avd_directory, filename))
+        virtual_devices[name] = properties.get('target')
+    return virtual_devices
+
+
+def loadIndex(sdk_directory):
+    """
+    Loads the index of an Android SDK, rescanning any part that has changed.
+
+    The index is kept in the user directory and each part of it is
+    invalidated by the modification times of the directories it was scanned
+    from, so a warm lookup costs a handful of stat calls. The index is also
+    kept in memory so later builds in the same process, such as rebuilds in
+    watch mode, do not read it again.
+
+    Args:
+    sdk_directory: The directory of the Android SDK.
+    Returns:
+    A dictionary containing the platforms, build tools versions, system
+    images and virtual devices of the SDK.
+    """
+    sdk_directory = os.path.abspath(sdk_directory)
+    sdk_hash = hashlib.sha1(sdk_directory).hexdigest()
+    index_file = files.userDirectory('sdk', sdk_hash + '.json')
+    index = _indexes.get(sdk_directory)
+    if index is None:
+        index = files.loadJson(index_file, {})
+    if index.get('version') != index_version or \
+            index.get('sdk') != sdk_directory:
+        index = {'version': index_version, 'sdk': sdk_directory}
+    avd_directory = _avdDirectory()
+    scanners = [('platforms',
+                 os.path.join(sdk_directory, 'platforms'), 1,
+                 lambda: _scanPlatforms(sdk_directory)),
+                ('build_tools',
+                 os.path.join(sdk_directory, 'build-tools'), 0,
+                 lambda: sorted(_listDirectories(os.path.join(sdk_directory,
+                                                              'build-tools')),
+                                key=versionKey)),
+                ('system_images',
+                 os.path.join(sdk_directory, 'system-images'), 3,
+                 lambda: _scanSystemImages(sdk_directory)),
+                ('virtual_devices', avd_directory, 0,
+                 lambda: _scanVirtualDevices(avd_directory))]
+    changed = False
+    for key, directory, depth, scanner in scanners:
+        part = index.get(key)
+        if part is not None and part['directory'] == directory and \
+                _isCurrent(part['mtimes']):
+            continue
+        index[key] = {'directory': directory,
+                      'mtimes': _directoryMtimes(directory, depth),
+                      'entries': scanner()}
+        changed = True
+    if changed:
+        files.saveJson(index_file, index)
+    _indexes[sdk_directory] = index
+    return index
+
+
+def findPlatform(index, target):
+    """
+    Looks up a target in the SDK index.
+
+    Args:
+    index: The dictionary returned by loadIndex.
+    target: The target identifier, such as android-23.
+    Returns:
+    The target dictionary, or None if the platform is not installed.
+    """
+    for platform in index['platforms']['entries']:
+        if target in platform['identifiers']:
+            return platform
+    return None
+
+
+def findBuildTools(index, api_level):
+    """
+    Picks the highest build tools revision matching an API level.
+
+    Args:
+    index: The dictionary returned by loadIndex.
+    api_level: The API level of the target as a string.
+    Returns:
+    A string with the absolute path to the build tools folder, or None if
+    no build tools with a matching major version are installed.
+    """
+    for version in reversed(index['build_tools']['entries']):
+        if version.split('.')[0] == api_level:
+            return os.path.join(index['build_tools']['directory'], version)
+    return None
+
+
+def virtualDevices(index):
+    """
+    Lists the virtual devices in the SDK index.
+
+    Args:
+    index: The dictionary returned by loadIndex.
+    Returns:
+    A list of the virtual device names, or None if the AVD directory does
+    not exist and the android tool has to be asked instead.
+    """
+    if not os.path.isdir(index['virtual_devices']['directory']):
+        return None
+    return sorted(index['virtual_devices']['entries'].keys())
@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import binascii
+import hashlib
+import os
+import struct
+
+
+jks_magic = 0xfeedfeed
+jks_private_key_tag = 1
+jks_integrity_salt = 'Mighty Aphrodite'
+# The proprietary Sun key protection algorithm used by JKS keystores
+jks_key_protector_oid = binascii.unhexlify('2b060104012a02110101')
+sha1_algorithm = binascii.unhexlify('300906052b0e03021a0500')
+sha256_algorithm = binascii.unhexlify('300d06096086480165030402010500')
+rsa_algorithm = binascii.unhexlify('300d06092a864886f70d0101010500')
+signed_data_oid = binascii.unhexlify('06092a864886f70d010702')
+data_oid = binascii.unhexlify('06092a864886f70d010701')
+sha1_digest_info = binascii.unhexlify('3021300906052b0e03021a05000414')
+sha256_digest_info = binascii.unhexlify(
+    '3031300d060960864801650304020105000420')
+# Keyed by the names used in JAR manifest attributes and by jarsigner
+digest_algorithms = {'SHA1': {'hash': hashlib.sha1,
+                              'algorithm': sha1_algorithm,
+                              'digest_info': sha1_digest_info,
+                              'signature': 'SHA1withRSA'},
+                     'SHA-256': {'hash': hashlib.sha256,
+                                 'algorithm': sha256_algorithm,
+                                 'digest_info': sha256_digest_info,
+                                 'signature': 'SHA256withRSA'}}
+# Android only verifies SHA-256 v1 signatures from API level 18
+sha256_min_sdk_version = 18
+v2_block_id = 0x7109871a
+v2_rsa_pkcs1_sha256 = 0x0103
+v2_chunk_size = 1024 * 1024
+signing_block_magic = 'APK Sig Block 42'
+_keys = {}
+
+
+def _derRead(data, offset):
+    """
+    Reads a DER value.
+
+    Args:
+    data: The DER encoded data.
+    offset: The offset of the value.
+    Returns:
+    A tuple of the tag, the offset of the contents and the offset after the
+    value.
+    """
+    tag = ord(data[offset])
+    length = ord(data[offset + 1])
+    offset += 2
+    if length & 0x80:
+        length_size = length & 0x7f
+        length = int(binascii.hexlify(data[offset:offset + length_size]), 16)
+        offset += length_size
+    return tag, offset, offset + length
+
+
+def _derChildren(data, offset=0):
+    """
+    Reads the values inside a DER sequence or set.
+
+    Args:
+    data: The DER encoded data.
+    offset: The offset of the sequence or set.
+    Returns:
+    A list of tuples of the tag, the offset of the value, the offset of its
+    contents and the offset after it.
+    """
+    tag, start, end = _derRead(data, offset)
+    children = []
+    while start < end:
+        child_tag, child_contents, child_end = _derRead(data, start)
+        children.append((child_tag, start, child_contents, child_end))
+        start = child_end
+    return children
+
+
+def _derInteger(data, offset):
+    """
+    Reads a DER integer.
+
+    Returns:
+    The integer as a long.
+    """
+    tag, start, end = _derRead(data, offset)
+    return long(binascii.hexlify(data[start:end]), 16)
+
+
+def _der(tag, contents):
+    """
+    Encodes a DER value.
+
+    Args:
+    tag: The tag of the value.
+    contents: The encoded contents.
+    Returns:
+    The DER encoded value.
+    """
+    length = len(contents)
+    if length < 0x80:
+        return chr(tag) + chr(length) + contents
+    length_bytes = ''
+    while length:
+        length_bytes = chr(length & 0xff) + length_bytes
+        length >>= 8
+    return chr(tag) + chr(0x80 | len(length_bytes)) + length_bytes + contents
+
+
+def _password(password):
+    """
+    Encodes a password the way Java keystores hash it.
+    """
+    return password.decode('utf-8').encode('utf-16-be')
+
+
+def _readUtf(data, offset):
+    """
+    Reads a length prefixed modified UTF-8 string from a keystore.
+
+    Returns:
+    A tuple of the string and the offset after it.
+    """
+    length, = struct.unpack('>H', data[offset:offset + 2])
+    return data[offset + 2:offset + 2 + length], offset + 2 + length
+
+
+def _readJks(data, storepass):
+    """
+    Reads the private key entries of a JKS keystore.
+
+    Args:
+    data: The contents of the keystore.
+    storepass: The keystore password, used to check its integrity.
+    Returns:
+    A dictionary of tuples of the protected key and the certificate chain
+    keyed by lower case alias.
+    """
+    magic, version, count = struct.unpack('>III', data[:12])
+    if magic != jks_magic or version != 2:
+        raise ValueError('Not a JKS keystore')
+    digest = hashlib.sha1(_password(storepass) + jks_integrity_salt +
+                          data[:-20]).digest()
+    if digest != data[-20:]:
+        raise ValueError('Keystore password is incorrect')
+    entries = {}
+    offset = 12
+    for index in range(count):
+        tag, = struct.unpack('>I', data[offset:offset + 4])
+        alias, offset = _readUtf(data, offset + 4)
+        offset += 8
+        if tag == jks_private_key_tag:
+            length, = struct.unpack('>I', data[offset:offset + 4])
+            protected_key = data[offset + 4:offset + 4 + length]
+            offset += 4 + length
+            chain_length, = struct.unpack('>I', data[offset:offset + 4])
+            offset += 4
+            chain = []
+            for chain_index in range(chain_length):
+                certificate_type, offset = _readUtf(data, offset)
+                length, = struct.unpack('>I', data[offset:offset + 4])
+                chain.append(data[offset + 4:offset + 4 + length])
+                offset += 4 + length
+            entries[alias.lower()] = (protected_key, chain)
+        else:
+            certificate_type, offset = _readUtf(data, offset)
+            length, = struct.unpack('>I', data[offset:offset + 4])
+            offset += 4 + length
+    return entries
+
+
+def _unprotectKey(protected_key, keypass):
+    """
+    Decrypts a private key protected with the JKS key protector.
+
+    Args:
+    protected_key: The encrypted private key info of a keystore entry.
+    keypass: The key password.
+    Returns:
+    The PKCS#8 encoded private key.
+    """
+    algorithm, encrypted = _derChildren(protected_key)
+    algorithm_oid = _derChildren(protected_key[algorithm[1]:algorithm[3]])[0]
+    if protected_key[algorithm[1]:algorithm[3]][
+            algorithm_oid[2]:algorithm_oid[3]] != jks_key_protector_oid:
+        raise ValueError('Unsupported key protection algorithm')
+    encrypted = protected_key[encrypted[2]:encrypted[3]]
+    salt = encrypted[:20]
+    check = encrypted[-20:]
+    encrypted = encrypted[20:-20]
+    password = _password(keypass)
+    key_stream = []
+    digest = salt
+    while len(key_stream) * 20 < len(encrypted):
+        digest = hashlib.sha1(password + digest).digest()
+        key_stream.append(digest)
+    key_stream = ''.join(key_stream)
+    plain_key = ''.join(chr(ord(a) ^ ord(b))
+                        for a, b in zip(encrypted, key_stream))
+    if hashlib.sha1(password + plain_key).digest() != check:
+        raise ValueError('Key password is incorrect')
+    return plain_key
+
+
+def _certificateFields(certificate):
+    """
+    Reads the fields of a certificate needed to sign with it.
+
+    Args:
+    certificate: The DER encoded X.509 certificate.
+    Returns:
+    A tuple of the encoded issuer, serial number and subject public key info.
+    """
+    tbs_certificate = _derChildren(certificate)[0]
+    tbs_certificate = certificate[tbs_certificate[1]:tbs_certificate[3]]
+    fields = _derChildren(tbs_certificate)
+    if fields[0][0] == 0xa0:
+        # Skip the explicit version
+        fields = fields[1:]
+    serial = tbs_certificate[fields[0][1]:fields[0][3]]
+    issuer = tbs_certificate[fields[2][1]:fields[2][3]]
+    public_key = tbs_certificate[fields[5][1]:fields[5][3]]
+    return issuer, serial, public_key
+
+
+def loadKey(keystore_file, storepass, keypass, key_alias):
+    """
+    Loads an RSA signing key from a JKS keystore, keeping it for the rest of
+    the process so repeated builds only read the keystore once.
+
+    Args:
+    keystore_file: The path to the keystore.
+    storepass: The keystore password.
+    keypass: The key password.
+    key_alias: The alias of the key in the keystore.
+    Returns:
+    A dictionary with the RSA key numbers and the encoded signing
+    certificate, its issuer, serial number and public key.
+    """
+    keystore_stat = os.stat(keystore_file)
+    memo_key = (keystore_file, keystore_stat.st_size, keystore_stat.st_mtime,
+                key_alias)
+    if memo_key in _keys:
+        return _keys[memo_key]
+    with open(keystore_file, 'rb') as f:
+        keystore = f.read()
+    try:
+        entries = _readJks(keystore, storepass)
+        if key_alias.lower() not in entries:
+            raise ValueError('Keystore has no key named ' + key_alias)
+        protected_key, chain = entries[key_alias.lower()]
+        private_key_info = _unprotectKey(protected_key, keypass)
+        algorithm, private_key = _derChildren(private_key_info)[1:3]
+        if private_key_info[algorithm[1]:algorithm[3]] != rsa_algorithm:
+            raise ValueError('Only RSA keys are supported')
+        private_key = private_key_info[private_key[2]:private_key[3]]
+        numbers = [_derInteger(private_key, child[1])
+                   for child in _derChildren(private_key)]
+        issuer, serial, public_key = _certificateFields(chain[0])
+        key = {'n': numbers[1],
+               'd': numbers[3],
+               'p': numbers[4],
+               'q': numbers[5],
+               'dp': numbers[6],
+               'dq': numbers[7],
+               'qinv': numbers[8],
+               'size': (len('%x' % numbers[1]) + 1) // 2,
+               'certificate': chain[0],
+               'issuer': issuer,
+               'serial': serial,
+               'public_key': public_key}
+    except (IndexError, struct.error):
+        raise ValueError('Keystore is corrupt')
+    _keys[memo_key] = key
+    return key
+
+
+def v1DigestAlgorithm(min_sdk_version):
+    """
+    Chooses the digest algorithm of v1 signatures the way apksigner does.
+
+    Args:
+    min_sdk_version: The minimum API level of the app, None for a preview.
+    Returns:
+    SHA1 if devices older than API level 18 have to verify the signature,
+    otherwise SHA-256.
+    """
+    if min_sdk_version is not None and \
+            min_sdk_version < sha256_min_sdk_version:
+        return 'SHA1'
+    return 'SHA-256'
+
+
+def _sign(key, data, digest_algorithm='SHA-256'):
+    """
+    Signs data with RSASSA-PKCS1-v1_5.
+
+    Args:
+    key: A key returned by loadKey.
+    data: The data to sign.
+    digest_algorithm: The name of the digest algorithm, SHA1 or SHA-256.
+    Returns:
+    The signature.
+    """
+    algorithm = digest_algorithms[digest_algorithm]
+    digest_info = algorithm['digest_info'] + \
+        algorithm['hash'](data).digest()
+    padding = '\xff' * (key['size'] - len(digest_info) - 3)
+    message = long(binascii.hexlify('\x00\x01' + padding + '\x00' +
+                                    digest_info), 16)
+    # Chinese remainder theorem
+    m1 = pow(message % key['p'], key['dp'], key['p'])
+    m2 = pow(message % key['q'], key['dq'], key['q'])
+    h = (key['qinv'] * (m1 - m2)) % key['p']
+    signature = m2 + h * key['q']
+    return binascii.unhexlify('%0*x' % (key['size'] * 2, signature))
+
+
+def _signatureFile(manifest, v2, digest_algorithm='SHA-256'):
+    """
+    Creates the v1 signature file from the manifest.
+
+    Args:
+    manifest: The contents of the manifest.
+    v2: Whether the APK also has a v2 signature, which stops the v2
+    signature from being stripped.
+    digest_algorithm: The name of the digest algorithm of the manifest.
+    Returns:
+    The contents of the signature file.
+    """
+    digest = digest_algorithms[digest_algorithm]['hash']
+    signature_file = 'Signature-Version: 1.0\r\n'
+    signature_file += 'Created-By: androidbuildsystem\r\n'
+    signature_file += digest_algorithm + '-Digest-Manifest: ' + \
+        base64.b64encode(digest(manifest).digest()) + '\r\n'
+    if v2:
+        signature_file += 'X-Android-APK-Signed: 2\r\n'
+    signature_file += '\r\n'
+    sections = manifest.split('\r\n\r\n')
+    for section in sections[1:]:
+        if not section:
+            continue
+        section += '\r\n\r\n'
+        name = section.split('\r\n' + digest_algorithm + '-Digest:')[0]
+        signature_file += name + '\r\n'
+        signature_file += digest_algorithm + '-Digest: ' + \
+            base64.b64encode(digest(section).digest()) + '\r\n\r\n'
+    return signature_file
+
+
+def _signatureBlock(key, signature_file, digest_algorithm='SHA-256'):
+    """
+    Creates the PKCS#7 signature block of the v1 signature file.
+
+    Args:
+    key: A key returned by loadKey.
+    signature_file: The contents of the signature file.
+    digest_algorithm: The name of the digest algorithm to sign with.
+    Returns:
+    The DER encoded signature block.
+    """
+    algorithm = digest_algorithms[digest_algorithm]['algorithm']
+    signer_info = _der(0x30,
+                       _der(0x02, '\x01') +
+                       _der(0x30, key['issuer'] + key['serial']) +
+                       algorithm +
+                       rsa_algorithm +
+                       _der(0x04, _sign(key, signature_file,
+                                        digest_algorithm)))
+    signed_data = _der(0x30,
+                       _der(0x02, '\x01') +
+                       _der(0x31, algorithm) +
+                       _der(0x30, data_oid) +
+                       _der(0xa0, key['certificate']) +
+                       _der(0x31, signer_info))
+    return _der(0x30, signed_data_oid + _der(0xa0, signed_data))
+
+
+def v1Signer(key, v2=False, digest_algorithm='SHA-256'):
+    """
+    Creates a signer adding the v1 (JAR) signature files to an APK.
+
+    Args:
+    key: A key returned by loadKey.
+    v2: Whether the APK is also signed with the v2 scheme.
+    digest_algorithm: The name of the digest algorithm of the manifest, as
+    returned by v1DigestAlgorithm.
+    Returns:
+    A signer function for ApkWriter.close.
+    """
+    def signer(manifest):
+        signature_file = _signatureFile(manifest, v2, digest_algorithm)
+        return [('META-INF/MANIFEST.MF', manifest),
+                ('META-INF/CERT.SF', signature_file),
+                ('META-INF/CERT.RSA', _signatureBlock(key, signature_file,
+                                                      digest_algorithm))]
+    return signer
+
+
+def _lengthPrefixed(data):
+    """
+    Prefixes data with its 32 bit length.
+    """
+    return struct.pack('<I', len(data)) + data
+
+
+def contentDigest(sections):
+    """
+    Works out the v2 digest of the contents of an APK.
+
+    Each section is split into 1MB chunks which are digested separately and
+    the chunk digests are digested together.
+
+    Args:
+    sections: A list of functions, one per section, each returning the next
+    chunk of the section given the chunk size, or an empty string once the
+    section is exhausted.
+    Returns:
+    The SHA-256 content digest.
+    """
+    chunk_digests = []
+    for read in sections:
+        chunk = read(v2_chunk_size)
+        while chunk:
+            chunk_digests.append(
+                hashlib.sha256('\xa5' + struct.pack('<I', len(chunk)) +
+                               chunk).digest())
+            chunk = read(v2_chunk_size)
+    return hashlib.sha256('\x5a' + struct.pack('<I', len(chunk_digests)) +
+                          ''.join(chunk_digests)).digest()
+
+
+def v2Signer(key):
+    """
+    Creates a signer producing the APK signing block of the v2 scheme.
+
+    Args:
+    key: A key returned by loadKey.
+    Returns:
+    A function taking the content digest returned by contentDigest and
+    returning the APK signing block.
+    """
+    def signer(content_digest):
+        digest = _lengthPrefixed(struct.pack('<I', v2_rsa_pkcs1_sha256) +
+                                 _lengthPrefixed(content_digest))
+        signed_data = _lengthPrefixed(digest) + \
+            _lengthPrefixed(_lengthPrefixed(key['certificate'])) + \
+            _lengthPrefixed('')
+        signature = _lengthPrefixed(struct.pack('<I', v2_rsa_pkcs1_sha256) +
+                                    _lengthPrefixed(_sign(key, signed_data)))
+        signer_block = _lengthPrefixed(signed_data) + \
+            _lengthPrefixed(signature) + \
+            _lengthPrefixed(key['public_key'])
+        value = _lengthPrefixed(_lengthPrefixed(signer_block))
+        pair = struct.pack('<QI', 4 + len(value), v2_block_id) + value
+        block_size = len(pair) + 8 + len(signing_block_magic)
+        return struct.pack('<Q', block_size) + pair + \
+            struct.pack('<Q', block_size) + signing_block_magic
+    return signer
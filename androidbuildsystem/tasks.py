@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import Queue
+import sys
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from androidbuildsystem import process
+from androidbuildsystem import tracing
+
+
+settings = {'jobs': multiprocessing.cpu_count()}
+
+
+def configure(jobs):
+    """
+    Sets how many build tasks can run at the same time.
+
+    Args:
+    jobs: The number of tasks to run concurrently, None for one per CPU.
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    settings['jobs'] = max(int(jobs), 1)
+
+
+def task(name, step, run, inputs=(), outputs=()):
+    """
+    Describes a build task.
+
+    Args:
+    name: The name of the task.
+    step: The build step the task belongs to.
+    run: A function taking a dictionary of the values of the inputs of the
+    task and returning a dictionary of the values of its outputs, or None
+    when its outputs have no value.
+    inputs: A list of the names of the values the task reads.
+    outputs: A list of the names of the values the task writes.
+    Returns:
+    A task dictionary.
+    """
+    return {'name': name,
+            'step': step,
+            'run': run,
+            'inputs': list(inputs),
+            'outputs': list(outputs),
+            'depends_on': set(),
+            'start': None,
+            'end': None}
+
+
+def _link(graph):
+    """
+    Works out the tasks each task depends on from the values it reads, and
+    orders the tasks so that every task comes after the tasks it depends on.
+
+    Args:
+    graph: A list of tasks.
+    Returns:
+    The list of tasks in dependency order.
+    """
+    producers = {}
+    for build_task in graph:
+        for output in build_task['outputs']:
+            if output in producers:
+                raise ValueError('Tasks ' + producers[output] + ' and ' +
+                                 build_task['name'] + ' both write ' + output)
+            producers[output] = build_task['name']
+    for build_task in graph:
+        build_task['depends_on'] = set()
+        for task_input in build_task['inputs']:
+            if task_input not in producers:
+                raise ValueError('No task writes ' + task_input +
+                                 ', which task ' + build_task['name'] +
+                                 ' reads')
+            build_task['depends_on'].add(producers[task_input])
+    ordered = []
+    names = set()
+    remaining = list(graph)
+    while len(remaining) > 0:
+        ready = [build_task for build_task in remaining
+                 if build_task['depends_on'].issubset(names)]
+        if len(ready) == 0:
+            raise ValueError('Tasks depend on each other: ' +
+                             ', '.join(build_task['name']
+                                       for build_task in remaining))
+        for build_task in ready:
+            ordered.append(build_task)
+            names.add(build_task['name'])
+            remaining.remove(build_task)
+    return ordered
+
+
+def _runTask(job):
+    """
+    Runs a task on a worker thread, capturing its output.
+
+    Args:
+    job: A tuple of the task, the values of its inputs and the output
+    stream.
+    Returns:
+    A tuple of the task name, the exit status, the values of its outputs,
+    its start and end times and the captured output.
+    """
+    build_task, values, output = job
+    output.capture()
+    status = 0
+    results = None
+    start = tracing.now()
+    try:
+        with tracing.inStep(build_task['step']), process.redirectOutput():
+            results = build_task['run'](values)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+        status = 1
+    end = tracing.now()
+    with tracing.inStep(build_task['step']):
+        tracing.record(build_task['name'], 'task', start, end - start)
+    return build_task['name'], status, results or {}, start, end, \
+        output.release()
+
+
+def _recordSteps(graph):
+    """
+    Records a trace event for each build step, from the start of its first
+    task to the end of its last task.
+
+    Steps overlap when their tasks run at the same time, so each event also
+    records the busy time of the step, the sum of the times of its tasks.
+
+    Args:
+    graph: The list of tasks that were run.
+    """
+    steps = {}
+    for build_task in graph:
+        if build_task['start'] is None:
+            continue
+        start, end, busy = steps.get(build_task['step'],
+                                     (build_task['start'],
+                                      build_task['end'],
+                                      0))
+        steps[build_task['step']] = (min(start, build_task['start']),
+                                     max(end, build_task['end']),
+                                     busy + build_task['end'] -
+                                     build_task['start'])
+    for step in sorted(steps, key=lambda step: steps[step][0]):
+        start, end, busy = steps[step]
+        tracing.record(step, 'step', start, end - start, {'busy': busy})
+
+
+def run(graph, jobs=None):
+    """
+    Runs build tasks on a pool of worker threads, starting each task once
+    the tasks writing the values it reads have finished.
+
+    The output of each task is printed when it finishes. When a task fails
+    no more tasks are started, and once the running tasks have finished the
+    build exits with the status of the failed task.
+
+    Args:
+    graph: A list of tasks.
+    jobs: The number of tasks to run at once, None for the configured
+    number.
+    Returns:
+    A dictionary of the values written by the tasks.
+    """
+    graph = _link(graph)
+    if jobs is None:
+        jobs = settings['jobs']
+    tasks_by_name = dict((build_task['name'], build_task)
+                         for build_task in graph)
+    completed = Queue.Queue()
+    pool = ThreadPool(max(min(int(jobs), len(graph)), 1))
+    values = {}
+    finished = set()
+    running = set()
+    status = 0
+    # Modules built at the same time already capture their output
+    stream = output = sys.stdout
+    if not isinstance(stream, process.ThreadOutput):
+        output = process.ThreadOutput(stream)
+        sys.stdout = output
+    try:
+        while True:
+            for build_task in graph:
+                if status != 0:
+                    break
+                if build_task['name'] in finished or \
+                        build_task['name'] in running or \
+                        not build_task['depends_on'].issubset(finished):
+                    continue
+                running.add(build_task['name'])
+                task_values = dict((task_input, values[task_input])
+                                   for task_input in build_task['inputs'])
+                pool.apply_async(_runTask,
+                                 ((build_task, task_values, output),),
+                                 callback=completed.put)
+            if len(running) == 0:
+                break
+            # A timeout keeps the wait interruptible with Ctrl-C
+            name, task_status, results, start, end, task_output = \
+                completed.get(True, 86400)
+            running.remove(name)
+            finished.add(name)
+            tasks_by_name[name]['start'] = start
+            tasks_by_name[name]['end'] = end
+            for task_output_name in tasks_by_name[name]['outputs']:
+                values[task_output_name] = results.get(task_output_name)
+            sys.stdout.write(task_output)
+            sys.stdout.flush()
+            if task_status != 0 and status == 0:
+                status = task_status
+    finally:
+        if output is not stream:
+            sys.stdout = stream
+        pool.close()
+        pool.join()
+    _recordSteps(graph)
+    if status != 0:
+        sys.exit(status)
+    return values
+
+
+def criticalPath(graph):
+    """
+    Works out the chain of dependent tasks that took the longest, which is
+    the chain that has to get faster for the build to get faster.
+
+    Args:
+    graph: The list of tasks that were run.
+    Returns:
+    A list of the tasks on the critical path in the order they ran.
+    """
+    graph = _link(graph)
+    tasks_by_name = dict((build_task['name'], build_task)
+                         for build_task in graph)
+    finish = {}
+    previous = {}
+    for build_task in graph:
+        if build_task['start'] is None:
+            continue
+        slowest = None
+        for dependency in build_task['depends_on']:
+            if dependency in finish and \
+                    (slowest is None or finish[dependency] > finish[slowest]):
+                slowest = dependency
+        finish[build_task['name']] = build_task['end'] - build_task['start']
+        if slowest is not None:
+            finish[build_task['name']] += finish[slowest]
+        previous[build_task['name']] = slowest
+    if len(finish) == 0:
+        return []
+    path = []
+    name = max(finish, key=lambda name: finish[name])
+    while name is not None:
+        path.append(tasks_by_name[name])
+        name = previous[name]
+    path.reverse()
+    return path
+
+
+def printCriticalPath(graph):
+    """
+    Prints the tasks on the critical path of the build, and how much time
+    running tasks at the same time saved.
+
+    Args:
+    graph: The list of tasks that were run.
+    """
+    path = criticalPath(graph)
+    ran = [build_task for build_task in graph
+           if build_task['start'] is not None]
+    if len(ran) == 0:
+        return
+    wall = max(build_task['end'] for build_task in ran) - \
+        min(build_task['start'] for build_task in ran)
+    total = sum(build_task['end'] - build_task['start']
+                for build_task in ran)
+    length = sum(build_task['end'] - build_task['start']
+                 for build_task in path)
+    print ''
+    print 'Critical path: ' + '%.3f' % (length / 1e6) + 's of ' + \
+        '%.3f' % (wall / 1e6) + 's'
+    for build_task in path:
+        print '%-10s %-24s %10.3fs' % (build_task['step'][:10],
+                                       build_task['name'][:24],
+                                       (build_task['end'] -
+                                        build_task['start']) / 1e6)
+    print 'Tasks off the critical path:'
+    on_path = set(build_task['name'] for build_task in path)
+    for build_task in ran:
+        if build_task['name'] not in on_path:
+            print '%-10s %-24s %10.3fs' % (build_task['step'][:10],
+                                           build_task['name'][:24],
+                                           (build_task['end'] -
+                                            build_task['start']) / 1e6)
+    print 'Time saved by running tasks at the same time: ' + \
+        '%.3f' % (max(total - wall, 0) / 1e6) + 's'
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+settings = {'enabled': False}
+events = []
+_events_lock = threading.Lock()
+_steps = threading.local()
+
+
+def enable():
+    """
+    Starts recording trace events.
+    """
+    settings['enabled'] = True
+
+
+def now():
+    """
+    Gets the current time in trace event units.
+
+    Returns:
+    The current time in microseconds.
+    """
+    return int(time.time() * 1000000)
+
+
+def currentStep():
+    """
+    Gets the build step running on this thread.
+
+    Returns:
+    The name of the innermost step, or None outside of a step.
+    """
+    stack = getattr(_steps, 'stack', [])
+    if len(stack) == 0:
+        return None
+    return stack[-1]
+
+
+def record(name, category, start, duration, arguments=None):
+    """
+    Records a complete trace event.
+
+    Args:
+    name: The name of the event.
+    category: The category of the event, such as step, tool or hook.
+    start: The start time in microseconds.
+    duration: The duration in microseconds.
+    arguments: A dictionary of extra values to show with the event.
+    """
+    if not settings['enabled']:
+        return
+    event_arguments = {'step': currentStep()}
+    if arguments is not None:
+        event_arguments.update(arguments)
+    with _events_lock:
+        events.append({'name': name,
+                       'cat': category,
+                       'ph': 'X',
+                       'ts': start,
+                       'dur': duration,
+                       'pid': os.getpid(),
+                       'tid': threading.current_thread().ident,
+                       'args': event_arguments})
+
+
+@contextlib.contextmanager
+def inStep(name):
+    """
+    Attributes the events recorded by this thread in a block to a step
+    without recording the block itself, for work handed to other threads.
+
+    Args:
+    name: The name of the step.
+    """
+    stack = getattr(_steps, 'stack', None)
+    if stack is None:
+        stack = _steps.stack = []
+    stack.append(name)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+def write(trace_file):
+    """
+    Writes the recorded events as a Chrome trace_event JSON file.
+
+    Args:
+    trace_file: The path to write the trace to.
+    """
+    with open(trace_file, 'w') as trace_f:
+        json.dump({'traceEvents': events,
+                   'displayTimeUnit': 'ms'},
+                  trace_f)
+    print 'Trace written to ' + trace_file
+
+
+def printSummary():
+    """
+    Prints a table of the time spent in every tool and hook by build step.
+    """
+    if not settings['enabled']:
+        return
+    rows = {}
+    for event in events:
+        if event['cat'] in ['step', 'task']:
+            continue
+        key = (event['args']['step'] or '-', event['name'])
+        row = rows.setdefault(key, {'count': 0,
+                                    'wall': 0,
+                                    'cpu': 0.0,
+                                    'rss': 0})
+        row['count'] += 1
+        row['wall'] += event['dur']
+        row['cpu'] += event['args'].get('cpu', 0.0)
+        row['rss'] = max(row['rss'], event['args'].get('max_rss_kb', 0))
+    print ''
+    print '%-10s %-24s %5s %10s %10s %12s' % ('Step', 'Program', 'Runs',
+                                               'Wall (s)', 'CPU (s)',
+                                               'Peak RSS (KB)')
+    for key in sorted(rows, key=lambda key: -rows[key]['wall']):
+        row = rows[key]
+        print '%-10s %-24s %5d %10.3f %10.3f %12d' % (key[0][:10],
+                                                       key[1][:24],
+                                                       row['count'],
+                                                       row['wall'] / 1e6,
+                                                       row['cpu'],
+                                                       row['rss'])
+    for event in events:
+        if event['cat'] == 'step':
+            line = 'Step ' + event['name'] + ': ' + \
+                '%.3f' % (event['dur'] / 1e6) + 's'
+            if 'busy' in event['args']:
+                line += ' (tasks busy ' + \
+                    '%.3f' % (event['args']['busy'] / 1e6) + 's)'
+            print line
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+
+poll_interval = 0.5
+in_modify = 0x00000002
+in_attrib = 0x00000004
+in_close_write = 0x00000008
+in_moved_from = 0x00000040
+in_moved_to = 0x00000080
+in_create = 0x00000100
+in_delete = 0x00000200
+in_delete_self = 0x00000400
+in_move_self = 0x00000800
+in_q_overflow = 0x00004000
+in_ignored = 0x00008000
+in_isdir = 0x40000000
+in_nonblock = os.O_NONBLOCK
+in_cloexec = 0o2000000
+watch_mask = in_modify | in_attrib | in_close_write | in_moved_from | \
+    in_moved_to | in_create | in_delete | in_delete_self | in_move_self
+event_header = struct.Struct('iIII')
+
+
+def _loadLibc():
+    """
+    Loads the C library if it provides inotify.
+
+    Returns:
+    The C library, or None if inotify is not available.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    return libc
+
+
+def _inotifyReader(directory, paths):
+    """
+    Watches paths with inotify.
+
+    Directories are watched recursively and files are watched through the
+    directory containing them, so that editors replacing the file are seen.
+
+    Args:
+    directory: The directory the paths are relative to.
+    paths: A list of the files and directories to watch.
+    Returns:
+    A function taking a timeout in seconds (None to wait forever) and
+    returning the set of paths changed before it, or None if inotify is not
+    available.
+    """
+    libc = _loadLibc()
+    if libc is None:
+        return None
+    fd = libc.inotify_init1(in_nonblock | in_cloexec)
+    if fd < 0:
+        return None
+    watches = {}
+    watched_files = set()
+
+    def addWatch(path, recursive):
+        wd = libc.inotify_add_watch(fd, path, watch_mask)
+        if wd >= 0:
+            watches[wd] = (path, recursive)
+
+    def addDirectory(path):
+        for root, dirnames, filenames in os.walk(path):
+            addWatch(root, True)
+
+    for path in paths:
+        full_path = os.path.join(directory, path)
+        if os.path.isdir(full_path):
+            addDirectory(full_path)
+        else:
+            watched_files.add(os.path.normpath(full_path))
+            addWatch(os.path.dirname(full_path), False)
+    if len(watches) == 0:
+        os.close(fd)
+        return None
+
+    def read(timeout):
+        changed = set()
+        try:
+            ready, _, _ = select.select([fd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return changed
+            raise
+        if len(ready) == 0:
+            return changed
+        try:
+            data = os.read(fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return changed
+            raise
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = event_header.unpack_from(data, offset)
+            offset += event_header.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & in_q_overflow:
+                # Events were dropped so assume everything changed
+                changed.update(paths)
+                continue
+            if wd not in watches:
+                continue
+            path, recursive = watches[wd]
+            if mask & in_ignored:
+                del watches[wd]
+                continue
+            if name:
+                path = os.path.join(path, name)
+            if recursive or path in watched_files:
+                changed.add(os.path.relpath(path, directory))
+            if recursive and mask & in_isdir and \
+                    mask & (in_create | in_moved_to):
+                addDirectory(path)
+        return changed
+    return read
+
+
+def _snapshot(directory, paths):
+    """
+    Records the size and modification time of every watched file.
+
+    Args:
+    directory: The directory the paths are relative to.
+    paths: A list of the files and directories to watch.
+    Returns:
+    A dictionary of the size and mtime of each file keyed by its path
+    relative to the directory.
+    """
+    snapshot = {}
+    for path in paths:
+        full_path = os.path.join(directory, path)
+        if os.path.isfile(full_path):
+            full_paths = [full_path]
+        else:
+            full_paths = []
+            for root, dirnames, filenames in os.walk(full_path):
+                full_paths.extend(os.path.join(root, filename)
+                                  for filename in filenames)
+        for file_path in full_paths:
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                continue
+            snapshot[os.path.relpath(file_path, directory)] = \
+                (file_stat.st_size, file_stat.st_mtime)
+    return snapshot
+
+
+def _pollingReader(directory, paths):
+    """
+    Watches paths by comparing snapshots of them, for systems without
+    inotify.
+
+    Args:
+    directory: The directory the paths are relative to.
+    paths: A list of the files and directories to watch.
+    Returns:
+    A function taking a timeout in seconds (None to wait forever) and
+    returning the set of paths changed before it.
+    """
+    state = {'snapshot': _snapshot(directory, paths)}
+
+    def read(timeout):
+        start = time.time()
+        while True:
+            snapshot = _snapshot(directory, paths)
+            changed = set(path for path in set(snapshot) |
+                          set(state['snapshot'])
+                          if snapshot.get(path) !=
+                          state['snapshot'].get(path))
+            state['snapshot'] = snapshot
+            if len(changed) > 0:
+                return changed
+            if timeout is not None and time.time() - start >= timeout:
+                return changed
+            time.sleep(poll_interval if timeout is None
+                       else min(poll_interval, timeout))
+    return read
+
+
+def _filter(changed, ignore):
+    """
+    Removes the ignored paths from a set of changed paths.
+
+    Args:
+    changed: The set of changed paths.
+    ignore: A function returning True for paths to ignore, or None.
+    Returns:
+    The set of changed paths that are not ignored.
+    """
+    if ignore is None:
+        return changed
+    return set(path for path in changed if not ignore(path))
+
+
+def run(directory, paths, rebuild, debounce=0.3, ignore=None):
+    """
+    Calls a function whenever the watched paths change, until interrupted.
+
+    Bursts of changes, such as saving several files at once, are collected
+    into one call once no change has been seen for the debounce time.
+
+    Args:
+    directory: The directory the paths are relative to.
+    paths: A list of the files and directories to watch.
+    rebuild: A function taking the set of changed paths.
+    debounce: The time in seconds to wait for further changes.
+    ignore: A function returning True for changed paths to ignore, such as
+    files written by the build itself.
+    """
+    read = _inotifyReader(directory, paths)
+    if read is None:
+        print 'inotify is not available, polling for changes'
+        read = _pollingReader(directory, paths)
+    while True:
+        print 'Watching for changes...'
+        sys.stdout.flush()
+        changed = set()
+        while len(changed) == 0:
+            changed = _filter(read(None), ignore)
+        more = read(debounce)
+        while len(more) > 0:
+            changed.update(_filter(more, ignore))
+            more = read(debounce)
+        rebuild(changed)
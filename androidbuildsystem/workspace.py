@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import Queue
+import sys
+import zipfile
+from multiprocessing.pool import ThreadPool
+
+from androidbuildsystem import files
+from androidbuildsystem import process
+
+
+classes_jar_file = 'classes.jar'
+
+
+def parse(workspace_config):
+    """
+    Parses the modules of a workspace and orders them so that every module
+    comes after the modules it depends on.
+
+    Args:
+    workspace_config: The workspace configuration, with a list of modules
+    each with a name, a directory and optionally a depends_on list of module
+    names.
+    Returns:
+    A list of module dictionaries with a name, directory and set of module
+    names it depends on, in dependency order.
+    """
+    modules = {}
+    for index, module_spec in enumerate(workspace_config.get('modules') or
+                                        []):
+        if not isinstance(module_spec, dict) or 'name' not in module_spec:
+            raise ValueError('Module ' + str(index + 1) + ' has no name')
+        name = str(module_spec['name'])
+        if name in modules:
+            raise ValueError('Module ' + name + ' is listed twice')
+        depends_on = module_spec.get('depends_on', [])
+        if not isinstance(depends_on, list):
+            depends_on = [depends_on]
+        modules[name] = {'name': name,
+                         'directory': str(module_spec.get('directory', name)),
+                         'depends_on': set(str(dependency)
+                                           for dependency in depends_on)}
+    if len(modules) == 0:
+        raise ValueError('The workspace has no modules')
+    for module in modules.values():
+        for dependency in module['depends_on']:
+            if dependency not in modules:
+                raise ValueError('Module ' + module['name'] +
+                                 ' depends on unknown module ' + dependency)
+    ordered = []
+    remaining = set(modules)
+    while len(remaining) > 0:
+        ready = sorted(name for name in remaining
+                       if modules[name]['depends_on'].isdisjoint(remaining))
+        if len(ready) == 0:
+            raise ValueError('Modules depend on each other: ' +
+                             ', '.join(sorted(remaining)))
+        for name in ready:
+            ordered.append(modules[name])
+            remaining.remove(name)
+    return ordered
+
+
+def dependencies(modules, module):
+    """
+    Lists every module a module depends on, directly or through other
+    modules.
+
+    Args:
+    modules: The list of modules returned by parse.
+    module: The module to list the dependencies of.
+    Returns:
+    A list of the modules in dependency order.
+    """
+    modules_by_name = dict((other['name'], other) for other in modules)
+    names = set()
+    pending = list(module['depends_on'])
+    while len(pending) > 0:
+        name = pending.pop()
+        if name not in names:
+            names.add(name)
+            pending.extend(modules_by_name[name]['depends_on'])
+    return [other for other in modules if other['name'] in names]
+
+
+def packageClasses(obj_directory, jar_file):
+    """
+    Packages the class files of a module into the jar its dependents compile
+    and dex against, leaving the jar untouched if no class changed so that
+    dependents are not rebuilt.
+
+    Args:
+    obj_directory: The directory containing the class files.
+    jar_file: The path to the jar to write.
+    """
+    temporary_jar_file = jar_file + '.tmp'
+    with zipfile.ZipFile(temporary_jar_file, 'w', zipfile.ZIP_STORED) as jar:
+        for root, dirnames, filenames in os.walk(obj_directory):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if os.path.splitext(filename)[1] != '.class':
+                    continue
+                class_file = os.path.join(root, filename)
+                relative_path = os.path.relpath(class_file, obj_directory)
+                info = zipfile.ZipInfo(relative_path.replace(os.sep, '/'),
+                                       (1980, 1, 1, 0, 0, 0))
+                with open(class_file, 'rb') as f:
+                    jar.writestr(info, f.read())
+    if os.path.isfile(jar_file) and \
+            files.hashFile(jar_file) == files.hashFile(temporary_jar_file):
+        os.remove(temporary_jar_file)
+    else:
+        os.rename(temporary_jar_file, jar_file)
+
+
+def _buildModule(job):
+    """
+    Builds a module on a worker thread, capturing its output.
+
+    Args:
+    job: A tuple of the module, the function building it and the output
+    stream.
+    Returns:
+    A tuple of the module name, the exit status and the captured output.
+    """
+    module, build_module, output = job
+    output.capture()
+    status = 0
+    try:
+        build_module(module)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    except Exception as e:
+        print 'Failed to build module: ' + str(e)
+        status = 1
+    return module['name'], status, output.release()
+
+
+def build(modules, build_module, jobs=None):
+    """
+    Builds modules on a pool of worker threads, starting each module once
+    the modules it depends on have been built.
+
+    The output of each module is printed prefixed with its name when it
+    finishes. Modules that depend on a module that failed are skipped.
+
+    Args:
+    modules: The list of modules returned by parse.
+    build_module: A function building a module, exiting on failure.
+    jobs: The number of modules to build at once, None for one per CPU.
+    Returns:
+    A dictionary of the exit status of each module keyed by name, None for
+    skipped modules.
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    completed = Queue.Queue()
+    pool = ThreadPool(max(min(int(jobs), len(modules)), 1))
+    results = {}
+    running = set()
+    output = process.ThreadOutput(sys.stdout)
+    sys.stdout = output
+    try:
+        while len(results) < len(modules):
+            for module in modules:
+                if module['name'] in results or module['name'] in running:
+                    continue
+                if not module['depends_on'].issubset(results):
+                    continue
+                if any(results[dependency] != 0
+                       for dependency in module['depends_on']):
+                    print 'Skipping module ' + module['name'] + \
+                        ' because a module it depends on failed'
+                    results[module['name']] = None
+                    continue
+                running.add(module['name'])
+                pool.apply_async(_buildModule,
+                                 ((module, build_module, output),),
+                                 callback=completed.put)
+            if len(running) == 0:
+                break
+            # A timeout keeps the wait interruptible with Ctrl-C
+            name, status, module_output = completed.get(True, 86400)
+            running.remove(name)
+            results[name] = status
+            for line in module_output.splitlines():
+                print '[' + name + '] ' + line
+            sys.stdout.flush()
+    finally:
+        sys.stdout = output.stream
+        pool.close()
+        pool.join()
+    return results
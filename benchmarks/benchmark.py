@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks androidbuildsystem against a fake SDK and JDK.
+
+The fake aapt, aapt2, javac, dx, java, keytool, jarsigner, zipalign, android
+and adb programs of tests/fake_toolchain.py sleep for a configurable latency
+before producing output the build accepts. A synthetic project with a given
+number of sources, resources and library jars is generated and built cold,
+with nothing changed, with one source changed and with one layout changed,
+and the end to end and per step times are reported and saved as JSON.
+"""
+
+import argparse
+import binascii
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+
+benchmark_file = os.path.abspath(__file__)
+repository_directory = os.path.dirname(os.path.dirname(benchmark_file))
+sys.path.insert(0, os.path.join(repository_directory, 'tests'))
+
+import fake_toolchain
+
+
+steps = ['compile', 'package', 'sign', 'install']
+scenarios = ['cold', 'noop', 'one_file', 'one_resource']
+build_config = """compile:
+    target: android-23
+package:
+    name: Benchmark
+sign:
+    keystore:
+        company_name: Benchmark
+        organisational_unit: Benchmark
+        organisation: Benchmark
+        location: London
+        state: London
+        country: GB
+    storepass: benchmark
+    keypass: benchmark
+    key_alias: BenchmarkKey
+install:
+    profile: BenchmarkAVD
+profiles:
+    - name: BenchmarkAVD
+      target: android-23
+      sdcard: 1024M
+      abi: default/x86_64
+      type: emulator
+"""
+android_manifest = """<?xml version="1.0" encoding="utf-8"?>
+<manifest xmlns:android="http://schemas.android.com/apk/res/android"
+    package="com.example.benchmark"
+    android:versionCode="1"
+    android:versionName="1.0">
+    <application android:label="@string/app_name">
+    </application>
+</manifest>
+"""
+# A 1x1 PNG
+png_contents = binascii.unhexlify(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c63f8cfc0f01f0005000201ff36b0cd'
+    '0000000049454e44ae426082')
+
+
+def createProject(directory, sources, resources, jars, overrides):
+    """
+    Creates a synthetic project.
+
+    Args:
+    directory: The project directory.
+    sources: The number of java sources, ten to a package, each using the
+    one before it.
+    resources: The number of resource files, alternating layouts and
+    drawables.
+    jars: The number of library jars.
+    overrides: A list of build configuration options to set, such as
+    compile.incremental=true.
+    """
+    import yaml
+    for sub_directory in ['src', 'res/drawable', 'res/layout', 'res/values',
+                          'lib']:
+        full_directory = os.path.join(directory, sub_directory)
+        if not os.path.exists(full_directory):
+            os.makedirs(full_directory)
+    with open(os.path.join(directory, 'AndroidManifest.xml'), 'w') as f:
+        f.write(android_manifest)
+    with open(os.path.join(directory, 'res/values/strings.xml'), 'w') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<resources>\n'
+                '    <string name="app_name">Benchmark</string>\n'
+                '</resources>\n')
+    for index in range(resources):
+        if index % 2 == 0:
+            with open(os.path.join(directory, 'res/layout',
+                                   'layout_' + str(index) + '.xml'),
+                      'w') as f:
+                f.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                        '<LinearLayout xmlns:android="http://schemas.'
+                        'android.com/apk/res/android"\n'
+                        '    android:layout_width="match_parent"\n'
+                        '    android:layout_height="match_parent" />\n')
+        else:
+            with open(os.path.join(directory, 'res/drawable',
+                                   'image_' + str(index) + '.png'),
+                      'wb') as f:
+                f.write(png_contents)
+    for index in range(sources):
+        package = 'com.example.benchmark.p' + str(index // 10)
+        package_directory = os.path.join(directory, 'src',
+                                         *package.split('.'))
+        if not os.path.exists(package_directory):
+            os.makedirs(package_directory)
+        uses = ''
+        if index > 0:
+            uses = '    private com.example.benchmark.p' + \
+                str((index - 1) // 10) + '.Source' + str(index - 1) + \
+                ' previous;\n'
+        with open(os.path.join(package_directory,
+                               'Source' + str(index) + '.java'), 'w') as f:
+            f.write('package ' + package + ';\n\n'
+                    'public class Source' + str(index) + ' {\n' + uses +
+                    '    public int value() {\n'
+                    '        return ' + str(index) + ';\n'
+                    '    }\n'
+                    '}\n')
+    for index in range(jars):
+        with zipfile.ZipFile(os.path.join(directory, 'lib',
+                                          'library' + str(index) + '.jar'),
+                             'w') as jar:
+            for class_index in range(20):
+                name = 'com/example/library' + str(index) + '/Library' + \
+                    str(class_index)
+                jar.writestr(name + '.class',
+                             fake_toolchain.classFile(name, []))
+    config = yaml.safe_load(build_config)
+    for override in overrides:
+        path, value = override.split('=', 1)
+        keys = path.split('.')
+        section = config
+        for key in keys[:-1]:
+            section = section.setdefault(key, {})
+        section[keys[-1]] = yaml.safe_load(value)
+    with open(os.path.join(directory, 'androidbuildsystem.yaml'), 'w') as f:
+        yaml.safe_dump(config, f, default_flow_style=False)
+
+
+def _clean(work_directory, project_directory):
+    """
+    Removes everything a build writes so the next build is cold.
+    """
+    for sub_directory in ['obj', 'bin', 'dex', 'gen', 'compiled', 'build']:
+        shutil.rmtree(os.path.join(project_directory, sub_directory),
+                      ignore_errors=True)
+    r_java_file = os.path.join(project_directory, 'src', 'com', 'example',
+                               'benchmark', 'R.java')
+    if os.path.exists(r_java_file):
+        os.remove(r_java_file)
+    home_directory = os.path.join(work_directory, 'home')
+    shutil.rmtree(home_directory, ignore_errors=True)
+    os.makedirs(home_directory)
+
+
+def _changeSource(project_directory, counter):
+    """
+    Changes the body of the first java source.
+    """
+    source_file = os.path.join(project_directory, 'src', 'com', 'example',
+                               'benchmark', 'p0', 'Source0.java')
+    with open(source_file) as f:
+        text = f.read()
+    text = re.sub(r'return \d+;', 'return ' + str(counter) + ';', text)
+    with open(source_file, 'w') as f:
+        f.write(text)
+
+
+def _changeResource(project_directory, counter):
+    """
+    Changes the first layout.
+    """
+    layout_file = os.path.join(project_directory, 'res', 'layout',
+                               'layout_0.xml')
+    with open(layout_file) as f:
+        text = f.read()
+    text = re.sub(r'( android:tag="\d+")? />',
+                  ' android:tag="' + str(counter) + '" />', text)
+    with open(layout_file, 'w') as f:
+        f.write(text)
+
+
+def _runBuild(work_directory, project_directory, environment):
+    """
+    Runs one build and times it.
+
+    Returns:
+    A dictionary with the total time, the time the tasks of each step took
+    in seconds and the number of processes started.
+    """
+    trace_file = os.path.join(work_directory, 'trace.json')
+    command = [sys.executable,
+               '-c', 'import androidbuildsystem; androidbuildsystem._main()',
+               '-a', os.path.join(work_directory, 'sdk'),
+               '-j', os.path.join(work_directory, 'jdk'),
+               '-d', project_directory,
+               '--trace', trace_file]
+    start = time.time()
+    build = subprocess.Popen(command,
+                             cwd=project_directory,
+                             env=environment,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+    output = build.communicate()[0]
+    total = time.time() - start
+    if build.returncode != 0:
+        print output
+        raise RuntimeError('Benchmark build failed')
+    with open(trace_file) as f:
+        events = json.load(f)['traceEvents']
+    # Step events span tasks that overlap other steps, so the time of a
+    # step is the time its tasks took
+    step_times = {}
+    for event in events:
+        step = event['args'].get('step')
+        if event['cat'] == 'task' and step in steps:
+            step_times[step] = step_times.get(step, 0) + event['dur'] / 1e6
+    processes = re.search(r'Processes started: (\d+)', output)
+    return {'total': total,
+            'steps': step_times,
+            'processes': int(processes.group(1)) if processes else 0}
+
+
+def _median(values):
+    """
+    Works out the median of a list of numbers.
+    """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _summarise(runs):
+    """
+    Takes the median of each measurement over several runs.
+    """
+    step_names = set()
+    for run in runs:
+        step_names.update(run['steps'])
+    return {'total': _median([run['total'] for run in runs]),
+            'steps': dict((step, _median([run['steps'].get(step, 0)
+                                          for run in runs]))
+                          for step in step_names),
+            'processes': _median([run['processes'] for run in runs])}
+
+
+def runScenarios(work_directory, project_directory, repeat, environment):
+    """
+    Times cold, no-op, one-source-changed and one-layout-changed builds.
+
+    Args:
+    work_directory: The directory containing the fake toolchain.
+    project_directory: The synthetic project directory.
+    repeat: The number of times to run each scenario.
+    environment: The environment to run the builds in.
+    Returns:
+    A dictionary of the median measurements of each scenario.
+    """
+    results = dict((scenario, []) for scenario in scenarios)
+    for index in range(repeat):
+        _clean(work_directory, project_directory)
+        results['cold'].append(_runBuild(work_directory, project_directory,
+                                         environment))
+        results['noop'].append(_runBuild(work_directory, project_directory,
+                                         environment))
+        _changeSource(project_directory, 1000 + index)
+        results['one_file'].append(_runBuild(work_directory,
+                                             project_directory,
+                                             environment))
+        if os.path.isfile(os.path.join(project_directory, 'res', 'layout',
+                                       'layout_0.xml')):
+            _changeResource(project_directory, 1000 + index)
+            results['one_resource'].append(_runBuild(work_directory,
+                                                     project_directory,
+                                                     environment))
+    results = dict((scenario, runs) for scenario, runs in results.items()
+                   if len(runs) > 0)
+    return dict((scenario, _summarise(runs))
+                for scenario, runs in results.items())
+
+
+def compare(results, baseline, threshold, minimum):
+    """
+    Compares results with a baseline.
+
+    Args:
+    results: The results of runScenarios.
+    baseline: The results saved by an earlier run.
+    threshold: The fraction a time can grow by before it is a regression.
+    minimum: The time in seconds a time must grow by to be a regression,
+    so that noise in short steps is ignored.
+    Returns:
+    A list of strings describing the regressions.
+    """
+    regressions = []
+    for scenario in scenarios:
+        if scenario not in baseline or scenario not in results:
+            continue
+        pairs = [('total', results[scenario]['total'],
+                  baseline[scenario]['total'])]
+        for step, seconds in sorted(results[scenario]['steps'].items()):
+            pairs.append((step, seconds,
+                          baseline[scenario]['steps'].get(step, 0)))
+        for name, seconds, baseline_seconds in pairs:
+            if seconds > baseline_seconds * (1 + threshold) and \
+                    seconds - baseline_seconds > minimum:
+                regressions.append('%s %s: %.3fs (baseline %.3fs)' %
+                                   (scenario, name, seconds,
+                                    baseline_seconds))
+    return regressions
+
+
+def printResults(results):
+    """
+    Prints a table of the results.
+    """
+    print '%-12s %10s %10s %10s %10s %10s %10s' % ('Scenario', 'Total (s)',
+                                                   'compile', 'package',
+                                                   'sign', 'install',
+                                                   'Processes')
+    for scenario in scenarios:
+        if scenario not in results:
+            continue
+        result = results[scenario]
+        print '%-12s %10.3f %10.3f %10.3f %10.3f %10.3f %10d' % (
+            scenario,
+            result['total'],
+            result['steps'].get('compile', 0),
+            result['steps'].get('package', 0),
+            result['steps'].get('sign', 0),
+            result['steps'].get('install', 0),
+            result['processes'])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks androidbuildsystem with a fake toolchain')
+    parser.add_argument('--sources', type=int, default=200,
+                        help='The number of java sources')
+    parser.add_argument('--resources', type=int, default=50,
+                        help='The number of resource files')
+    parser.add_argument('--jars', type=int, default=5,
+                        help='The number of library jars')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='The seconds each fake SDK tool takes')
+    parser.add_argument('--jvm-latency', type=float, default=0.3,
+                        help='The seconds each fake JDK tool takes')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='The number of times to run each scenario')
+    parser.add_argument('--set', action='append', default=[],
+                        help='Sets a build configuration option, such as '
+                        'compile.incremental=true')
+    parser.add_argument('--work', help='The directory to generate the '
+                        'toolchain and project in, a temporary directory by '
+                        'default')
+    parser.add_argument('--output', help='Writes the results to a JSON file')
+    parser.add_argument('--baseline', help='Compares the results with a JSON '
+                        'file written by --output and fails on regressions')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='The fraction a time can grow by before it is '
+                        'a regression')
+    parser.add_argument('--minimum', type=float, default=0.1,
+                        help='The seconds a time must grow by before it is a '
+                        'regression')
+    args = parser.parse_args()
+    work_directory = args.work or tempfile.mkdtemp(prefix='abs-benchmark-')
+    work_directory = os.path.abspath(work_directory)
+    project_directory = os.path.join(work_directory, 'project')
+    try:
+        fake_toolchain.createToolchain(work_directory)
+        createProject(project_directory, args.sources, args.resources,
+                      args.jars, args.set)
+        environment = dict(os.environ)
+        environment['PATH'] = os.path.join(work_directory, 'sdk', 'tools') + \
+            os.pathsep + environment.get('PATH', '')
+        environment['PYTHONPATH'] = repository_directory
+        environment['ANDROIDBUILDSYSTEM_HOME'] = os.path.join(work_directory,
+                                                              'home')
+        environment['ANDROID_AVD_HOME'] = os.path.join(work_directory, 'avd')
+        environment['BENCHMARK_LATENCY'] = str(args.latency)
+        environment['BENCHMARK_JVM_LATENCY'] = str(args.jvm_latency)
+        results = runScenarios(work_directory, project_directory,
+                               args.repeat, environment)
+    finally:
+        if args.work is None:
+            shutil.rmtree(work_directory, ignore_errors=True)
+    printResults(results)
+    document = {'parameters': {'sources': args.sources,
+                               'resources': args.resources,
+                               'jars': args.jars,
+                               'latency': args.latency,
+                               'jvm_latency': args.jvm_latency,
+                               'repeat': args.repeat,
+                               'set': args.set},
+                'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('parameters') != document['parameters']:
+            print 'Warning: the baseline was run with different parameters'
+        regressions = compare(results, baseline['results'], args.threshold,
+                              args.minimum)
+        if len(regressions) > 0:
+            print 'Regressions:'
+            for regression in regressions:
+                print '  ' + regression
+            sys.exit(1)
+        print 'No regressions against ' + args.baseline
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,682 @@
+# -*- coding: utf-8 -*-
+"""
+A fake Android SDK and JDK for the tests and the benchmark.
+
+The fake aapt, aapt2, javac, dx, java, keytool, jarsigner, zipalign, android
+and adb programs are small launchers that run this script, sleeping for a
+configurable latency before producing output the build accepts.
+"""
+
+import binascii
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import StringIO
+import struct
+import sys
+import time
+import zipfile
+
+
+fake_toolchain_file = os.path.abspath(__file__)
+target = 'android-23'
+api_level = '23'
+build_tools_version = '23.0.3'
+avd_name = 'BenchmarkAVD'
+emulator_serial = 'emulator-5554'
+jvm_tools = ['javac', 'java', 'keytool', 'jarsigner', 'dx']
+worker_tools = {'javac': 'javac',
+                'com.android.dx.command.Main': 'dx',
+                'com.android.dx.merge.DexMerger': 'java',
+                'sun.security.tools.keytool.Main': 'keytool',
+                'sun.security.tools.jarsigner.Main': 'jarsigner'}
+tools = {'sdk/build-tools/' + build_tools_version: ['aapt', 'aapt2', 'dx',
+                                                   'zipalign'],
+         'sdk/tools': ['android'],
+         'sdk/platform-tools': ['adb'],
+         'jdk/bin': ['javac', 'java', 'keytool', 'jarsigner']}
+package_pattern = re.compile(r'package="([^"]+)"')
+class_pattern = re.compile(r'\b([A-Z]\w*)\b')
+method_pattern = re.compile(r'\bpublic\s+(?:static\s+)?(\w+)\s+(\w+)\s*\(')
+constant_pattern = re.compile(
+    r'\bstatic\s+final\s+int\s+(\w+)\s*=\s*(-?\d+)\s*;')
+descriptors = {'int': 'I', 'void': 'V', 'boolean': 'Z'}
+
+
+def _sleep(tool):
+    """
+    Waits for the latency configured for a fake tool.
+
+    Args:
+    tool: The name of the fake tool.
+    """
+    variable = 'BENCHMARK_JVM_LATENCY' if tool in jvm_tools \
+        else 'BENCHMARK_LATENCY'
+    latency = float(os.environ.get(variable, '0'))
+    if latency > 0:
+        time.sleep(latency)
+
+
+def _option(arguments, name, default=None):
+    """
+    Gets the value following an option in a fake tool command line.
+    """
+    if name in arguments:
+        return arguments[arguments.index(name) + 1]
+    return default
+
+
+def _writeRJava(r_directory, package, resources):
+    """
+    Writes an R.java with an identifier for every resource file.
+    """
+    types = {}
+    for resource, contents in resources:
+        resource_type = resource.split('/')[0].split('-')[0]
+        if resource_type == 'values':
+            continue
+        name = os.path.splitext(os.path.basename(resource))[0]
+        types.setdefault(resource_type, set()).add(name)
+    lines = ['package ' + package + ';', 'public final class R {']
+    identifier = 0x7f010000
+    for resource_type in sorted(types):
+        lines.append('    public static final class ' + resource_type + ' {')
+        for name in sorted(types[resource_type]):
+            lines.append('        public static final int ' + name +
+                         ' = ' + hex(identifier) + ';')
+            identifier += 1
+        lines.append('    }')
+    lines.append('}')
+    package_directory = os.path.join(r_directory, *package.split('.'))
+    if not os.path.exists(package_directory):
+        os.makedirs(package_directory)
+    with open(os.path.join(package_directory, 'R.java'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def _writeResources(apk_file, manifest_file, resources, dex_directory=None):
+    """
+    Writes a resources archive with the manifest, a resource table and the
+    resource files.
+    """
+    table = hashlib.sha1()
+    with zipfile.ZipFile(apk_file, 'w', zipfile.ZIP_DEFLATED) as apk:
+        apk.write(manifest_file, 'AndroidManifest.xml')
+        for resource, contents in resources:
+            table.update(contents)
+            if not resource.startswith('values'):
+                apk.writestr('res/' + resource, contents)
+        apk.writestr('resources.arsc', table.digest() * 64)
+        if dex_directory is not None:
+            classes_dex_file = os.path.join(dex_directory, 'classes.dex')
+            if os.path.isfile(classes_dex_file):
+                apk.write(classes_dex_file, 'classes.dex')
+
+
+def _manifestPackage(arguments, manifest_file):
+    """
+    Works out the package of R.java like aapt.
+    """
+    custom_package = _option(arguments, '--custom-package')
+    if custom_package is not None:
+        return custom_package
+    with open(manifest_file) as f:
+        return package_pattern.search(f.read()).group(1)
+
+
+def _fakeAapt(arguments):
+    """
+    Generates R.java or packages the resources like aapt package, or
+    crunches an image like aapt singleCrunch.
+    """
+    if arguments[0] == 'singleCrunch':
+        shutil.copyfile(_option(arguments, '-i'), _option(arguments, '-o'))
+        return 0
+    manifest_file = _option(arguments, '-M')
+    res_directory = _option(arguments, '-S')
+    resources = []
+    for root, dirnames, filenames in os.walk(res_directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            resource_file = os.path.join(root, filename)
+            with open(resource_file, 'rb') as f:
+                resources.append((os.path.relpath(resource_file,
+                                                  res_directory).replace(
+                                                      os.sep, '/'),
+                                  f.read()))
+    r_directory = _option(arguments, '-J')
+    if r_directory is not None:
+        _writeRJava(r_directory, _manifestPackage(arguments, manifest_file),
+                    resources)
+    apk_file = _option(arguments, '-F')
+    if apk_file is not None:
+        dex_directory = None
+        if os.path.isdir(arguments[-1]):
+            dex_directory = arguments[-1]
+        _writeResources(apk_file, manifest_file, resources, dex_directory)
+    return 0
+
+
+def _fakeAapt2(arguments):
+    """
+    Compiles one resource file or links the compiled files like aapt2.
+    """
+    if arguments[0] == 'compile':
+        resource_file = arguments[-1]
+        resource = os.path.relpath(
+            resource_file,
+            os.path.dirname(os.path.dirname(resource_file))).replace(
+                os.sep, '/')
+        extension = '.arsc.flat' if resource.startswith('values') \
+            else '.flat'
+        flat_file = os.path.join(_option(arguments, '-o'),
+                                 resource.replace('/', '_') + extension)
+        with open(resource_file, 'rb') as f:
+            contents = f.read()
+        with open(flat_file, 'wb') as f:
+            f.write(resource + '\n' + contents)
+        return 0
+    manifest_file = _option(arguments, '--manifest')
+    resources = []
+    for argument in arguments:
+        if argument.endswith('.flat'):
+            with open(argument, 'rb') as f:
+                resources.append(tuple(f.read().split('\n', 1)))
+    r_directory = _option(arguments, '--java')
+    if r_directory is not None:
+        _writeRJava(r_directory, _manifestPackage(arguments, manifest_file),
+                    resources)
+    _writeResources(_option(arguments, '-o'), manifest_file, sorted(resources))
+    return 0
+
+
+def classFile(name, references, methods=(), fields=()):
+    """
+    Creates a minimal class file naming a class, the classes it uses, its
+    public methods as tuples of the name and return type and its int
+    constants as tuples of the name and value.
+    """
+    constants = []
+
+    def utf8(value):
+        constants.append(struct.pack('>BH', 1, len(value)) + value)
+        return len(constants)
+
+    def class_constant(value):
+        constants.append(struct.pack('>BH', 7, utf8(value)))
+        return len(constants)
+    this_class = class_constant(name)
+    super_class = class_constant('java/lang/Object')
+    for reference in references:
+        class_constant(reference)
+    members = {'fields': [], 'methods': []}
+    for field_name, value in fields:
+        constants.append(struct.pack('>Bi', 3, value))
+        value_index = len(constants)
+        members['fields'].append(struct.pack(
+            '>HHHHHIH', 0x19, utf8(field_name), utf8('I'), 1,
+            utf8('ConstantValue'), 2, value_index))
+    for method_name, return_type in methods:
+        members['methods'].append(struct.pack(
+            '>HHHH', 0x01, utf8(method_name),
+            utf8('()' + descriptors.get(return_type, 'Ljava/lang/Object;')),
+            0))
+    return '\xca\xfe\xba\xbe' + struct.pack('>HHH', 0, 50,
+                                            len(constants) + 1) + \
+        ''.join(constants) + struct.pack('>HHHH', 0x21, this_class,
+                                         super_class, 0) + \
+        struct.pack('>H', len(members['fields'])) + \
+        ''.join(members['fields']) + \
+        struct.pack('>H', len(members['methods'])) + \
+        ''.join(members['methods']) + struct.pack('>H', 0)
+
+
+def _fakeJavac(arguments):
+    """
+    Writes a class file for every java source like javac.
+    """
+    source_paths = []
+    for argument in arguments:
+        if argument.startswith('@'):
+            with open(argument[1:]) as f:
+                source_paths.extend(line.strip().strip('"') for line in f
+                                    if line.strip())
+        elif argument.endswith('.java'):
+            source_paths.append(argument)
+    obj_directory = _option(arguments, '-d')
+    source_directories = _option(arguments, '-sourcepath', '').split(':')
+    known_classes = {}
+    for source_directory in source_directories:
+        for root, dirnames, filenames in os.walk(source_directory):
+            for filename in filenames:
+                if filename.endswith('.java'):
+                    relative_path = os.path.relpath(
+                        os.path.join(root, filename), source_directory)[:-5]
+                    known_classes[os.path.basename(relative_path)] = \
+                        relative_path
+    for source_path in source_paths:
+        relative_path = None
+        for source_directory in source_directories:
+            prefix = os.path.abspath(source_directory) + os.sep
+            if os.path.abspath(source_path).startswith(prefix):
+                relative_path = os.path.abspath(source_path)[
+                    len(prefix):-5]
+        if relative_path is None:
+            relative_path = os.path.basename(source_path)[:-5]
+        with open(source_path) as f:
+            text = f.read()
+        name = os.path.basename(relative_path)
+        references = sorted(set(known_classes[reference]
+                                for reference in class_pattern.findall(text)
+                                if reference in known_classes and
+                                reference != name))
+        class_file = os.path.join(obj_directory, relative_path + '.class')
+        if not os.path.exists(os.path.dirname(class_file)):
+            os.makedirs(os.path.dirname(class_file))
+        with open(class_file, 'wb') as f:
+            f.write(classFile(relative_path, references,
+                               [(method_name, return_type)
+                                for return_type, method_name in
+                                method_pattern.findall(text)],
+                               [(field_name, int(value))
+                                for field_name, value in
+                                constant_pattern.findall(text)]))
+    return 0
+
+
+def _fakeDx(arguments):
+    """
+    Writes a dex file from the class files and jars like dx --dex.
+    """
+    output_file = [argument for argument in arguments
+                   if argument.startswith('--output=')][0][9:]
+    digest = hashlib.sha1()
+    size = 0
+    for argument in arguments:
+        if argument.startswith('-'):
+            continue
+        paths = [argument]
+        if os.path.isdir(argument):
+            paths = []
+            for root, dirnames, filenames in os.walk(argument):
+                dirnames.sort()
+                paths.extend(os.path.join(root, filename)
+                             for filename in sorted(filenames))
+        for path in paths:
+            with open(path, 'rb') as f:
+                data = f.read()
+            digest.update(data)
+            size += len(data)
+    with open(output_file, 'wb') as f:
+        f.write('dex\n035\0' + digest.digest() * max(size // 20, 1))
+    return 0
+
+
+def _fakeWorker():
+    """
+    Serves requests like the persistent JVM worker, running the fake tools
+    in this process after the latency of a tool that is already loaded.
+
+    BENCHMARK_WORKER_JDK=18 answers health checks like a JVM that cannot
+    trap System.exit, and BENCHMARK_WORKER_EXIT=1 exits after running a
+    tool like a tool calling System.exit.
+    """
+    exit_trapped = int(os.environ.get('BENCHMARK_WORKER_JDK', '8')) < 18
+    stdout = sys.stdout
+    while True:
+        header = sys.stdin.read(4)
+        if len(header) < 4:
+            return 0
+        request = []
+        for index in range(struct.unpack('>i', header)[0]):
+            size = struct.unpack('>i', sys.stdin.read(4))[0]
+            request.append(sys.stdin.read(size))
+        output = StringIO.StringIO()
+        status = 0 if exit_trapped else -1000
+        if len(request) > 0:
+            status = 0
+            tool = worker_tools.get(request[0])
+            if tool is None:
+                status = -1000
+            else:
+                _sleep('worker')
+                sys.stdout = output
+                try:
+                    # The fake java takes the main class as well
+                    status = fakes[tool](request if tool == 'java'
+                                         else request[1:])
+                finally:
+                    sys.stdout = stdout
+                if os.environ.get('BENCHMARK_WORKER_EXIT'):
+                    return status
+        stdout.write(struct.pack('>ii', status, len(output.getvalue())) +
+                     output.getvalue())
+        stdout.flush()
+
+
+def _fakeJava(arguments):
+    """
+    Merges dex files like the dx DexMerger run through java, or serves
+    requests like the persistent JVM worker.
+    """
+    if 'AndroidBuildSystemWorker' in arguments:
+        return _fakeWorker()
+    if 'com.android.dx.merge.DexMerger' in arguments:
+        index = arguments.index('com.android.dx.merge.DexMerger')
+        with open(arguments[index + 1], 'wb') as output:
+            for dex_file in arguments[index + 2:]:
+                with open(dex_file, 'rb') as f:
+                    output.write(f.read())
+    return 0
+
+
+def _derInteger(value):
+    """
+    Encodes a positive integer as DER.
+    """
+    from androidbuildsystem import signing
+    digits = '%x' % value
+    data = binascii.unhexlify(('0' if len(digits) % 2 else '') + digits)
+    if ord(data[0]) & 0x80:
+        data = '\0' + data
+    return signing._der(0x02, data)
+
+
+def _isProbablePrime(candidate):
+    """
+    Tests a number for primality with the Miller-Rabin test.
+    """
+    for prime in [3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47]:
+        if candidate % prime == 0:
+            return candidate == prime
+    d = candidate - 1
+    r = 0
+    while d % 2 == 0:
+        d //= 2
+        r += 1
+    for _ in range(20):
+        x = pow(random.randrange(2, candidate - 2), d, candidate)
+        if x == 1 or x == candidate - 1:
+            continue
+        for _ in range(r - 1):
+            x = pow(x, 2, candidate)
+            if x == candidate - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def _randomPrime(bits, e):
+    """
+    Generates a random prime for an RSA key.
+    """
+    while True:
+        candidate = long(binascii.hexlify(os.urandom(bits // 8)), 16)
+        candidate |= (3 << (bits - 2)) | 1
+        if (candidate - 1) % e != 0 and _isProbablePrime(candidate):
+            return candidate
+
+
+def _inverse(value, modulus):
+    """
+    Works out the modular inverse of a number.
+    """
+    a, b, x0, x1 = value, modulus, 1, 0
+    while b:
+        q = a // b
+        a, b = b, a - q * b
+        x0, x1 = x1, x0 - q * x1
+    return x0 % modulus
+
+
+def _fakeKeytool(arguments):
+    """
+    Creates a JKS keystore with a new RSA key and self signed certificate
+    like keytool -genkeypair, so the built in signer can load it.
+    """
+    from androidbuildsystem import signing
+    e = 65537
+    p = _randomPrime(1024, e)
+    q = _randomPrime(1024, e)
+    n = p * q
+    d = _inverse(e, (p - 1) * (q - 1))
+    key = {'n': n, 'd': d, 'p': p, 'q': q, 'dp': d % (p - 1),
+           'dq': d % (q - 1), 'qinv': _inverse(q, p), 'size': 256}
+    private_key = signing._der(0x30, ''.join(_derInteger(number) for number
+                                             in [0, n, e, d, p, q,
+                                                 key['dp'], key['dq'],
+                                                 key['qinv']]))
+    private_key_info = signing._der(0x30, _derInteger(0) +
+                                    signing.rsa_algorithm +
+                                    signing._der(0x04, private_key))
+    name = signing._der(0x30, signing._der(0x31, signing._der(
+        0x30, binascii.unhexlify('0603550403') +
+        signing._der(0x0c, _option(arguments, '-alias')))))
+    sha256_rsa_algorithm = binascii.unhexlify(
+        '300d06092a864886f70d01010b0500')
+    public_key = signing._der(0x30, signing.rsa_algorithm + signing._der(
+        0x03, '\0' + signing._der(0x30, _derInteger(n) + _derInteger(e))))
+    tbs_certificate = signing._der(
+        0x30,
+        signing._der(0xa0, _derInteger(2)) +
+        _derInteger(random.getrandbits(63)) +
+        sha256_rsa_algorithm +
+        name +
+        signing._der(0x30, signing._der(0x17, '160101000000Z') +
+                     signing._der(0x17, '491231000000Z')) +
+        name +
+        public_key)
+    certificate = signing._der(0x30, tbs_certificate + sha256_rsa_algorithm +
+                               signing._der(0x03, '\0' + signing._sign(
+                                   key, tbs_certificate)))
+    # Protect the key with the JKS key protector
+    password = signing._password(_option(arguments, '-keypass'))
+    salt = os.urandom(20)
+    key_stream = ''
+    digest = salt
+    while len(key_stream) < len(private_key_info):
+        digest = hashlib.sha1(password + digest).digest()
+        key_stream += digest
+    encrypted = salt + ''.join(chr(ord(a) ^ ord(b)) for a, b in
+                               zip(private_key_info, key_stream)) + \
+        hashlib.sha1(password + private_key_info).digest()
+    protected_key = signing._der(0x30, signing._der(
+        0x30, signing._der(0x06, signing.jks_key_protector_oid) + '\x05\x00') +
+        signing._der(0x04, encrypted))
+    alias = _option(arguments, '-alias').lower()
+    keystore = struct.pack('>IIII', signing.jks_magic, 2, 1,
+                           signing.jks_private_key_tag)
+    keystore += struct.pack('>H', len(alias)) + alias
+    keystore += struct.pack('>Q', int(time.time() * 1000))
+    keystore += struct.pack('>I', len(protected_key)) + protected_key
+    keystore += struct.pack('>IH', 1, 5) + 'X.509'
+    keystore += struct.pack('>I', len(certificate)) + certificate
+    keystore += hashlib.sha1(signing._password(_option(arguments,
+                                                       '-storepass')) +
+                             signing.jks_integrity_salt + keystore).digest()
+    with open(_option(arguments, '-keystore'), 'wb') as f:
+        f.write(keystore)
+    return 0
+
+
+def _fakeJarsigner(arguments):
+    """
+    Copies the jar to the signed jar like jarsigner -signedjar.
+    """
+    signed_jar_file = _option(arguments, '-signedjar')
+    index = arguments.index('-signedjar')
+    shutil.copyfile(arguments[index + 2], signed_jar_file)
+    return 0
+
+
+def _fakeZipalign(arguments):
+    """
+    Copies the APK like zipalign.
+    """
+    shutil.copyfile(arguments[-2], arguments[-1])
+    return 0
+
+
+def _fakeAndroid(arguments):
+    """
+    Lists targets and virtual devices or creates a virtual device in the
+    format of the android tool.
+    """
+    if arguments[:2] == ['list', 'target']:
+        print 'Available Android targets:'
+        print '----------'
+        print 'id: 1 or "' + target + '"'
+        print '     Name: Android 6.0'
+        print '     Type: Platform'
+        print '     API level: ' + api_level
+        print '     Revision: 3'
+        print '     Skins: HVGA, QVGA, WVGA800 (default)'
+        print ' Tag/ABIs : default/x86_64'
+    elif arguments[:2] == ['list', 'avd']:
+        print 'Available Android Virtual Devices:'
+        avd_directory = os.environ['ANDROID_AVD_HOME']
+        for filename in sorted(os.listdir(avd_directory)):
+            if filename.endswith('.ini'):
+                print '    Name: ' + filename[:-4]
+                print '---------'
+    elif 'create' in arguments:
+        name = _option(arguments, '--name')
+        avd_directory = os.environ['ANDROID_AVD_HOME']
+        with open(os.path.join(avd_directory, name + '.ini'), 'w') as f:
+            f.write('target=' + _option(arguments, '--target') + '\n')
+    return 0
+
+
+def _adbState():
+    """
+    Gets the path of the file recording the packages installed onto the
+    fake devices and every APK transferred to them.
+    """
+    return os.path.join(os.environ['ANDROID_AVD_HOME'], 'adb.json')
+
+
+def _fakeAdb(arguments):
+    """
+    Lists one emulator and installs APKs like adb, recording the packages
+    installed and the APKs transferred in the state file.
+    """
+    serial = emulator_serial
+    if arguments[:1] == ['-s']:
+        serial = arguments[1]
+        arguments = arguments[2:]
+    elif arguments[:1] in [['-d'], ['-e']]:
+        arguments = arguments[1:]
+    state = {'packages': {}, 'transfers': []}
+    if os.path.isfile(_adbState()):
+        with open(_adbState()) as f:
+            state = json.load(f)
+    packages = state['packages'].setdefault(serial, {})
+    if arguments == ['devices']:
+        print 'List of devices attached'
+        print emulator_serial + '\tdevice'
+    elif arguments == ['emu', 'avd', 'name']:
+        print os.environ.get('BENCHMARK_AVD_NAME', avd_name)
+        print 'OK'
+    elif arguments == ['shell', 'getprop', 'ro.serialno']:
+        print 'EMULATOR' + serial.split('-')[-1]
+    elif arguments[:3] == ['shell', 'pm', 'path']:
+        if arguments[3] not in packages:
+            return 1
+        print 'package:/data/app/' + arguments[3] + '-' + \
+            str(packages[arguments[3]]) + '/base.apk'
+    elif arguments[:1] == ['uninstall']:
+        packages.pop(arguments[1], None)
+    elif arguments[:1] == ['install']:
+        with zipfile.ZipFile(arguments[-1]) as apk:
+            package = package_pattern.search(
+                apk.read('AndroidManifest.xml')).group(1)
+        # Each install moves the APK, like Android does
+        packages[package] = len(state['transfers']) + 1
+        state['transfers'].append({'serial': serial,
+                                   'package': package,
+                                   'fastdeploy': '--fastdeploy' in arguments})
+        print 'Success'
+    with open(_adbState(), 'w') as f:
+        json.dump(state, f)
+    return 0
+
+
+fakes = {'aapt': _fakeAapt,
+         'aapt2': _fakeAapt2,
+         'dx': _fakeDx,
+         'zipalign': _fakeZipalign,
+         'android': _fakeAndroid,
+         'adb': _fakeAdb,
+         'javac': _fakeJavac,
+         'java': _fakeJava,
+         'keytool': _fakeKeytool,
+         'jarsigner': _fakeJarsigner}
+
+
+def createToolchain(directory):
+    """
+    Creates the fake SDK and JDK.
+
+    Args:
+    directory: The directory to create the sdk and jdk directories in.
+    """
+    for tools_directory, names in tools.items():
+        full_tools_directory = os.path.join(directory, tools_directory)
+        if not os.path.exists(full_tools_directory):
+            os.makedirs(full_tools_directory)
+        for name in names:
+            tool_file = os.path.join(full_tools_directory, name)
+            with open(tool_file, 'w') as f:
+                f.write('#!/bin/sh\nexec "' + sys.executable + '" "' +
+                        fake_toolchain_file + '" ' + name + ' "$@"\n')
+            os.chmod(tool_file, 0o755)
+    # The jar persistent JVM workers load dx from
+    lib_directory = os.path.join(directory, 'sdk', 'build-tools',
+                                 build_tools_version, 'lib')
+    if not os.path.exists(lib_directory):
+        os.makedirs(lib_directory)
+    with open(os.path.join(lib_directory, 'dx.jar'), 'w') as f:
+        f.write('dx.jar')
+    platform_directory = os.path.join(directory, 'sdk', 'platforms', target)
+    if not os.path.exists(platform_directory):
+        os.makedirs(platform_directory)
+    with open(os.path.join(platform_directory, 'android.jar'), 'w') as f:
+        f.write('android.jar')
+    with open(os.path.join(platform_directory, 'source.properties'),
+              'w') as f:
+        f.write('AndroidVersion.ApiLevel=' + api_level + '\n'
+                'Platform.Version=6.0\nPkg.Revision=3\n')
+    for avd_directory in ['avd', 'home']:
+        if not os.path.exists(os.path.join(directory, avd_directory)):
+            os.makedirs(os.path.join(directory, avd_directory))
+
+
+
+def createKeystore(keystore_file, storepass, keypass, alias):
+    """
+    Creates a keystore with a new key like keytool -genkeypair.
+
+    Args:
+    keystore_file: The keystore file to create.
+    storepass: The password of the keystore.
+    keypass: The password of the key.
+    alias: The alias of the key.
+    """
+    _fakeKeytool(['-genkeypair',
+                  '-keystore', keystore_file,
+                  '-storepass', storepass,
+                  '-keypass', keypass,
+                  '-alias', alias])
+
+
+def main():
+    _sleep(sys.argv[1])
+    sys.exit(fakes[sys.argv[1]](sys.argv[2:]))
+
+
+if __name__ == '__main__':
+    main()
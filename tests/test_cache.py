@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+root_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_directory)
+
+from androidbuildsystem import cache
+
+
+class CacheTest(unittest.TestCase):
+    """
+    Runs a copying action through the build cache of two checkouts of the
+    same project.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.checkouts = [os.path.join(self.directory, name)
+                          for name in ['first', 'second']]
+        for checkout in self.checkouts:
+            os.makedirs(os.path.join(checkout, 'src'))
+            os.makedirs(os.path.join(checkout, 'bin'))
+            self._writeInput(checkout, 'input')
+        self._configure(self.checkouts[0])
+        for statistic in cache.statistics:
+            cache.statistics[statistic] = 0
+        self.runs = []
+
+    def tearDown(self):
+        cache.configure(None, [])
+        cache._file_hashes.clear()
+        shutil.rmtree(self.directory)
+
+    def _configure(self, checkout, max_size=1):
+        cache.configure({'directory': os.path.join(self.directory, 'cache'),
+                         'max_size': max_size},
+                        [(checkout, '$DIR')])
+
+    def _writeInput(self, checkout, text):
+        with open(os.path.join(checkout, 'src', 'input.txt'), 'w') as f:
+            f.write(text)
+
+    def _run(self, checkout, option='--copy'):
+        input_file = os.path.join(checkout, 'src', 'input.txt')
+        output_file = os.path.join(checkout, 'bin', 'output.txt')
+
+        def action():
+            self.runs.append(checkout)
+            shutil.copyfile(input_file, output_file)
+            return 0
+        result = cache.run([['copy', option, input_file, output_file]],
+                           [input_file],
+                           [output_file],
+                           action)
+        self.assertEqual(result, 0)
+        with open(output_file) as f:
+            return f.read()
+
+    def _key(self, checkout, option='--copy'):
+        input_file = os.path.join(checkout, 'src', 'input.txt')
+        output_file = os.path.join(checkout, 'bin', 'output.txt')
+        return cache._key([['copy', option, input_file, output_file]],
+                          [input_file],
+                          [output_file])
+
+    def testKeys(self):
+        key = self._key(self.checkouts[0])
+        self.assertEqual(self._key(self.checkouts[0]), key)
+        self.assertNotEqual(self._key(self.checkouts[0], '--other'), key)
+        self._configure(self.checkouts[1])
+        self.assertEqual(self._key(self.checkouts[1]), key)
+        self._writeInput(self.checkouts[1], 'changed')
+        self.assertNotEqual(self._key(self.checkouts[1]), key)
+
+    def testHitAndMiss(self):
+        self.assertEqual(self._run(self.checkouts[0]), 'input')
+        self.assertEqual(self._run(self.checkouts[0]), 'input')
+        self.assertEqual(self.runs, [self.checkouts[0]])
+        self.assertEqual(cache.statistics['misses'], 1)
+        self.assertEqual(cache.statistics['hits'], 1)
+
+    def testOtherCheckoutHits(self):
+        self._run(self.checkouts[0])
+        self._configure(self.checkouts[1])
+        self.assertEqual(self._run(self.checkouts[1]), 'input')
+        self.assertEqual(self.runs, [self.checkouts[0]])
+        self._writeInput(self.checkouts[1], 'changed')
+        self.assertEqual(self._run(self.checkouts[1]), 'changed')
+        self.assertEqual(self.runs, self.checkouts)
+
+    def testLeastRecentlyUsedEntriesAreEvicted(self):
+        self._configure(self.checkouts[0], 0)
+        self._run(self.checkouts[0])
+        self.assertEqual(cache.statistics['evicted'], 1)
+        self.assertEqual(cache._entries(), [])
+        self._run(self.checkouts[0])
+        self.assertEqual(len(self.runs), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+root_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_directory)
+
+import fake_toolchain
+from androidbuildsystem import devices
+from androidbuildsystem import process
+
+
+class InstallTest(unittest.TestCase):
+    """
+    Installs APKs onto the fake adb, which records every APK it
+    transfers.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.environment = dict(os.environ)
+        fake_toolchain.createToolchain(self.directory)
+        os.environ['ANDROID_AVD_HOME'] = os.path.join(self.directory, 'avd')
+        os.environ['ANDROIDBUILDSYSTEM_HOME'] = os.path.join(self.directory,
+                                                             'home')
+        self.adb_program = os.path.join(self.directory, 'sdk',
+                                        'platform-tools', 'adb')
+        self.apk_file = os.path.join(self.directory, 'app.apk')
+        self.target = {'name': fake_toolchain.avd_name,
+                       'selector': ['-s', fake_toolchain.emulator_serial],
+                       'serial': fake_toolchain.emulator_serial}
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environment)
+        shutil.rmtree(self.directory)
+
+    def _writeApk(self, dex, resources):
+        with zipfile.ZipFile(self.apk_file, 'w') as apk:
+            apk.writestr('AndroidManifest.xml',
+                         '<manifest package="com.example.app"/>')
+            apk.writestr('classes.dex', dex)
+            apk.writestr('res/raw/data', resources)
+
+    def _install(self):
+        results = devices.install(self.adb_program, [self.target],
+                                  self.apk_file, 'com.example.app')
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0][1], 0, results[0][2])
+        return results[0][3]
+
+    def _transfers(self):
+        with open(os.path.join(self.directory, 'avd', 'adb.json')) as f:
+            return json.load(f)['transfers']
+
+    def testUnchangedInstallsAreSkipped(self):
+        self._writeApk('dex' * 10, 'resources' * 100)
+        self.assertEqual(self._install(), 'installed')
+        self.assertEqual(self._install(), 'skipped')
+        self.assertEqual(len(self._transfers()), 1)
+
+    def testUninstalledAppIsInstalled(self):
+        self._writeApk('dex' * 10, 'resources' * 100)
+        self._install()
+        process.run([self.adb_program, '-s', fake_toolchain.emulator_serial,
+                     'uninstall', 'com.example.app'])
+        self.assertEqual(self._install(), 'installed')
+        self.assertEqual(len(self._transfers()), 2)
+
+    def testReusedSerialIsInstalled(self):
+        self._writeApk('dex' * 10, 'resources' * 100)
+        self._install()
+        os.environ['BENCHMARK_AVD_NAME'] = 'OtherAVD'
+        self.assertEqual(self._install(), 'installed')
+        self.assertEqual(len(self._transfers()), 2)
+
+    def testDeltaOnlyForSmallChanges(self):
+        self._writeApk('dex' * 10, 'resources' * 100)
+        self._install()
+        self._writeApk('new dex' * 10, 'resources' * 100)
+        self.assertEqual(self._install(), 'delta')
+        self._writeApk('new dex' * 10, 'new resources' * 100)
+        self.assertEqual(self._install(), 'installed')
+        self.assertEqual([transfer['fastdeploy']
+                          for transfer in self._transfers()],
+                         [False, True, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
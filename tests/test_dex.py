@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+root_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_directory)
+
+import fake_toolchain
+from androidbuildsystem import dex
+
+
+class IncrementalDexTest(unittest.TestCase):
+    """
+    Dexes shards with the fake dx.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        fake_toolchain.createToolchain(self.directory)
+        self.obj_directory = os.path.join(self.directory, 'obj')
+        for relative_path in ['com/example/Main.class',
+                              'com/example/util/Util.class']:
+            class_file = os.path.join(self.obj_directory, relative_path)
+            if not os.path.exists(os.path.dirname(class_file)):
+                os.makedirs(os.path.dirname(class_file))
+            with open(class_file, 'w') as f:
+                f.write(relative_path)
+        self.dex_directory = os.path.join(self.directory, 'dex')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _dex(self, build_tools_version):
+        result = dex.dexIncremental(
+            os.path.join(self.directory, 'sdk', 'build-tools',
+                         build_tools_version),
+            os.path.join(self.directory, 'jdk', 'bin', 'java'),
+            self.obj_directory,
+            self.dex_directory,
+            os.path.join(self.directory, 'classes.dex'))
+        self.assertEqual(result, 0)
+        return sorted(filename for filename in os.listdir(self.dex_directory)
+                      if filename.endswith('.dex'))
+
+    def testConfiguration(self):
+        self.assertEqual(dex.dexConfiguration('/sdk/build-tools/23.0.3/dx'),
+                         '23.0.3-dx --dex')
+        self.assertEqual(dex.dexConfiguration('/sdk/build-tools/28.0.3/d8'),
+                         '28.0.3-d8 --intermediate')
+
+    def _shardKeys(self, configuration='23.0.3-dx --dex', library_jars=()):
+        classes = dex._hashClasses(self.obj_directory, {})
+        shards = dex._shards(self.obj_directory, classes, configuration,
+                             library_jars)
+        return dict((name, shard['key']) for name, shard in shards.items())
+
+    def testShardKeys(self):
+        keys = self._shardKeys()
+        self.assertEqual(sorted(keys), ['package:com/example',
+                                        'package:com/example/util'])
+        self.assertEqual(self._shardKeys(), keys)
+        with open(os.path.join(self.obj_directory, 'com', 'example', 'util',
+                               'Util.class'), 'w') as f:
+            f.write('changed')
+        changed_keys = self._shardKeys()
+        self.assertEqual(changed_keys['package:com/example'],
+                         keys['package:com/example'])
+        self.assertNotEqual(changed_keys['package:com/example/util'],
+                            keys['package:com/example/util'])
+        other_keys = self._shardKeys('28.0.3-d8 --intermediate')
+        for name in keys:
+            self.assertNotEqual(other_keys[name], changed_keys[name])
+
+    def testJarShardKeys(self):
+        jar_file = os.path.join(self.directory, 'library.jar')
+        with open(jar_file, 'w') as f:
+            f.write('library')
+        key = self._shardKeys(library_jars=[jar_file])['jar:' + jar_file]
+        self.assertEqual(
+            self._shardKeys(library_jars=[jar_file])['jar:' + jar_file], key)
+        with open(jar_file, 'w') as f:
+            f.write('changed')
+        self.assertNotEqual(
+            self._shardKeys(library_jars=[jar_file])['jar:' + jar_file], key)
+
+    def testShardsOfOtherBuildToolsAreNotReused(self):
+        shard_files = self._dex(fake_toolchain.build_tools_version)
+        self.assertEqual(len(shard_files), 2)
+        self.assertEqual(self._dex(fake_toolchain.build_tools_version),
+                         shard_files)
+        build_tools_directory = os.path.join(self.directory, 'sdk',
+                                             'build-tools')
+        shutil.copytree(os.path.join(build_tools_directory,
+                                     fake_toolchain.build_tools_version),
+                        os.path.join(build_tools_directory, '24.0.0'))
+        other_shard_files = self._dex('24.0.0')
+        self.assertEqual(len(other_shard_files), 2)
+        self.assertFalse(set(shard_files) & set(other_shard_files))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+root_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_directory)
+
+from androidbuildsystem import drawables
+
+
+class DrawablesTest(unittest.TestCase):
+    """
+    Crunches drawables with an aapt that makes every image larger.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.environment = dict(os.environ)
+        os.environ['ANDROIDBUILDSYSTEM_HOME'] = os.path.join(self.directory,
+                                                             'home')
+        self.build_tools = os.path.join(self.directory, 'build-tools', '23')
+        os.makedirs(self.build_tools)
+        aapt_program = os.path.join(self.build_tools, 'aapt')
+        with open(aapt_program, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    '{ cat "$3"; echo crunched; } > "$5"\n')
+        os.chmod(aapt_program, 0o755)
+        self.res_directory = os.path.join(self.directory, 'res')
+        os.makedirs(os.path.join(self.res_directory, 'drawable'))
+        os.makedirs(os.path.join(self.res_directory, 'layout'))
+        for name in ['drawable/icon.png', 'drawable/button.9.png',
+                     'layout/main.xml']:
+            with open(os.path.join(self.res_directory, name), 'w') as f:
+                f.write(name + '\n')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environment)
+        shutil.rmtree(self.directory)
+
+    def _merged(self, merged_directory, name):
+        with open(os.path.join(merged_directory, name)) as f:
+            return f.read()
+
+    def testLargerImages(self):
+        result, merged_directory = drawables.crunch(
+            self.build_tools,
+            self.res_directory,
+            os.path.join(self.directory, 'crunched'))
+        self.assertEqual(result, 0)
+        # Plain images keep the smaller source, nine-patches stay crunched
+        self.assertEqual(self._merged(merged_directory, 'drawable/icon.png'),
+                         'drawable/icon.png\n')
+        self.assertEqual(self._merged(merged_directory,
+                                      'drawable/button.9.png'),
+                         'drawable/button.9.png\ncrunched\n')
+        self.assertEqual(self._merged(merged_directory, 'layout/main.xml'),
+                         'layout/main.xml\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+root_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_directory)
+
+from androidbuildsystem import files
+
+
+def _addKeys(job):
+    """
+    Adds keys to a shared JSON file one at a time in a worker process.
+    """
+    path, name, count = job
+    for index in range(count):
+        def update(value):
+            value[name + str(index)] = index
+            return value
+        files.updateJson(path, update, {})
+
+
+class UpdateJsonTest(unittest.TestCase):
+    """
+    Updates a JSON file from several processes at once, like variants
+    recording their installs.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testConcurrentUpdatesAreKept(self):
+        path = os.path.join(self.directory, 'shared', 'installs.json')
+        names = ['debug', 'release', 'free', 'paid']
+        pool = multiprocessing.Pool(len(names))
+        try:
+            pool.map(_addKeys, [(path, name, 25) for name in names])
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(len(files.loadJson(path)), len(names) * 25)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+root_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_directory)
+
+import fake_toolchain
+from androidbuildsystem import incremental
+from androidbuildsystem import process
+
+
+class IncrementalCompileTest(unittest.TestCase):
+    """
+    Compiles a chain of sources, where C uses B and B uses A, with the fake
+    javac, which records the public methods and int constants of each
+    class.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        fake_toolchain.createToolchain(self.directory)
+        self.javac_program = os.path.join(self.directory, 'jdk', 'bin',
+                                          'javac')
+        self.src_directory = os.path.join(self.directory, 'src')
+        self.obj_directory = os.path.join(self.directory, 'obj')
+        os.makedirs(self.obj_directory)
+        self._writeSource('A', 'public int value() { return 1; }')
+        self._writeSource('B', 'private A a;')
+        self._writeSource('C', 'private B b;')
+        self._writeSource('D', '')
+        self.assertEqual(self._build(), ['A', 'B', 'C', 'D'])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _writeSource(self, name, body):
+        source_file = os.path.join(self.src_directory, 'com', 'example',
+                                   name + '.java')
+        if not os.path.exists(os.path.dirname(source_file)):
+            os.makedirs(os.path.dirname(source_file))
+        with open(source_file, 'w') as f:
+            f.write('package com.example;\n'
+                    'public class ' + name + ' {\n    ' + body + '\n}\n')
+
+    def _javaSources(self):
+        java_sources = {}
+        for root, dirnames, filenames in os.walk(self.src_directory):
+            for filename in filenames:
+                source_file = os.path.join(root, filename)
+                java_sources[os.path.relpath(source_file,
+                                             self.src_directory)] = \
+                    source_file
+        return java_sources
+
+    def _build(self, interrupt=False):
+        """
+        Compiles the sources like an incremental build, returning the names
+        of the sources compiled.
+        """
+        java_sources = self._javaSources()
+        sources, previous = incremental.loadManifest(self.obj_directory,
+                                                     'javac')
+        compile_paths, hashes = incremental.plan(sources, previous,
+                                                 self.obj_directory,
+                                                 java_sources)
+        incremental.saveManifest(self.obj_directory, 'javac', sources,
+                                 previous)
+        if interrupt:
+            return []
+        compiled = []
+        while True:
+            if len(compile_paths) > 0:
+                result, output = process.run(
+                    [self.javac_program,
+                     '-d', self.obj_directory,
+                     '-sourcepath', self.src_directory] + compile_paths)
+                self.assertEqual(result, 0, output)
+                compiled.extend(os.path.basename(path)[:-5]
+                                for path in compile_paths)
+            elif len(previous) == 0:
+                break
+            incremental.update(sources, self.obj_directory, hashes)
+            compile_paths = incremental.dependents(sources, previous,
+                                                   self.obj_directory,
+                                                   java_sources)
+            incremental.saveManifest(self.obj_directory, 'javac', sources,
+                                     previous)
+            if len(compile_paths) == 0:
+                break
+        return sorted(compiled)
+
+    def testNothingChanged(self):
+        self.assertEqual(self._build(), [])
+
+    def testPlan(self):
+        self._writeSource('B', 'private A a;\n    private D d;')
+        sources, previous = incremental.loadManifest(self.obj_directory,
+                                                     'javac')
+        compile_paths, hashes = incremental.plan(sources, previous,
+                                                 self.obj_directory,
+                                                 self._javaSources())
+        self.assertEqual([os.path.basename(path) for path in compile_paths],
+                         ['B.java'])
+        self.assertEqual(sorted(previous), [os.path.join('com', 'example',
+                                                         'B.java')])
+        self.assertFalse(os.path.exists(os.path.join(
+            self.obj_directory, 'com', 'example', 'B.class')))
+
+    def testBodyChange(self):
+        self._writeSource('A', 'public int value() { return 2; }')
+        self.assertEqual(self._build(), ['A'])
+
+    def testSignatureChangeOnlyCompilesDirectUsers(self):
+        self._writeSource('A', 'public int value() { return 1; }\n'
+                          '    public int other() { return 2; }')
+        self.assertEqual(self._build(), ['A', 'B'])
+        self.assertEqual(self._build(), [])
+
+    def testConstantChangeCompilesEverything(self):
+        self._writeSource('D', 'public static final int SIZE = 1;')
+        self.assertEqual(self._build(), ['A', 'B', 'C', 'D'])
+        self._writeSource('D', 'public static final int SIZE = 2;')
+        self.assertEqual(self._build(), ['A', 'B', 'C', 'D'])
+
+    def testInterruptedBuildStillCompilesUsers(self):
+        self._writeSource('A', 'public boolean value() { return true; }')
+        self.assertEqual(self._build(interrupt=True), [])
+        self.assertEqual(self._build(), ['A', 'B'])
+
+    def testDeletedSourceCompilesUsers(self):
+        os.remove(os.path.join(self.src_directory, 'com', 'example',
+                               'A.java'))
+        self.assertEqual(self._build(), ['B'])
+        self.assertFalse(os.path.exists(os.path.join(
+            self.obj_directory, 'com', 'example', 'A.class')))
+
+    def testMissingClassFile(self):
+        os.remove(os.path.join(self.obj_directory, 'com', 'example',
+                               'C.class'))
+        self.assertEqual(self._build(), ['C'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+root_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_directory)
+
+import fake_toolchain
+from androidbuildsystem import jvm
+
+
+class WorkerTest(unittest.TestCase):
+    """
+    Runs dx on the fake JVM worker.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.environment = dict(os.environ)
+        fake_toolchain.createToolchain(self.directory)
+        os.environ['ANDROIDBUILDSYSTEM_HOME'] = os.path.join(self.directory,
+                                                             'home')
+        jvm.configure(1, os.path.join(self.directory, 'jdk'))
+        for statistic in jvm.statistics:
+            jvm.statistics[statistic] = 0
+        self.obj_directory = os.path.join(self.directory, 'obj')
+        os.makedirs(self.obj_directory)
+        with open(os.path.join(self.obj_directory, 'Main.class'), 'w') as f:
+            f.write('Main')
+        self.dex_file = os.path.join(self.directory, 'classes.dex')
+
+    def tearDown(self):
+        jvm.shutdown()
+        jvm.configure(0, None)
+        jvm._pools.clear()
+        jvm._failed.clear()
+        jvm._unsupported.clear()
+        os.environ.clear()
+        os.environ.update(self.environment)
+        shutil.rmtree(self.directory)
+
+    def _dx(self):
+        return jvm.run([os.path.join(self.directory, 'sdk', 'build-tools',
+                                     fake_toolchain.build_tools_version, 'dx'),
+                        '--dex',
+                        '--output=' + self.dex_file,
+                        self.obj_directory])
+
+    def testToolRunsOnWorker(self):
+        self.assertEqual(self._dx(), (0, ''))
+        self.assertEqual(self._dx(), (0, ''))
+        self.assertTrue(os.path.isfile(self.dex_file))
+        self.assertEqual(jvm.statistics['started'], 1)
+        self.assertEqual(jvm.statistics['requests'], 2)
+
+    def testWorkerWithoutExitTrapIsNotUsed(self):
+        os.environ['BENCHMARK_WORKER_JDK'] = '18'
+        self.assertIsNone(self._dx())
+        self.assertIsNone(self._dx())
+        self.assertFalse(os.path.exists(self.dex_file))
+        self.assertEqual(jvm.statistics['started'], 0)
+        self.assertEqual(jvm.statistics['requests'], 0)
+
+    def testToolIsNotRunAgainWhenTheWorkerExits(self):
+        os.environ['BENCHMARK_WORKER_EXIT'] = '1'
+        status, output = self._dx()
+        self.assertNotEqual(status, 0)
+        self.assertIn('exited', output)
+        self.assertTrue(os.path.isfile(self.dex_file))
+        self.assertEqual(jvm.statistics['restarts'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
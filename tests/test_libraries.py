@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+root_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_directory)
+
+import fake_toolchain
+from androidbuildsystem import files
+from androidbuildsystem import libraries
+
+
+class LibraryIndexTest(unittest.TestCase):
+    """
+    Indexes and pre-dexes library jars with the fake dx.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.environment = dict(os.environ)
+        fake_toolchain.createToolchain(self.directory)
+        os.environ['ANDROIDBUILDSYSTEM_HOME'] = os.path.join(self.directory,
+                                                             'home')
+        self.lib_directory = os.path.join(self.directory, 'lib')
+        os.makedirs(self.lib_directory)
+        for name in ['b.jar', 'a.jar', 'notes.txt']:
+            self._writeJar(name, name)
+        self._resetIndex()
+
+    def tearDown(self):
+        self._resetIndex()
+        os.environ.clear()
+        os.environ.update(self.environment)
+        shutil.rmtree(self.directory)
+
+    def _resetIndex(self):
+        libraries._index['loaded'] = False
+        libraries._index['jars'].clear()
+
+    def _writeJar(self, name, text):
+        with open(os.path.join(self.lib_directory, name), 'w') as f:
+            f.write(text)
+
+    def _savedIndex(self):
+        return files.loadJson(files.userDirectory(
+            libraries.libraries_directory, libraries.index_file))
+
+    def testIndex(self):
+        jars = libraries.index([self.lib_directory])
+        self.assertEqual([os.path.basename(jar['path']) for jar in jars],
+                         ['a.jar', 'b.jar'])
+        self.assertNotEqual(jars[0]['sha1'], jars[1]['sha1'])
+        saved_index = self._savedIndex()
+        self.assertEqual(saved_index['version'], libraries.index_version)
+        self.assertEqual(sorted(saved_index['jars']),
+                         [jar['path'] for jar in jars])
+
+    def testUnchangedJarsAreNotHashedAgain(self):
+        jars = libraries.index([self.lib_directory])
+        self._resetIndex()
+        self.assertEqual(libraries._hashJar(jars[0]['path']),
+                         (jars[0]['sha1'], False))
+        self._writeJar('a.jar', 'changed')
+        jar_hash, hashed = libraries._hashJar(jars[0]['path'])
+        self.assertTrue(hashed)
+        self.assertNotEqual(jar_hash, jars[0]['sha1'])
+
+    def testJarsArePredexedOnce(self):
+        build_tools_folder = os.path.join(self.directory, 'sdk',
+                                          'build-tools',
+                                          fake_toolchain.build_tools_version)
+        jars = libraries.index([self.lib_directory])
+        result, dex_files = libraries.predex(build_tools_folder, jars)
+        self.assertEqual(result, 0)
+        self.assertEqual([os.path.basename(dex_file)
+                          for dex_file in dex_files],
+                         [jar['sha1'] + '.dex' for jar in jars])
+        mtimes = [os.path.getmtime(dex_file) for dex_file in dex_files]
+        self.assertEqual(libraries.predex(build_tools_folder, jars),
+                         (0, dex_files))
+        self.assertEqual([os.path.getmtime(dex_file)
+                          for dex_file in dex_files], mtimes)
+
+
+if __name__ == '__main__':
+    unittest.main()
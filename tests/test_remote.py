@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+root_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_directory)
+
+import fake_toolchain
+from androidbuildsystem import remote
+
+
+class RemoteTest(unittest.TestCase):
+    """
+    Runs actions on a worker started with serve, using the fake toolchain.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        fake_toolchain.createToolchain(self.directory)
+        self.android = os.path.join(self.directory, 'sdk')
+        self.java = os.path.join(self.directory, 'jdk')
+        listener = socket.socket()
+        listener.bind(('localhost', 0))
+        self.port = listener.getsockname()[1]
+        listener.close()
+        environment = dict(os.environ,
+                           ANDROIDBUILDSYSTEM_HOME=os.path.join(
+                               self.directory, 'worker'),
+                           ANDROIDBUILDSYSTEM_WORKER_TOKEN='secret',
+                           PYTHONPATH=root_directory)
+        with open(os.devnull, 'w') as devnull:
+            self.worker = subprocess.Popen(
+                [sys.executable, '-c',
+                 'import sys\n'
+                 'from androidbuildsystem import remote\n'
+                 'remote.serve(*sys.argv[1:])\n',
+                 str(self.port), self.android, self.java],
+                env=environment,
+                stdout=devnull,
+                stderr=subprocess.STDOUT)
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(('localhost', self.port)).close()
+                break
+            except socket.error:
+                if time.time() > deadline or self.worker.poll() is not None:
+                    raise
+                time.sleep(0.05)
+        for statistic in remote.statistics:
+            remote.statistics[statistic] = 0
+
+    def tearDown(self):
+        self.worker.terminate()
+        self.worker.wait()
+        remote.configure(None, [])
+        shutil.rmtree(self.directory)
+
+    def _writeSource(self, path, text):
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def testJavacRoundTrip(self):
+        project_directory = os.path.join(self.directory, 'project')
+        src_directory = os.path.join(project_directory, 'src')
+        gen_directory = os.path.join(project_directory, 'gen')
+        obj_directory = os.path.join(project_directory, 'obj')
+        source_paths = [os.path.join(src_directory, 'com/example/Main.java'),
+                        os.path.join(gen_directory, 'com/example/R.java')]
+        self._writeSource(source_paths[0],
+                          'package com.example;\n'
+                          'public class Main { int id = R.layout; }\n')
+        self._writeSource(source_paths[1],
+                          'package com.example;\n'
+                          'public class R { static int layout; }\n')
+        os.makedirs(obj_directory)
+        android_jar_file = os.path.join(self.android, 'platforms',
+                                        fake_toolchain.target, 'android.jar')
+        remote.configure({'workers': [str(self.port)], 'token': 'secret'},
+                         [(project_directory, '$DIR'),
+                          (self.android, '$ANDROID'),
+                          (self.java, '$JAVA')])
+        # Argument files are outside the build, like those of the build
+        argument_fd, argument_file = tempfile.mkstemp(suffix='.txt')
+        with os.fdopen(argument_fd, 'w') as f:
+            for source_path in source_paths:
+                f.write('"' + source_path + '"\n')
+        try:
+            result, output = remote.run(
+                [os.path.join(self.java, 'bin/javac'),
+                 '-d', obj_directory,
+                 '-classpath', android_jar_file,
+                 '-sourcepath', src_directory + ':' + gen_directory,
+                 '@' + argument_file],
+                [src_directory, gen_directory, android_jar_file] +
+                source_paths,
+                [obj_directory])
+        finally:
+            os.remove(argument_file)
+        self.assertEqual(result, 0, output)
+        self.assertEqual(remote.statistics['remote'], 1)
+        self.assertEqual(remote.statistics['local'], 0)
+        for name in ['Main', 'R']:
+            self.assertTrue(os.path.isfile(os.path.join(
+                obj_directory, 'com', 'example', name + '.class')))
+
+    def _sendAction(self, command, token='secret'):
+        connection = socket.create_connection(('localhost', self.port))
+        try:
+            remote._sendMessage(connection,
+                                {'version': remote.protocol_version,
+                                 'token': token,
+                                 'command': command,
+                                 'cwd': None,
+                                 'placeholders': ['$DIR'],
+                                 'inputs': {},
+                                 'outputs': []})
+            return remote._receiveMessage(connection)
+        finally:
+            connection.close()
+
+    def testOnlyToolsRun(self):
+        for command in [['$ANDROID/../../bin/sh', '-c', 'true'],
+                        ['$JAVA/bin/java', '-cp', '$DIR/evil.jar', 'Main'],
+                        ['$DIR/javac'],
+                        ['$JAVA/bin/javac', '-J-javaagent:$DIR/evil.jar'],
+                        ['$JAVA/bin/javac', '-processorpath', '$DIR']]:
+            self.assertIn('error', self._sendAction(command))
+
+    def testWrongToken(self):
+        self.assertEqual(self._sendAction(['$JAVA/bin/javac'], 'wrong'),
+                         {'error': 'Invalid token'})
+        self.assertNotIn('error', self._sendAction(['$JAVA/bin/javac']))
+
+    def testTokenRequiredForOtherMachines(self):
+        environment = dict(os.environ)
+        os.environ.pop(remote.token_variable, None)
+        try:
+            self.assertRaises(ValueError, remote.serve, '0.0.0.0:0',
+                              self.android, self.java)
+        finally:
+            os.environ.clear()
+            os.environ.update(environment)
+
+
+class EvictBlobsTest(unittest.TestCase):
+    """
+    Evicts the blobs stored by a worker.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = Server()
+        self.server.directory = self.directory
+        self.server.max_size = 25
+        self.server.blob_lock = threading.Lock()
+        self.server.blobs_in_use = collections.Counter()
+        os.makedirs(os.path.join(self.directory, 'blobs'))
+        for index, blob_hash in enumerate(['old', 'used', 'new']):
+            blob_file = os.path.join(self.directory, 'blobs', blob_hash)
+            with open(blob_file, 'w') as f:
+                f.write('x' * 10)
+            os.utime(blob_file, (index, index))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testLeastRecentlyUsedBlobsAreRemoved(self):
+        remote._evictBlobs(self.server)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.directory,
+                                                        'blobs'))),
+                         ['new', 'used'])
+
+    def testBlobsInUseAreKept(self):
+        self.server.max_size = 0
+        self.server.blobs_in_use['used'] += 1
+        remote._evictBlobs(self.server)
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'blobs')),
+                         ['used'])
+
+
+class Server(object):
+    """
+    Holds the attributes serve sets on a worker server.
+    """
+
+
+if __name__ == '__main__':
+    unittest.main()
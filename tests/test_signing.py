@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import binascii
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+root_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_directory)
+
+import fake_toolchain
+from androidbuildsystem import apk
+from androidbuildsystem import process
+from androidbuildsystem import resources
+from androidbuildsystem import signing
+
+
+def _findProgram(name, directories):
+    """
+    Finds a program in the given directories or on the PATH.
+    """
+    directories = directories + \
+        os.environ.get('PATH', '').split(os.pathsep)
+    for directory in directories:
+        program = os.path.join(directory, name)
+        if os.path.isfile(program) and os.access(program, os.X_OK):
+            return program
+    return None
+
+
+jarsigner_program = _findProgram(
+    'jarsigner', [os.path.join(os.environ.get('JAVA_HOME', ''), 'bin')])
+apksigner_program = _findProgram(
+    'apksigner', sorted(glob.glob(os.path.join(
+        os.environ.get('ANDROID_HOME', ''), 'build-tools', '*')))[-1:])
+
+
+class SigningTest(unittest.TestCase):
+    """
+    Signs APKs with the built in signer using a keystore made by the fake
+    keytool.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        keystore_file = os.path.join(self.directory, 'debug.keystore')
+        fake_toolchain.createKeystore(keystore_file, 'android', 'android',
+                                      'androiddebugkey')
+        self.key = signing.loadKey(keystore_file, 'android', 'android',
+                                   'androiddebugkey')
+        self.apk_file = os.path.join(self.directory, 'app.apk')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _signApk(self, digest_algorithm):
+        writer = apk.ApkWriter(self.apk_file, 4, digest_algorithm)
+        writer.addBytes('AndroidManifest.xml', '<manifest/>')
+        writer.addBytes('classes.dex', 'dex' * 100)
+        writer.addBytes('res/raw/data', 'resources' * 100, False)
+        writer.close(signing.v1Signer(self.key, True, digest_algorithm),
+                     signing.v2Signer(self.key))
+
+    def _verify(self, digest_algorithm):
+        """
+        Verifies the v1 signature of the APK the way Android does.
+        """
+        algorithm = signing.digest_algorithms[digest_algorithm]
+        digest = lambda data: base64.b64encode(
+            algorithm['hash'](data).digest())
+        with zipfile.ZipFile(self.apk_file) as apk_zip:
+            manifest = apk_zip.read('META-INF/MANIFEST.MF')
+            signature_file = apk_zip.read('META-INF/CERT.SF')
+            signature_block = apk_zip.read('META-INF/CERT.RSA')
+            sections = manifest.split('\r\n\r\n')[1:-1]
+            self.assertEqual(len(sections), 3)
+            for section in sections:
+                lines = section.split('\r\n')
+                name = lines[0][len('Name: '):]
+                self.assertEqual(lines[1], digest_algorithm + '-Digest: ' +
+                                 digest(apk_zip.read(name)))
+                self.assertIn(lines[0] + '\r\n' + digest_algorithm +
+                              '-Digest: ' + digest(section + '\r\n\r\n'),
+                              signature_file)
+        self.assertIn(digest_algorithm + '-Digest-Manifest: ' +
+                      digest(manifest) + '\r\n', signature_file)
+        self.assertIn(algorithm['algorithm'], signature_block)
+        signature = signing._sign(self.key, signature_file, digest_algorithm)
+        self.assertIn(signature, signature_block)
+        message = pow(long(binascii.hexlify(signature), 16), 65537,
+                      self.key['n'])
+        self.assertTrue(('%x' % message).endswith(binascii.hexlify(
+            algorithm['digest_info'] +
+            algorithm['hash'](signature_file).digest())))
+
+    def testDigestAlgorithm(self):
+        self.assertEqual(resources.manifestMinSdkVersion(
+            os.path.join(root_directory, 'example', 'AndroidManifest.xml')),
+            2)
+        self.assertEqual(signing.v1DigestAlgorithm(2), 'SHA1')
+        self.assertEqual(signing.v1DigestAlgorithm(17), 'SHA1')
+        self.assertEqual(signing.v1DigestAlgorithm(18), 'SHA-256')
+        self.assertEqual(signing.v1DigestAlgorithm(None), 'SHA-256')
+
+    def testSha1(self):
+        self._signApk('SHA1')
+        self._verify('SHA1')
+
+    def testSha256(self):
+        self._signApk('SHA-256')
+        self._verify('SHA-256')
+
+    @unittest.skipUnless(jarsigner_program, 'jarsigner is not installed')
+    def testJarsignerVerifies(self):
+        for digest_algorithm in sorted(signing.digest_algorithms):
+            self._signApk(digest_algorithm)
+            result, output = process.run([jarsigner_program, '-verify',
+                                          self.apk_file])
+            self.assertEqual(result, 0, output)
+            self.assertIn('jar verified.', output)
+
+    @unittest.skipUnless(apksigner_program, 'apksigner is not installed')
+    def testApksignerVerifies(self):
+        for digest_algorithm, min_sdk_version in [('SHA1', '2'),
+                                                  ('SHA-256', '18')]:
+            self._signApk(digest_algorithm)
+            result, output = process.run([apksigner_program, 'verify',
+                                          '--min-sdk-version',
+                                          min_sdk_version,
+                                          self.apk_file])
+            self.assertEqual(result, 0, output)
+
+
+if __name__ == '__main__':
+    unittest.main()